@@ -1,11 +1,32 @@
-from sqlalchemy.orm import sessionmaker
+import os
+
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy import create_engine
 from src.database.config import *
 
-db_url = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+# DATABASE_URL переопределяет базу, например sqlite для тестов
+db_url = os.getenv("DATABASE_URL", f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}")
 
 engine = create_engine(db_url)
 
 my_Session = sessionmaker(bind=engine)
-session = my_Session()
-print(session)
\ No newline at end of file
+
+
+class ThreadLocalSession:
+    """Сессия для `with session as s`, у каждого потока своя.
+    Репозитории вызываются и из цикла событий, и из пула потоков (прогрев, фоновые задачи),
+    а одна общая Session не потокобезопасна
+    """
+
+    def __init__(self, factory: sessionmaker):
+        self._registry = scoped_session(factory)
+
+    def __enter__(self) -> Session:
+        return self._registry()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._registry.remove()
+
+
+session = ThreadLocalSession(my_Session)
+print(session)
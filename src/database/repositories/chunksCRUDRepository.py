@@ -1,8 +1,8 @@
 from typing import List
 
 from src.database.connection import session
-from src.database.tables import Chunks
-from sqlalchemy import and_
+from src.database.tables import Chunks, Files
+from sqlalchemy import and_, or_, exists
 
 
 def insert_chunk(chunk: Chunks) -> int:
@@ -23,6 +23,30 @@ def select_source_chunk(user_id: int, workspace_id: int, belongs_to: str, doc_nu
         return None
 
 
+def select_chunks_by_spans(user_id: int, workspace_id: int, spans: dict[str, list[tuple[int, int]]]) -> list[Chunks]:
+    """Фрагменты всех файлов одним запросом: spans - {название файла: [(первый номер, последний номер)]}"""
+    conditions = [
+        and_(Chunks.source_doc_name == belongs_to, Chunks.doc_number.between(first, last))
+        for belongs_to, file_spans in spans.items()
+        for first, last in file_spans
+    ]
+    if not conditions:
+        return []
+    with session as s:
+        res = s.query(Chunks).filter(
+            and_(Chunks.user_id == user_id, Chunks.workspace_id == workspace_id, or_(*conditions))
+        ).order_by(Chunks.source_doc_name, Chunks.doc_number).all()
+    return res
+
+
+def select_doc_numbers_by_file(user_id: int, workspace_id: int, belongs_to: str) -> list[int]:
+    with session as s:
+        res = s.query(Chunks.doc_number).filter(
+            and_(Chunks.user_id == user_id, Chunks.workspace_id == workspace_id, Chunks.source_doc_name == belongs_to)
+        ).order_by(Chunks.doc_number).all()
+    return [row.doc_number for row in res]
+
+
 def select_all_chunks_from_workspace(user_id: int, workspace_id: int) -> list[Chunks]:
     with session as s:
         res = s.query(Chunks).filter(
@@ -35,3 +59,44 @@ def delete_all_chunks_in_workspace(user_id: int, workspace_id: int) -> None:
     with session as s:
         s.query(Chunks).filter(and_(Chunks.user_id == user_id, Chunks.workspace_id == workspace_id)).delete()
         s.commit()
+
+
+def delete_chunks_by_file(user_id: int, workspace_id: int, belongs_to: str) -> None:
+    with session as s:
+        s.query(Chunks).filter(
+            and_(Chunks.user_id == user_id, Chunks.workspace_id == workspace_id, Chunks.source_doc_name == belongs_to)
+        ).delete()
+        s.commit()
+
+
+def _orphan_chunks_filter():
+    """Фрагменты, для которых в пространстве больше нет файла (файл или пространство удалены)"""
+    return ~exists().where(and_(Files.user_id == Chunks.user_id,
+                                Files.workspace_id == Chunks.workspace_id,
+                                Files.file_name == Chunks.source_doc_name))
+
+
+def select_orphan_chunk_workspaces() -> list[tuple[int, int]]:
+    """Пространства (user_id, workspace_id), в которых есть фрагменты без файла"""
+    with session as s:
+        res = s.query(Chunks.user_id, Chunks.workspace_id).filter(_orphan_chunks_filter()).distinct().all()
+    return [(row.user_id, row.workspace_id) for row in res]
+
+
+def select_orphan_chunk_ids(user_id: int, workspace_id: int, limit: int) -> list[int]:
+    with session as s:
+        res = s.query(Chunks.id).filter(
+            and_(Chunks.user_id == user_id, Chunks.workspace_id == workspace_id, _orphan_chunks_filter())
+        ).order_by(Chunks.id).limit(limit).all()
+    return [row.id for row in res]
+
+
+def count_orphan_chunks() -> int:
+    with session as s:
+        return s.query(Chunks.id).filter(_orphan_chunks_filter()).count()
+
+
+def delete_chunks_by_ids(ids: list[int]) -> None:
+    with session as s:
+        s.query(Chunks).filter(Chunks.id.in_(ids)).delete(synchronize_session=False)
+        s.commit()
@@ -26,3 +26,10 @@ def delete_all_files_in_workspace(user_id: int, workspace_id: int) -> None:
         s.query(Files).filter(
             and_(Files.user_id == user_id, Files.workspace_id == workspace_id)).delete()
         s.commit()
+
+
+def delete_files_by_name(user_id: int, workspace_id: int, file_name: str) -> None:
+    with session as s:
+        s.query(Files).filter(
+            and_(Files.user_id == user_id, Files.workspace_id == workspace_id, Files.file_name == file_name)).delete()
+        s.commit()
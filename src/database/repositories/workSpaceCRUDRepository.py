@@ -18,11 +18,21 @@ def select_all_by_user_id(user_id: int) -> List[WorkSpace]:
         return s.query(WorkSpace).filter(WorkSpace.user_id == user_id).all()
 
 
+def select_all() -> List[WorkSpace]:
+    with session as s:
+        return s.query(WorkSpace).all()
+
+
 def select_workspace(user_id: int, workspace_name: str) -> WorkSpace | None:
     with session as s:
         return s.query(WorkSpace).filter(WorkSpace.user_id == user_id, WorkSpace.name == workspace_name).first()
 
 
+def exists_workspace(user_id: int, workspace_id: int) -> bool:
+    with session as s:
+        return s.query(WorkSpace.id).filter(WorkSpace.user_id == user_id, WorkSpace.id == workspace_id).first() is not None
+
+
 def delete_workspace(user_id: int, workspace_id: int) -> None:
     with session as s:
         s.query(WorkSpace).filter(WorkSpace.user_id == user_id, WorkSpace.id == workspace_id).delete()
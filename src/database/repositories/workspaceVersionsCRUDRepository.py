@@ -0,0 +1,34 @@
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from src.database.connection import session
+from src.database.tables import WorkspaceVersion
+
+
+def _filter(user_id: int, workspace_id: int):
+    return and_(WorkspaceVersion.user_id == user_id, WorkspaceVersion.workspace_id == workspace_id)
+
+
+def select_version(user_id: int, workspace_id: int) -> int:
+    with session as s:
+        version = s.query(WorkspaceVersion.version).filter(_filter(user_id, workspace_id)).scalar()
+    return version or 0
+
+
+def increment_version(user_id: int, workspace_id: int) -> int:
+    """Увеличивает версию одним UPDATE. Строка создается при первом изменении пространства,
+    если ее одновременно создал другой процесс, увеличение повторяется UPDATE
+    """
+    try:
+        with session as s:
+            updated = s.query(WorkspaceVersion).filter(_filter(user_id, workspace_id)).update(
+                {WorkspaceVersion.version: WorkspaceVersion.version + 1}, synchronize_session=False)
+            if not updated:
+                s.add(WorkspaceVersion(user_id=user_id, workspace_id=workspace_id, version=1))
+            s.commit()
+    except IntegrityError:
+        with session as s:
+            s.query(WorkspaceVersion).filter(_filter(user_id, workspace_id)).update(
+                {WorkspaceVersion.version: WorkspaceVersion.version + 1}, synchronize_session=False)
+            s.commit()
+    return select_version(user_id, workspace_id)
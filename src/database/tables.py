@@ -88,4 +88,12 @@ class FavoriteMessages(Base):
     text = Column(String)
 
 
+class WorkspaceVersion(Base):
+    """Версия содержимого пространства, общая для всех процессов API"""
+    __tablename__ = 'workspace_versions'
+    user_id = Column(Integer, primary_key=True)
+    workspace_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 Base.metadata.create_all(engine)
@@ -1,6 +1,7 @@
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+from src.rag_agent_api.routers.admin_router import router as admin_router
 from src.rag_agent_api.routers.main_router import router as main_router
 from src.rag_agent_api.routers.files_router import router as files_router
 from src.rag_agent_api.routers.workspace_router import router as workspace_router
@@ -12,6 +13,7 @@ app.include_router(main_router)
 app.include_router(files_router)
 app.include_router(workspace_router)
 app.include_router(user_router)
+app.include_router(admin_router)
 
 origins = [
     "http://localhost:5173",
@@ -1,63 +1,95 @@
+import asyncio
 import json
 from pprint import pprint
 from typing import Any, NamedTuple
 
 from langchain_core.language_models import LanguageModelLike
 from langchain_core.tools import tool, InjectedToolArg
+from pydantic import BaseModel, Field
 from typing_extensions import Annotated
 
 from src.rag_agent_api.agents.rag_agent import RagAgent
 from src.rag_agent_api.agents.searcher_agent import SeracherAgent
-from src.rag_agent_api.langchain_model_init import model_for_answer
+from src.rag_agent_api.config import PLAN_MAX_CONCURRENT_STEPS, PLAN_STEP_RESULT_MAX_CHARS
+from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
+from src.rag_agent_api.services.chunk_store_service import ChunkStore
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.plan_budget_service import PlanBudget, PlanBudgetExceeded
 from langchain_core.documents import Document
 
 class RagSearchRes(NamedTuple):
     answer: str
     used_docs: list[str]
-    neighboring_docs: list[str]
+    neighboring_docs: list[Document]
 
 
 class PlanResult(NamedTuple):
     answer: str
     used_docs: list[str]
     neighboring_docs: list[Document]
+    # расход бюджета задачи, см. PlanBudget.usage; exhausted - причина остановки по бюджету или None
+    usage: dict[str, Any] | None = None
+
+
+class PlanStep(BaseModel):
+    """Шаг плана"""
+    id: int = Field(description="номер шага, начиная с 1")
+    step: str = Field(description="конкретное действие, выполнимое одним инструментом или собственными знаниями")
+    depends_on: list[int] = Field(default_factory=list,
+                                  description="номера предыдущих шагов, результаты которых нужны для этого шага")
+
+
+class Plan(BaseModel):
+    """План выполнения задачи: граф шагов, независимые шаги выполняются одновременно"""
+    steps: list[PlanStep] = Field(description="шаги плана")
+
+
+# графы агентов-инструментов компилируются один раз, retriever передается в config вызова
+searcher_agent = SeracherAgent(model_for_answer, node_models)
+rag_agent = RagAgent(model_for_answer, models=node_models)
 
 
 @tool
-def web_search(question: str) -> str:
+async def web_search(question: str) -> str:
     """Используй этот иннструмент для ответа на вопрос с помощью поиска в интернете"""
 
-    searcher = SeracherAgent(model_for_answer)
-    answer = searcher().invoke({"user_input": question})["answer"]
+    answer = (await searcher_agent().ainvoke({"user_input": question}))["answer"]
     return answer
 
 
 @tool
-def rag_search(
+async def rag_search(
         question: str,
         user_id: Annotated[int, InjectedToolArg],
         workspace_id: Annotated[int, InjectedToolArg],
-        belongs_to: Annotated[str, InjectedToolArg],
+        belongs_to: Annotated[str | None, InjectedToolArg],
         chat_history: Annotated[list[tuple[str, str]], InjectedToolArg],
         retriever: Annotated[Any, InjectedToolArg],
 
 ) -> RagSearchRes:
     """Поиск в векторном хранилище пользователя"""
-    rag_agent = RagAgent(model_for_answer, retriever)
-    result = rag_agent().invoke(
+    chunk_store = ChunkStore()
+    result = await rag_agent().ainvoke(
         {"question": question,
          "user_id": user_id,
          "workspace_id": workspace_id,
          "belongs_to": belongs_to,
-         "chat_history": chat_history}
+         "chat_history": chat_history},
+        {"configurable": {"retriever": retriever, "chunk_store": chunk_store}}
     )
 
-    return RagSearchRes(result["answer"], result["used_docs"], result["neighboring_docs"])
+    return RagSearchRes(result["answer"], result["used_docs"], chunk_store.documents(result["neighboring_chunks"]))
 
 
 tools = [web_search, rag_search]
 
 
+def _truncate(text: str, limit: int = PLAN_STEP_RESULT_MAX_CHARS) -> str:
+    """Результат шага для запросов к LLM: длинные ответы инструментов не раздувают следующие запросы"""
+    text = str(text)
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
 class PlanAndExecuteAgent:
     def __init__(self,
                  llm: LanguageModelLike,
@@ -67,6 +99,7 @@ class PlanAndExecuteAgent:
                  belongs_to: str,
                  retriever,
                  chat_history: list[tuple[str, str]],
+                 callbacks: list | None = None,
                  ):
         self.llm = llm
         self.max_plan_length = max_plan_length
@@ -75,29 +108,115 @@ class PlanAndExecuteAgent:
         self.belongs_to = belongs_to
         self.retriever = retriever
         self.chat_history = chat_history
+        # callbacks трассировки запроса, вызовы LLM подписываются через metadata["trace_node"]
+        self.callbacks = callbacks
+        self.budget = PlanBudget()
 
         self.tools = {t.name: t for t in tools}
-        self.plan = []
-        self.current_step = 0
+        self.plan: list[PlanStep] = []
         self.result_steps = {}
+        # успешные результаты шагов всех планов задачи в порядке выполнения, из них берется частичный ответ
+        self.completed_steps: dict[str, str] = {}
+        # результаты инструментов в пределах запроса: {(инструмент, аргументы): задача вызова},
+        # одинаковые вызовы разных шагов и планов выполняются один раз
+        self._tool_results: dict[tuple[str, str], asyncio.Task] = {}
 
         self.used_docs = []
         self.neighboring_docs = []
 
-    def run(self, task: str) -> PlanResult:
-        self.plan = self._create_plan(task, self.chat_history)
-        self.current_step = 0
+    def _config(self, stage: str) -> dict[str, Any]:
+        return {"callbacks": [*(self.callbacks or []), self.budget],
+                "metadata": {"trace_node": f"plan_and_execute/{stage}"}}
+
+    async def run(self, task: str) -> PlanResult:
+        """Задача выполняется в пределах бюджета PlanBudget, при его исчерпании возвращается частичный ответ"""
+        self.budget = PlanBudget()
+        exhausted = None
+        try:
+            result = await asyncio.wait_for(self._plan_and_execute(task), self.budget.max_seconds)
+        except PlanBudgetExceeded as e:
+            exhausted = e.reason
+        except asyncio.TimeoutError:
+            exhausted = "time"
+        finally:
+            for call in self._tool_results.values():
+                call.cancel()
+        if exhausted is not None:
+            print("бюджет задачи исчерпан", exhausted, self.budget.usage())
+            metrics.inc("plan_budget_exhausted", labels={"reason": exhausted})
+            result = self._partial_result()
+
+        usage = {**self.budget.usage(), "exhausted": exhausted}
+        metrics.observe("plan_llm_calls", usage["llm_calls"])
+        metrics.observe("plan_tokens", usage["tokens"])
+        metrics.observe("plan_seconds", usage["seconds"])
+        return result._replace(usage=usage)
+
+    async def _plan_and_execute(self, task: str) -> PlanResult:
+        self.plan = await self._create_plan(task, self.chat_history)
+        return await self._execute_plan(task)
+
+    def _partial_result(self) -> PlanResult:
+        """Лучший частичный ответ - результат последнего успешно выполненного шага:
+        шаги с зависимостями выполняются позже шагов, результаты которых они используют
+        """
+        if not self.completed_steps:
+            answer = "Не удалось выполнить задачу в пределах отведенного времени и числа обращений к модели."
+        else:
+            answer = list(self.completed_steps.values())[-1]
+        return PlanResult(answer, self.used_docs, self.neighboring_docs)
+
+    async def _execute_plan(self, task: str) -> PlanResult:
+        """Шаг запускается, когда выполнены шаги из его depends_on, независимые шаги выполняются
+        одновременно, не более PLAN_MAX_CONCURRENT_STEPS сразу
+        """
+        steps = {step.id: step for step in self.plan}
+        semaphore = asyncio.Semaphore(PLAN_MAX_CONCURRENT_STEPS)
+        running: dict[int, asyncio.Task] = {}
+
+        async def run_step(step: PlanStep) -> str:
+            dependencies = {}
+            for dependency in step.depends_on:
+                result = await running[dependency]
+                if result.startswith("Ошибка"):
+                    return f"Ошибка: не выполнен шаг {dependency}, от которого зависит шаг {step.id}"
+                dependencies[steps[dependency].step] = _truncate(result)
+            async with semaphore:
+                result = await self._execute_tool(step.step, dependencies)
+            if not result.startswith("Ошибка"):
+                self.completed_steps[step.step] = result
+            return result
 
         for step in self.plan:
-            result = self._execute_tool(step, self.result_steps)
-            self.result_steps[step] = result
-            if isinstance(result, str) and result.startswith("Ошибка"):
-                print("ошибка выполнения плана, переплан")
-                self.result_steps = {}
-                return self._replan(task, result)
-        return self._final_result()
-
-    def _create_plan(self, task, chat_history) -> list[str]:
+            running[step.id] = asyncio.create_task(run_step(step))
+        try:
+            results = await asyncio.gather(*running.values())
+        except BaseException:
+            # бюджет исчерпан или задача отменена: остальные шаги не продолжаются
+            for step_task in running.values():
+                step_task.cancel()
+            raise
+
+        self.result_steps = {step.step: result for step, result in zip(self.plan, results)}
+        errors = [result for result in results if result.startswith("Ошибка")]
+        if errors:
+            print("ошибка выполнения плана, переплан", errors)
+            self.result_steps = {}
+            return await self._replan(task, errors[0])
+        return await self._final_result()
+
+    def _validate_plan(self, plan: Plan) -> list[PlanStep]:
+        """Шаг может зависеть только от шагов, стоящих в плане раньше него, поэтому в плане нет циклов"""
+        steps, seen = [], set()
+        for step in plan.steps[:self.max_plan_length]:
+            if step.id in seen:
+                continue
+            steps.append(step.model_copy(update={"depends_on": [d for d in dict.fromkeys(step.depends_on)
+                                                                if d in seen]}))
+            seen.add(step.id)
+        return steps
+
+    async def _create_plan(self, task, chat_history) -> list[PlanStep]:
         prompt = f"""
         Ты  - умный ассистент, который разбивает запрос пользователя на отдельные шаги.
         
@@ -111,106 +230,107 @@ class PlanAndExecuteAgent:
         -проанализируй запрос пользователя 
         -всегда начинай с вызова интсрумента rag_search
         -при необходимо использовать актуальные на данный момент данные используй инструмент web_search
+        -для каждого шага укажи в depends_on номера предыдущих шагов, результаты которых нужны для его выполнения
+        -шаги, которым не нужны результаты других шагов, оставляй без зависимостей: они выполняются одновременно
 
-        Твоя задача: Разбей следующую задачу на последовательность шагов (не более {self.max_plan_length})
+        Твоя задача: Разбей следующую задачу на шаги (не более {self.max_plan_length})
       
         Задача: {task}
-
-        
-         Верни ответ в формате JSON:
-        {{
-            "plan": [
-                "шаг 1",
-                "шаг 2",
-                ...
-            ]
-        }}
-
-        Отвечай только в формате JSON. Проверь валидность ответа. Размышляй шаг за шагом. 
-        Всегда начинай с использования rag_search. 
         """
-        response = self.llm.invoke(prompt)
-        pprint(response.content)
         try:
-            plan = json.loads(response.content)["plan"]
-            return plan
-        except:
-            return [f"INVALID_PLAN: {response}"]
+            plan = await self.llm.with_structured_output(Plan).ainvoke(prompt, self._config("create_plan"))
+            pprint(plan)
+            return self._validate_plan(plan)
+        except PlanBudgetExceeded:
+            raise
+        except Exception as e:
+            return [PlanStep(id=1, step=f"INVALID_PLAN: {e}")]
+
+    async def _run_tool(self, name: str, args: dict) -> str | RagSearchRes:
+        if name == "rag_search":
+            return await rag_search.ainvoke({**args,
+                                             "user_id": self.user_id,
+                                             "workspace_id": self.workspace_id,
+                                             "belongs_to": self.belongs_to,
+                                             "chat_history": self.chat_history,
+                                             "retriever": self.retriever}, self._config(name))
+        return await self.tools[name].ainvoke(args, self._config(name))
+
+    async def _call_tool(self, name: str, args: dict) -> str | RagSearchRes:
+        """Вызов инструмента с запоминанием результата, неудачный вызов не запоминается"""
+        key = (name, json.dumps(args, ensure_ascii=False, sort_keys=True))
+        if key in self._tool_results:
+            metrics.inc("plan_tool_cache_hits", labels={"tool": name})
+        else:
+            self._tool_results[key] = asyncio.create_task(self._run_tool(name, args))
+        try:
+            return await asyncio.shield(self._tool_results[key])
+        except Exception:
+            self._tool_results.pop(key, None)
+            raise
 
-    def _execute_tool(self, step: str, previous_steps: dict) -> str:
+    async def _execute_tool(self, step: str, previous_steps: dict) -> str:
         prompt = f"""
         Ты  - умный ассистент, который выполняет шаги плана действий. 
 
-        Предыдущие шаги и результаты выполнения:
+        Результаты шагов, от которых зависит текущий шаг:
         {previous_steps}
 
         Текущий шаг плана: {step}
 
-        Определи, какой инструмент подходит для выполнения этого шага и какие входные данные ему нужны.
-        Доступные инструменты:
-        {json.dumps({name: t.args for name, t in self.tools.items()})}
-
-        Верни ответ в формате JSON:
-        {{
-            "thought": "рассуждения о выборе инструмента",
-            "action": "имя инструмента",
-            "action_input": "входные данные"
-        }}       
-
-        Отвечай строго в формате JSON. Проверь валидность ответа. 
+        Вызови инструмент, который подходит для выполнения этого шага, с нужными входными данными.
+        Если шаг выполняется с помощью собственных знаний, ответь без вызова инструмента.
         """
-        pprint(f"prompt для выбора инструмента {prompt}")
-        response = self.llm.invoke(prompt)
-        pprint(f"Аргументы для инстурмента {response.content}")
         try:
-            data = json.loads(response.content)
-            selected_tool = self.tools[data["action"]]
-            if not selected_tool:
-                return f"Ошибка: инструмент {data['action']} не найден"
-
-            if selected_tool.name == "rag_search":
-                answer = tools.invoke(
-                    data["action_input"],
-                    self.user_id,
-                    self.workspace_id,
-                    self.belongs_to,
-                    self.chat_history,
-                    self.retriever
-                )
-                self.used_docs = answer.used_docs
-                self.neighboring_docs = answer.neighboring_docs
+            response = await self.llm.bind_tools(list(self.tools.values())).ainvoke(
+                prompt, self._config("execute_tool"))
+            if not response.tool_calls:
+                return response.content
+            tool_call = response.tool_calls[0]
+            pprint(f"Аргументы для инстурмента {tool_call}")
+            if tool_call["name"] not in self.tools:
+                return f"Ошибка: инструмент {tool_call['name']} не найден"
+
+            answer = await self._call_tool(tool_call["name"], tool_call["args"])
+            if isinstance(answer, RagSearchRes):
+                self.used_docs = list(dict.fromkeys(self.used_docs + answer.used_docs))
+                self.neighboring_docs += answer.neighboring_docs
                 print("RAG SEARCH ANSWER", answer)
                 return answer.answer
-            return selected_tool.invoke(data["action_input"])
+            return answer
+        except PlanBudgetExceeded:
+            # исчерпание бюджета внутри шага или инструмента - не ошибка шага, а остановка задачи
+            raise
         except Exception as e:
             return f"Ошибка выполнения шага: {str(e)}"
 
-    def _replan(self, task: str, error: str) -> PlanResult:
+    async def _replan(self, task: str, error: str) -> PlanResult:
+        self.budget.start_replan()
         prompt = f"""
         При выполнении задачи возникла ошибка:
-        {error}
+        {_truncate(error)}
 
         Исходная задача: {task}
         Первоначальный план:
-        {json.dumps(self.plan, indent=2)}
+        {json.dumps([step.model_dump() for step in self.plan], ensure_ascii=False, indent=2)}
 
         Создай новый план, учитывая возникшую ошибку.
-        Верни ответ в том же JSON формате.
         """
-        self.plan = self._create_plan(prompt, self.chat_history)
-        return self.run(task)
+        self.plan = await self._create_plan(prompt, self.chat_history)
+        return await self._execute_plan(task)
 
-    def _final_result(self) -> PlanResult:
+    async def _final_result(self) -> PlanResult:
+        step_results = {step: _truncate(result) for step, result in self.result_steps.items()}
         prompt = f"""
             Ты - умный ассистент который отвечает на запросы пользователя. 
             История диалога с пользователем:
             {self.chat_history}
         
               Все шаги плана были успешно выполнены:
-              {json.dumps(self.plan, indent=2)}
+              {json.dumps([step.step for step in self.plan], ensure_ascii=False, indent=2)}
 
               Результаты выполнения:
-              {self.result_steps}
+              {step_results}
               
               Формат вывода:
               -отвечай строго в формате Markdown
@@ -229,10 +349,11 @@ class PlanAndExecuteAgent:
               Проверь валидность ответа в Markdown. 
               """
 
-        answer = self.llm.invoke(prompt)
+        answer = await self.llm.ainvoke(prompt, self._config("final_result"))
         return PlanResult(answer.content, self.used_docs, self.neighboring_docs)
 
 
 if __name__ == '__main__':
-    agent = PlanAndExecuteAgent(model_for_answer, 3)
-    print(agent.run("сколько лететь до марса на космическом корабле?"))
+    agent = PlanAndExecuteAgent(model_for_answer, 3, user_id=1, workspace_id=1, belongs_to=None,
+                                retriever=None, chat_history=[])
+    print(asyncio.run(agent.run("сколько лететь до марса на космическом корабле?")))
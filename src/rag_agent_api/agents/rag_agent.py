@@ -1,23 +1,52 @@
-from typing import List, TypedDict, NamedTuple
+import asyncio
+import logging
+import re
+import time
+from typing import List, TypedDict, NamedTuple, Literal
 
 from langchain_core.documents import Document
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
 from langgraph.types import Command
-
+from pydantic import BaseModel, Field
+
+from src.rag_agent_api.config import (
+    RERANK_MODE,
+    RERANK_MAX_CONCURRENCY,
+    RERANK_TIMEOUT_SECONDS,
+    RERANK_MIN_SCORE,
+    NEIGHBOUR_RADIUS,
+    RETRIEVAL_MAX_DISTANCE,
+    WORKING_SET_ENABLED,
+    CONTEXT_COMPRESSION_ENABLED
+)
 from src.rag_agent_api.prompts.rag_agent_prompts import (
     analyze_category_prompt,
     factual_query_chain_prompt,
     analytical_query_chain_prompt,
     opinion_query_chain_prompt,
     rerank_chain_prompt,
+    rerank_listwise_prompt,
     answer_with_context_prompt,
-    define_user_question_prompt
+    define_user_question_prompt,
+    fast_query_planner_prompt,
+    nothing_found_answer
 )
+from src.rag_agent_api.services.chunk_store_service import ChunkRef, get_chunk_store
+from src.rag_agent_api.services.context_compressor_service import context_compressor
+from src.rag_agent_api.services.context_packer_service import context_packer
+from src.rag_agent_api.services.cross_encoder_reranker_service import cross_encoder_reranker
 from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.plan_budget_service import PlanBudgetExceeded
+from src.rag_agent_api.services.query_classifier_service import category_classifier
+from src.rag_agent_api.services.working_set_service import working_sets
+
+logger = logging.getLogger("rag_agent_api.rag_agent")
 
 
 class Message(NamedTuple):
@@ -25,18 +54,37 @@ class Message(NamedTuple):
     message: str
 
 
+class QueryPlan(BaseModel):
+    """Результат быстрого планировщика запроса"""
+    question: str = Field(description="итоговый запрос пользователя с учетом истории диалога")
+    category: Literal["factual", "analytical", "opinion"] = Field(description="категория запроса")
+    sub_questions: list[str] = Field(description="дополнительные вопросы для поиска информации")
+
+
 class GraphState(TypedDict):
     question: str
     user_id: int
     workspace_id: int
     belongs_to: str
     chat_history: list[tuple[str, str]]
+    planner_mode: Literal["sequential", "fast"]
+    planner_started_at: float
+    speculative_chunks: list[ChunkRef] | None
 
     question_category: str
     question_with_additions: str
 
-    retrieved_documents: list[Document]
-    neighboring_docs: list[Document]
+    # в состоянии только ссылки на фрагменты, тексты - в ChunkStore запроса из config
+    retrieved_chunks: list[ChunkRef]
+    neighboring_chunks: list[ChunkRef]
+    # ни один найденный фрагмент не прошел RETRIEVAL_MAX_DISTANCE
+    retrieval_empty: bool
+    # фрагменты взяты из рабочего набора беседы без поиска
+    working_set_used: bool
+    context_tokens: int
+    context_dropped_tokens: int
+    # токены контекста, убранные сжатием до предложений, близких к вопросу
+    context_saved_tokens: int
 
     answer: str
 
@@ -44,47 +92,155 @@ class GraphState(TypedDict):
 
 
 class RagAgent:
-    def __init__(self, model: BaseChatModel, retriever):
+    def __init__(self, model: BaseChatModel, retriever=None, models: dict[str, BaseChatModel] | None = None):
+        """Граф и цепочки создаются один раз, retriever и хранилище текстов фрагментов запроса передаются
+        в каждом вызове через config={"configurable": {"retriever": retriever, "chunk_store": ChunkStore()}},
+        переданный в конструктор retriever используется по умолчанию.
+        models - модели отдельных узлов (см. LLM_NODE_MODELS), для остальных используется model
+        """
         self.model = model
+        self.models = models or {}
         self.retriever = retriever
         self.state = GraphState
+        self._background_tasks: set[asyncio.Task] = set()
+        self._build_chains()
         self.app = self.compile_graph()
 
-    def __simple_chain(self, system_prompt: str, question: str) -> str:
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system_prompt),
-                ("human", "Вопрос пользователя: {question}")
-            ]
-        )
-
-        answer_chain = prompt | self.model | StrOutputParser()
-        return answer_chain.invoke({"question": question})
-
-    def define_user_question(self, state: GraphState):
-        prompt = ChatPromptTemplate.from_messages(
+    def _build_chains(self) -> None:
+        self._simple_chains = {
+            system_prompt: ChatPromptTemplate.from_messages(
+                [
+                    ("system", system_prompt),
+                    ("human", "Вопрос пользователя: {question}")
+                ]
+            ) | self.models.get(node, self.model) | StrOutputParser()
+            for system_prompt, node in ((analyze_category_prompt, "analyze_query_for_category"),
+                                        (factual_query_chain_prompt, "query_strategy"),
+                                        (analytical_query_chain_prompt, "query_strategy"),
+                                        (opinion_query_chain_prompt, "query_strategy"))
+        }
+        self._define_user_question_chain = ChatPromptTemplate.from_messages(
             [
                 ("system", define_user_question_prompt),
                 MessagesPlaceholder("chat_history"),
                 ("human", "Вопрос: {question}")
             ]
-        )
-        chain = prompt | self.model | StrOutputParser()
-        answer = chain.invoke({"chat_history": state["chat_history"], "question": state["question"]})
-        print("define user question", answer)
-        return {"question": answer}
+        ) | self.models.get("define_user_question", self.model) | StrOutputParser()
+        try:
+            self._fast_query_planner_chain = ChatPromptTemplate.from_messages(
+                [
+                    ("system", fast_query_planner_prompt),
+                    MessagesPlaceholder("chat_history"),
+                    ("human", "Вопрос: {question}")
+                ]
+            ) | self.models.get("fast_query_planner", self.model).with_structured_output(QueryPlan)
+        except NotImplementedError:
+            # модель без структурированного вывода, быстрый планировщик будет переходить к последовательному
+            self._fast_query_planner_chain = None
+        self._rerank_chain = ChatPromptTemplate.from_messages([
+            ("system", rerank_chain_prompt),
+            ("human", "Вопрос пользователя: {question}")
+        ]) | self.models.get("rerank", self.model) | StrOutputParser()
+        self._rerank_listwise_chain = ChatPromptTemplate.from_messages([
+            ("system", rerank_listwise_prompt),
+            ("human", "Вопрос пользователя: {question}")
+        ]) | self.models.get("rerank_listwise", self.model) | StrOutputParser()
+        self._answer_with_context_chain = ChatPromptTemplate.from_messages(
+            [
+                ("system", answer_with_context_prompt),
+                MessagesPlaceholder("history"),
+                ("human", "Вопрос: {question}")
+            ]
+        ) | self.models.get("answer", self.model) | StrOutputParser()
 
-    def analyze_query_for_category_chain(self, question: str) -> str:
-        return self.__simple_chain(analyze_category_prompt, question)
+    async def __simple_chain(self, system_prompt: str, question: str) -> str:
+        return await self._simple_chains[system_prompt].ainvoke({"question": question})
 
-    def analyze_query_for_category(self, state: GraphState):
+    def route_query_planner(self, state: GraphState) -> Literal["define_user_question", "fast_query_planner",
+                                                                "retrieve_documents"]:
+        """Если супервизор уже нашел документы по первому вопросу беседы, вопрос не уточняется:
+        переписывать его без истории нечем, а дополнительные вопросы для поиска не нужны
+        """
+        if state.get("speculative_chunks"):
+            planner_calls = 1 if state.get("planner_mode") == "fast" else 3
+            metrics.inc("llm_calls_saved", planner_calls, {"reason": "speculative_retrieval"})
+            return "retrieve_documents"
+        if state.get("planner_mode") == "fast":
+            return "fast_query_planner"
+        return "define_user_question"
+
+    def _observe_planner_latency(self, state: GraphState, mode: str) -> None:
+        if state.get("planner_started_at"):
+            metrics.observe("query_planner_latency_seconds", time.perf_counter() - state["planner_started_at"],
+                            {"mode": mode})
+
+    async def fast_query_planner(self, state: GraphState):
+        """Один вызов LLM со структурированным ответом вместо трех последовательных узлов:
+        уточненный вопрос, категория и дополнительные вопросы.
+        Если модель не вернула корректную структуру, выполняется обычный последовательный путь
+        """
+        started_at = time.perf_counter()
+        try:
+            if self._fast_query_planner_chain is None:
+                raise NotImplementedError("модель не поддерживает структурированный вывод")
+            plan: QueryPlan = await self._fast_query_planner_chain.ainvoke({"chat_history": state["chat_history"],
+                                                                            "question": state["question"]})
+        except PlanBudgetExceeded:
+            raise
+        except Exception as e:
+            print("ошибка быстрого планировщика, переход к последовательному", e)
+            return Command(goto="define_user_question", update={"planner_mode": "sequential"})
+        print("fast query plan", plan)
+        metrics.observe("query_planner_latency_seconds", time.perf_counter() - started_at, {"mode": "fast"})
+        return Command(goto="check_working_set", update={
+            "question": plan.question,
+            "question_category": plan.category,
+            "question_with_additions": "\n".join([plan.question] + plan.sub_questions)
+        })
+
+    async def define_user_question(self, state: GraphState):
+        started_at = time.perf_counter()
+        answer = await self._define_user_question_chain.ainvoke({"chat_history": state["chat_history"],
+                                                                 "question": state["question"]})
+        print("define user question", answer)
+        return {"question": answer, "planner_started_at": started_at}
+
+    async def check_working_set(self, state: GraphState, config: RunnableConfig):
+        """Уточняющий вопрос сначала проверяется по рабочему набору беседы - фрагментам последнего ответа.
+        Если набор покрывает вопрос, категория, дополнительные вопросы, поиск, соседи и оценка документов
+        пропускаются и ответ строится по этим фрагментам
+        """
+        next_node = "retrieve_documents" if state.get("planner_mode") == "fast" else "analyze_query_for_category"
+        # текущий вопрос уже записан в историю, уточняющим он может быть только при предыдущих репликах
+        if not WORKING_SET_ENABLED or len(state.get("chat_history") or []) <= 1:
+            return Command(goto=next_node)
+        documents = await asyncio.to_thread(working_sets.find, state["user_id"], state["workspace_id"],
+                                            state["belongs_to"], state["question"])
+        if documents is None:
+            return Command(goto=next_node)
+        print("фрагменты из рабочего набора беседы", len(documents))
+        neighboring_chunks = get_chunk_store(config).add(documents)
+        planner_calls = 2 if next_node == "analyze_query_for_category" else 0
+        metrics.inc("llm_calls_saved", planner_calls + self._rerank_calls(len(neighboring_chunks)),
+                    {"reason": "working_set"})
+        return Command(goto="generate_answer_with_retrieve_context",
+                       update={"neighboring_chunks": neighboring_chunks, "working_set_used": True})
+
+    async def analyze_query_for_category_chain(self, question: str) -> str:
+        return await self.__simple_chain(analyze_category_prompt, question)
+
+    async def analyze_query_for_category(self, state: GraphState):
         """Анализирует вопрос и разделяет его на 3 категории:
         1. Фактическая
         2. Аналитическая
         3. Формирование мнения
+        Категорию определяет локальный классификатор, LLM вызывается только при низкой уверенности.
         В зависимости от категории на следующих этапах убудут сформированы вспомогательные вопросы
         """
-        question_category: str = self.analyze_query_for_category_chain(state["question"]).lower()
+        question_category = await asyncio.to_thread(category_classifier.classify, state["question"])
+        if question_category is None:
+            question_category = (await self.analyze_query_for_category_chain(state["question"])).lower()
+            await asyncio.to_thread(category_classifier.log_decision, state["question"], question_category)
         print("category", question_category)
         if question_category == "factual":
             return Command(goto="factual_query_strategy", update={"question": state["question"],
@@ -98,126 +254,294 @@ class RagAgent:
                 "question": state["question"],
                 "question_category": question_category})
 
-    def factual_query_chain(self, question: str) -> str:
-        return self.__simple_chain(factual_query_chain_prompt, question)
+    async def factual_query_chain(self, question: str) -> str:
+        return await self.__simple_chain(factual_query_chain_prompt, question)
 
-    def factual_query_strategy(self, state: GraphState):
+    async def factual_query_strategy(self, state: GraphState):
         """Цепочка, которая выполняется если выбран тип вопроса 'Фактический'
         В этом случае генерируются дполнительные воросы
         """
         print("factual_query_strategy")
-        return {"question_with_additions": self.factual_query_chain(state["question"])}
+        question_with_additions = await self.factual_query_chain(state["question"])
+        self._observe_planner_latency(state, "sequential")
+        return {"question_with_additions": question_with_additions}
 
-    def analytical_query_chain(self, question: str) -> str:
-        return self.__simple_chain(analytical_query_chain_prompt, question)
+    async def analytical_query_chain(self, question: str) -> str:
+        return await self.__simple_chain(analytical_query_chain_prompt, question)
 
-    def analytical_query_strategy(self, state: GraphState):
+    async def analytical_query_strategy(self, state: GraphState):
         """Цепочка которая выполняется в случае если выбран тип вопроса 'Аналитический'
         Для такого вопроса генерируются уточняющие вопросы
         """
         print("analytical_query_chain")
-        return {"question_with_additions": self.analytical_query_chain(state["question"])}
+        question_with_additions = await self.analytical_query_chain(state["question"])
+        self._observe_planner_latency(state, "sequential")
+        return {"question_with_additions": question_with_additions}
 
-    def opinion_query_chain(self, question: str) -> str:
-        return self.__simple_chain(opinion_query_chain_prompt, question)
+    async def opinion_query_chain(self, question: str) -> str:
+        return await self.__simple_chain(opinion_query_chain_prompt, question)
 
-    def opinion_query_strategy(self, state: GraphState):
+    async def opinion_query_strategy(self, state: GraphState):
         """Цепочка которая выполняется в случае если выбран тип вопроса 'Формирование мнения'
         Для такого вопроса генерируются уточняющие вопросы
         """
-        return {"question_with_additions": self.opinion_query_chain(state["question"])}
-
-    def retrieve_documents(self, state: GraphState):
-        """Ищет документы и ограничивает выборку документами со сходством <= 1.3(наиболее релевантные)"""
+        question_with_additions = await self.opinion_query_chain(state["question"])
+        self._observe_planner_latency(state, "sequential")
+        return {"question_with_additions": question_with_additions}
+
+    async def retrieve_documents(self, state: GraphState, config: RunnableConfig):
+        """Ищет документы и ограничивает выборку документами с расстоянием <= RETRIEVAL_MAX_DISTANCE
+        (наиболее релевантные).
+        Если супервизор уже выполнил опережающий поиск по исходному вопросу, используются его результаты,
+        а узлы уточнения вопроса пропускаются (см. route_query_planner).
+        Тексты найденных фрагментов дальше не нужны: соседние фрагменты читаются из базы, в состояние
+        попадают только ссылки с векторной оценкой
+        """
         print("========================retrieve_documents=======================")
-        retrieved_documents: List[Document] = self.retriever.get_relevant_documents(state["question_with_additions"],
-                                                                                    state["belongs_to"],
-                                                                                    )
-        print("retrieved_documents", retrieved_documents)
-        return {"retrieved_documents": retrieved_documents}
-
-    def get_neighboring_numbers_doc(self, section_numbers_dict: dict) -> dict:
-        """Получает словарь, где ключ - раздел документа, значение - номера документов в разделе
-        Возвращает словарь, где к номерам документов добавляютс соседние номера кажого документа
+        if state.get("speculative_chunks"):
+            retrieved_chunks = state["speculative_chunks"]
+        else:
+            retriever = config.get("configurable", {}).get("retriever", self.retriever)
+            retrieved_documents: List[Document] = await asyncio.to_thread(retriever.get_relevant_documents,
+                                                                          state["question_with_additions"],
+                                                                          state["belongs_to"])
+            retrieved_chunks = [ChunkRef.from_document(doc) for doc in retrieved_documents]
+        relevant_chunks = [chunk for chunk in retrieved_chunks if chunk.score <= RETRIEVAL_MAX_DISTANCE]
+        print("retrieved_documents", len(retrieved_chunks), "relevant", len(relevant_chunks))
+        if not relevant_chunks:
+            # нерелевантные фрагменты остаются в состоянии только для подсчета пропущенных вызовов LLM
+            return {"retrieved_chunks": retrieved_chunks, "retrieval_empty": True}
+        return {"retrieved_chunks": relevant_chunks, "retrieval_empty": False}
+
+    def route_after_retrieval(self, state: GraphState) -> Literal["get_neighboring_docs", "nothing_found"]:
+        if state["retrieval_empty"]:
+            return "nothing_found"
+        return "get_neighboring_docs"
+
+    @staticmethod
+    def _rerank_calls(documents: int) -> int:
+        """Число вызовов LLM для оценки documents документов в текущем RERANK_MODE"""
+        if RERANK_MODE == "cross_encoder" or not documents:
+            return 0
+        if RERANK_MODE == "listwise":
+            return 1
+        return documents
+
+    def _skipped_llm_calls(self, retrieved_chunks: list[ChunkRef]) -> int:
+        """Вызовы LLM, которые не понадобились: оценка соседних документов и генерация ответа.
+        Число соседей оценивается по окнам вокруг найденных фрагментов
         """
-        res_dict = {}
-        for sec, numbers in section_numbers_dict.items():
-            numbers_int: list[int] = [int(s) for s in numbers.split("/")]
-            neighboring_numbers: list[int] = numbers_int + [n - 1 for n in numbers_int] + [n + 1 for n in numbers_int]
-            unique_neighboring_numbers = sorted(set(neighboring_numbers))
-            res_dict[sec] = "/".join([str(i) for i in unique_neighboring_numbers])
-        return res_dict
-
-    def section_numbers_dict(self, retrieved_documents: list[Document]) -> dict:
-        section_numbers_dict = {}
-        for doc in retrieved_documents:
-            if doc.metadata["belongs_to"] in section_numbers_dict:
-                section_numbers_dict[doc.metadata["belongs_to"]] += f'/{doc.metadata["doc_number"]}'
-            else:
-                section_numbers_dict[doc.metadata["belongs_to"]] = str(doc.metadata["doc_number"])
-        return section_numbers_dict
+        neighbours = sum(last - first + 1 for spans in self.neighbour_spans(retrieved_chunks).values()
+                         for first, last in spans)
+        return self._rerank_calls(neighbours) + 1
 
-    def get_neighboring_docs(self, state: GraphState):
-        """Ищет соседние исходные документы к тем, что были надйены при посике с помощью retriever"""
-        section_numbers_dict = self.section_numbers_dict(state["retrieved_documents"])
-        neighboring_docs_numbers: dict = self.get_neighboring_numbers_doc(section_numbers_dict)
+    def nothing_found(self, state: GraphState):
+        """Ни один найденный фрагмент не прошел порог расстояния: соседи, оценка документов
+        и генерация ответа пропускаются. Супервизор может передать вопрос другому агенту (RETRIEVAL_EMPTY_FALLBACK)
+        """
+        print("в документах ничего не найдено")
+        metrics.inc("rag_nothing_found")
+        metrics.inc("llm_calls_saved", self._skipped_llm_calls(state["retrieved_chunks"]), {"reason": "nothing_found"})
+        return {"answer": nothing_found_answer, "neighboring_chunks": [], "used_docs": []}
+
+    @staticmethod
+    def merge_spans(numbers: list[int], radius: int = NEIGHBOUR_RADIUS) -> list[tuple[int, int]]:
+        """Окна [n - radius, n + radius] вокруг номеров документов,
+        пересекающиеся и соседние окна объединяются в один непрерывный диапазон
+        """
+        spans: list[tuple[int, int]] = []
+        for n in sorted(set(numbers)):
+            first, last = max(n - radius, 0), n + radius
+            if spans and first <= spans[-1][1] + 1:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], last))
+            else:
+                spans.append((first, last))
+        return spans
+
+    def neighbour_spans(self, retrieved_chunks: list[ChunkRef]) -> dict[str, list[tuple[int, int]]]:
+        """Возвращает словарь, где ключ - документ, значение - диапазоны номеров найденных фрагментов и их соседей"""
+        numbers_by_file: dict[str, list[int]] = {}
+        for chunk in retrieved_chunks:
+            numbers_by_file.setdefault(chunk.belongs_to, []).append(chunk.doc_number)
+        return {belongs_to: self.merge_spans(numbers) for belongs_to, numbers in numbers_by_file.items()}
+
+    async def get_neighboring_docs(self, state: GraphState, config: RunnableConfig):
+        """Ищет соседние исходные документы к тем, что были надйены при посике с помощью retriever.
+        Все диапазоны всех документов извлекаются одним запросом к базе, тексты сохраняются в ChunkStore запроса
+        """
+        spans = self.neighbour_spans(state["retrieved_chunks"])
+        chunks = await asyncio.to_thread(DocumentsGetterService.get_source_chunks_by_spans,
+                                         state["user_id"], state["workspace_id"], spans)
         neighboring_docs: list[Document] = []
-        for belongs_to, numbers in neighboring_docs_numbers.items():
-            doc_nums = numbers.split("/")
-            for num in doc_nums:
-                chunk = DocumentsGetterService.get_source_chunk(state["user_id"], state["workspace_id"], belongs_to,
-                                                                num)
-                if len(chunk.page_content) > 0:
-                    neighboring_docs.append(chunk)
-        return {"neighboring_docs": neighboring_docs}
-
-    def rerank_document_chain(self, question: str, document: Document) -> str:
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", rerank_chain_prompt),
-            ("human", "Вопрос пользователя: {question}")
-        ])
-
-        chain = prompt | self.model | StrOutputParser()
-        return chain.invoke({"question": question, "document": document})
-
-    def reranked_documents(self, state: GraphState):
-        retrieved_neighboring_docs = state["neighboring_docs"]
+        for chunk in chunks:
+            if len(chunk.page_content) > 0:
+                chunk.metadata["score"] = self._neighbour_score(chunk, state["retrieved_chunks"])
+                neighboring_docs.append(chunk)
+        return {"neighboring_chunks": get_chunk_store(config).add(neighboring_docs)}
+
+    @staticmethod
+    def _neighbour_score(chunk: Document, retrieved_chunks: list[ChunkRef]) -> float:
+        """Векторная оценка соседнего документа - лучшая (наименьшая) оценка найденного документа рядом с ним"""
+        scores = [
+            retrieved.score for retrieved in retrieved_chunks
+            if retrieved.belongs_to == chunk.metadata["belongs_to"]
+            and abs(retrieved.doc_number - int(chunk.metadata["doc_number"])) <= NEIGHBOUR_RADIUS
+        ]
+        return min(scores) if scores else float("inf")
+
+    async def rerank_document_chain(self, question: str, document: Document) -> str:
+        return await self._rerank_chain.ainvoke({"question": question, "document": document})
+
+    async def rerank_listwise_chain(self, question: str, documents: list[Document]) -> str:
+        numbered_documents = "\n\n".join(f"{i + 1}. {doc.page_content}" for i, doc in enumerate(documents))
+        return await self._rerank_listwise_chain.ainvoke({"question": question, "documents": numbered_documents})
+
+    @staticmethod
+    def _parse_rank(rank: str) -> int:
+        try:
+            return int(rank)
+        except ValueError:
+            print("Неправильная оценка", rank)
+            return 0
+
+    async def _rerank_sequential(self, question: str, documents: list[Document]) -> dict[int, int]:
+        return {i: self._parse_rank(await self.rerank_document_chain(question, doc))
+                for i, doc in enumerate(documents)}
+
+    async def _rerank_parallel(self, question: str, documents: list[Document]) -> dict[int, int]:
+        """Оценивает документы одновременно (не больше RERANK_MAX_CONCURRENCY вызовов LLM).
+        Документы, которые не успели оценить за RERANK_TIMEOUT_SECONDS или с ошибкой, остаются без оценки.
+        Исчерпание бюджета плана (PlanBudgetExceeded) не ошибка оценки и пробрасывается дальше
+        """
+        semaphore = asyncio.Semaphore(RERANK_MAX_CONCURRENCY)
+
+        async def rank_document(doc: Document) -> str:
+            async with semaphore:
+                return await self.rerank_document_chain(question, doc)
+
+        tasks = {asyncio.create_task(rank_document(doc)): i for i, doc in enumerate(documents)}
+        if not tasks:
+            return {}
+        done, not_done = await asyncio.wait(tasks, timeout=RERANK_TIMEOUT_SECONDS)
+        for task in not_done:
+            task.cancel()
+        ranks, budget_exceeded = {}, None
+        for task in done:
+            error = task.exception()
+            if error is None:
+                ranks[tasks[task]] = self._parse_rank(task.result())
+            elif isinstance(error, PlanBudgetExceeded):
+                budget_exceeded = error
+            else:
+                logger.warning("Ошибка оценки документа: %r", error)
+        if budget_exceeded:
+            raise budget_exceeded
+        if not_done:
+            logger.warning("Не успели оценить документов: %d", len(not_done))
+        return ranks
+
+    async def _rerank_listwise(self, question: str, documents: list[Document]) -> dict[int, int]:
+        """Оценивает все документы одним вызовом LLM. Ответ вида 'номер: оценка' на каждой строке"""
+        try:
+            answer = await asyncio.wait_for(self.rerank_listwise_chain(question, documents),
+                                            timeout=RERANK_TIMEOUT_SECONDS)
+        except PlanBudgetExceeded:
+            raise
+        except Exception as e:
+            logger.warning("Ошибка оценки списка документов: %r", e)
+            return {}
+        ranks = {}
+        for number, rank in re.findall(r"(\d+)\s*[:.)\-–]\s*([1-5])", answer):
+            if 1 <= int(number) <= len(documents):
+                ranks[int(number) - 1] = int(rank)
+        return ranks
+
+    async def _rerank_cross_encoder(self, question: str, documents: list[Document]) -> dict[int, float]:
+        return dict(enumerate(await asyncio.to_thread(cross_encoder_reranker.score, question, documents)))
+
+    async def reranked_documents(self, state: GraphState, config: RunnableConfig):
+        """Оставляет документы, оценка релевантности которых не ниже порога выбранного режима
+        (RERANK_MIN_SCORE для LLM, CROSS_ENCODER_THRESHOLD для cross-encoder).
+        Документы без оценки (таймаут или ошибка) добавляются в конец в порядке векторной оценки
+        """
+        neighboring_chunks = state["neighboring_chunks"]
+        retrieved_neighboring_docs = get_chunk_store(config).documents(neighboring_chunks)
         question = state["question"]
-        docs_with_rank_over = []
-        for doc in retrieved_neighboring_docs:
-            rank = self.rerank_document_chain(question, doc)
-            try:
-                if int(rank) >= 3:
-                    docs_with_rank_over.append(doc)
-            except ValueError:
-                print("Неправильная оценка", rank)
-        return {"neighboring_docs": docs_with_rank_over}
-
-    def answer_with_context_chain(self, question: str, context: str, chat_history: list[tuple[str, str]]):
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", answer_with_context_prompt),
-                MessagesPlaceholder("history"),
-                ("human", "Вопрос: {question}")
-            ]
-        )
+        threshold = RERANK_MIN_SCORE
+        if RERANK_MODE == "cross_encoder":
+            ranks = await self._rerank_cross_encoder(question, retrieved_neighboring_docs)
+            threshold = cross_encoder_reranker.threshold
+        elif RERANK_MODE == "listwise":
+            ranks = await self._rerank_listwise(question, retrieved_neighboring_docs)
+        elif RERANK_MODE == "parallel":
+            ranks = await self._rerank_parallel(question, retrieved_neighboring_docs)
+        else:
+            ranks = await self._rerank_sequential(question, retrieved_neighboring_docs)
+
+        chunks_with_rank_over = [chunk._replace(rerank_score=ranks[i]) for i, chunk in enumerate(neighboring_chunks)
+                                 if ranks.get(i, 0) >= threshold]
+        unscored_chunks = sorted([chunk for i, chunk in enumerate(neighboring_chunks) if i not in ranks],
+                                 key=lambda chunk: chunk.score)
+        return {"neighboring_chunks": chunks_with_rank_over + unscored_chunks}
 
-        chain = prompt | self.model | StrOutputParser()
-        return chain.invoke({"history": chat_history, "question": question, "context": context})
+    async def answer_with_context_chain(self, question: str, context: str, chat_history: list[tuple[str, str]]):
+        return await self._answer_with_context_chain.ainvoke({"history": chat_history, "question": question,
+                                                              "context": context})
 
-    def generate_answer_with_retrieve_context(self, state: GraphState):
-        doc_context = "".join([doc.page_content for doc in state["neighboring_docs"]])
-        answer = self.answer_with_context_chain(state["question"], doc_context, state["chat_history"])
-        return {"answer": answer}
+    async def generate_answer_with_retrieve_context(self, state: GraphState, config: RunnableConfig):
+        """Контекст собирается в пределах бюджета токенов CONTEXT_TOKEN_BUDGET, см. ContextPacker,
+        и сжимается до предложений, близких к вопросу, см. ContextCompressor
+        """
+        documents = get_chunk_store(config).documents(state["neighboring_chunks"])
+        packed = await asyncio.to_thread(context_packer.pack, documents)
+        context, context_tokens, saved_tokens = packed.text, packed.used_tokens, 0
+        if CONTEXT_COMPRESSION_ENABLED:
+            compressed = await asyncio.to_thread(context_compressor.compress, state["question"], packed)
+            context, context_tokens, saved_tokens = compressed.text, compressed.tokens, compressed.saved_tokens
+            metrics.observe("context_tokens_saved", saved_tokens)
+        metrics.observe("context_tokens_used", context_tokens)
+        metrics.observe("context_tokens_dropped", packed.dropped_tokens)
+        start = time.perf_counter()
+        answer = await self.answer_with_context_chain(state["question"], context, state["chat_history"])
+        metrics.observe("answer_generation_seconds", time.perf_counter() - start,
+                        {"compressed": str(saved_tokens > 0).lower()})
+        return {"answer": answer,
+                "context_tokens": context_tokens,
+                "context_dropped_tokens": packed.dropped_tokens,
+                "context_saved_tokens": saved_tokens}
 
     def add_source_docs_names(self, state: GraphState):
-        documents: list[Document] = state["neighboring_docs"]
-        used_docs_names = list(set([doc.metadata["belongs_to"] for doc in documents]))
+        used_docs_names = list(set([chunk.belongs_to for chunk in state["neighboring_chunks"]]))
         return {"used_docs": used_docs_names}
 
+    @staticmethod
+    def _remember_working_set(user_id: int, workspace_id: int, belongs_to: str | None,
+                              documents: list[Document]) -> None:
+        try:
+            working_sets.remember(user_id, workspace_id, belongs_to, documents)
+        except Exception as e:
+            print("ошибка сохранения рабочего набора беседы", e)
+
+    async def update_working_set(self, state: GraphState, config: RunnableConfig):
+        """Фрагменты ответа становятся рабочим набором беседы для следующего вопроса.
+        Эмбеддинги фрагментов считаются в фоне, ответ их не ждет
+        """
+        if not WORKING_SET_ENABLED or not state["neighboring_chunks"]:
+            return {}
+        if state.get("working_set_used"):
+            working_sets.touch(state["user_id"], state["workspace_id"])
+            return {}
+        documents = get_chunk_store(config).documents(state["neighboring_chunks"])
+        task = asyncio.create_task(asyncio.to_thread(self._remember_working_set, state["user_id"],
+                                                     state["workspace_id"], state["belongs_to"], documents))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return {}
+
     def compile_graph(self):
         workflow = StateGraph(self.state)
         workflow.add_node("define_user_question", self.define_user_question)
+        workflow.add_node("fast_query_planner", self.fast_query_planner)
         workflow.add_node("analyze_query_for_category", self.analyze_query_for_category)
         workflow.add_node("factual_query_strategy", self.factual_query_strategy)
         workflow.add_node("analytical_query_strategy", self.analytical_query_strategy)
@@ -227,21 +551,26 @@ class RagAgent:
         workflow.add_node("reranked_documents", self.reranked_documents)
         workflow.add_node("generate_answer_with_retrieve_context", self.generate_answer_with_retrieve_context)
         workflow.add_node("add_source_docs_names", self.add_source_docs_names)
+        workflow.add_node("nothing_found", self.nothing_found)
+        workflow.add_node("check_working_set", self.check_working_set)
+        workflow.add_node("update_working_set", self.update_working_set)
 
-        workflow.add_edge(START, "define_user_question")
-        workflow.add_edge("define_user_question", "analyze_query_for_category")
+        workflow.add_conditional_edges(START, self.route_query_planner)
+        workflow.add_edge("define_user_question", "check_working_set")
 
         workflow.add_edge("factual_query_strategy", "retrieve_documents")
         workflow.add_edge("analytical_query_strategy", "retrieve_documents")
         workflow.add_edge("opinion_query_strategy", "retrieve_documents")
 
-        workflow.add_edge("retrieve_documents", "get_neighboring_docs")
+        workflow.add_conditional_edges("retrieve_documents", self.route_after_retrieval)
         workflow.add_edge("get_neighboring_docs", "reranked_documents")
 
         workflow.add_edge("reranked_documents", "generate_answer_with_retrieve_context")
         workflow.add_edge("generate_answer_with_retrieve_context", "add_source_docs_names")
 
-        workflow.add_edge("add_source_docs_names", END)
+        workflow.add_edge("add_source_docs_names", "update_working_set")
+        workflow.add_edge("update_working_set", END)
+        workflow.add_edge("nothing_found", END)
         return workflow.compile()
 
     def __call__(self, *args, **kwargs):
@@ -249,8 +578,9 @@ class RagAgent:
 
 
 if __name__ == "__main__":
+    from src.rag_agent_api.services.chunk_store_service import ChunkStore
     from src.rag_agent_api.services.retriever_service import CustomRetriever, embeddings
-    from src.rag_agent_api.langchain_model_init import model_for_answer
+    from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
     from langchain_chroma import Chroma
     from pprint import pprint
 
@@ -293,14 +623,14 @@ if __name__ == "__main__":
     ]
     retriever.vectorstore.add_documents(docs)
 
-    agent = RagAgent(model_for_answer, retriever)
+    agent = RagAgent(model_for_answer, retriever, node_models)
 
     while True:
         input_question = input("Введите сообщение: ")
 
         if input_question != "q":
             inputs = {"question": input_question}
-            result = agent().invoke(inputs)
+            result = asyncio.run(agent().ainvoke(inputs, {"configurable": {"chunk_store": ChunkStore()}}))
             print(result, result["forced_generation"])
             question, generation, web_search, forced_generation = result["question"], result["generation"], result[
                 "web_search"], result["forced_generation"]
@@ -1,3 +1,4 @@
+import asyncio
 from typing import TypedDict
 
 from langchain_core.output_parsers import StrOutputParser
@@ -21,40 +22,44 @@ class SearcherState(TypedDict):
 
 
 class SeracherAgent:
-    def __init__(self, model):
+    def __init__(self, model, models: dict | None = None):
+        """models - модели отдельных узлов (см. LLM_NODE_MODELS), для остальных используется model"""
         self.model = model
+        self.models = models or {}
         self.state = SearcherState
-        self.app = self.compile_graph()
-
-    def define_user_question(self, state: SearcherState):
-        prompt = ChatPromptTemplate.from_messages(
+        self._define_user_question_chain = ChatPromptTemplate.from_messages(
             [
                 ("system", define_user_question_prompt),
                 MessagesPlaceholder("chat_history"),
                 ("human", "Вопрос: {question}")
             ]
-        )
-        chain = prompt | self.model | StrOutputParser()
-        answer = chain.invoke({"question": state["user_input"], "chat_history": state["chat_history"]})
-        return {"user_input": answer}
-
-    def search(self, state: SearcherState):
-        web_search_result = search_tool.invoke(state["user_input"])["results"]
-        wiki_search_result = wiki_tool.invoke(state["user_input"])
-        searched_content = [r["content"] for r in web_search_result]
-        return {"searched_content": " ".join(searched_content) + wiki_search_result}
-
-    def generate_answer(self, state: SearcherState):
-        prompt = ChatPromptTemplate.from_messages(
+        ) | self.models.get("define_user_question", self.model) | StrOutputParser()
+        self._generate_answer_chain = ChatPromptTemplate.from_messages(
             [
                 ("system", generate_answer_prompt),
                 MessagesPlaceholder("chat_history"),
                 ("human", "Вопрос: {question}")
             ]
-        )
-        chain = prompt | self.model | StrOutputParser()
-        answer = chain.invoke({"chat_history": state["chat_history"], "context": state["searched_content"],
-                               "question": state["user_input"]})
+        ) | self.models.get("answer", self.model) | StrOutputParser()
+        self.app = self.compile_graph()
+
+    async def define_user_question(self, state: SearcherState):
+        answer = await self._define_user_question_chain.ainvoke({"question": state["user_input"],
+                                                                 "chat_history": state["chat_history"]})
+        return {"user_input": answer}
+
+    async def search(self, state: SearcherState):
+        """Поиск в интернете и в Википедии выполняется одновременно"""
+        web_search_response, wiki_search_result = await asyncio.gather(search_tool.ainvoke(state["user_input"]),
+                                                                       wiki_tool.ainvoke(state["user_input"]))
+        web_search_result = web_search_response["results"]
+        searched_content = [r["content"] for r in web_search_result]
+        return {"searched_content": " ".join(searched_content) + wiki_search_result}
+
+    async def generate_answer(self, state: SearcherState):
+        answer = await self._generate_answer_chain.ainvoke({"chat_history": state["chat_history"],
+                                                            "context": state["searched_content"],
+                                                            "question": state["user_input"]})
         return {"answer": answer}
 
     def compile_graph(self):
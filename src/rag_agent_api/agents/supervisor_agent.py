@@ -1,9 +1,10 @@
+import asyncio
 from typing import TypedDict, Literal, Any
 
-from langchain_core.documents import Document
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableConfig
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
 from langgraph.types import Command
@@ -11,7 +12,11 @@ from langgraph.types import Command
 from src.rag_agent_api.agents.rag_agent import RagAgent
 from src.rag_agent_api.agents.searcher_agent import SeracherAgent
 from src.rag_agent_api.agents.visualizer_agent import VisualizerAgent
+from src.rag_agent_api.config import SPECULATIVE_RETRIEVAL_ENABLED, RETRIEVAL_EMPTY_FALLBACK
 from src.rag_agent_api.prompts.supervisor_prompts import routing_prompt, simple_task_prompt
+from src.rag_agent_api.services.chunk_store_service import ChunkRef
+from src.rag_agent_api.services.query_classifier_service import route_classifier
+from src.rag_agent_api.services.speculative_retrieval_service import SpeculativeRetrieval
 
 
 class SupervisorState(TypedDict):
@@ -29,69 +34,120 @@ class SupervisorState(TypedDict):
     user_id: int
     workspace_id: int
     belongs_to: str
+    planner_mode: Literal["sequential", "fast"]
+    speculative_chunks: list[ChunkRef] | None
 
     question_category: str
     question_with_additions: str
 
-    retrieved_documents: list[Document]
-    neighboring_docs: list[Document]
+    # тексты фрагментов - в ChunkStore запроса из config
+    neighboring_chunks: list[ChunkRef]
     used_docs_names: list[str]
 
 
 class SuperVisor:
-    def __init__(self, model: BaseChatModel, retriever):
+    def __init__(self, model: BaseChatModel, retriever=None, models: dict[str, BaseChatModel] | None = None):
+        """Граф супервизора и графы агентов компилируются один раз.
+        retriever и ChunkStore запроса передаются в каждом вызове через
+        config={"configurable": {"retriever": retriever, "chunk_store": ChunkStore()}} и доходят до RagAgent
+        вместе с config узла.
+        models - модели отдельных узлов (см. LLM_NODE_MODELS), передаются агентам, для остальных узлов - model
+        """
         self.model = model
+        self.models = models or {}
         self.retriever = retriever
         self.state = SupervisorState
-        self.app = self.compile_graph()
-
-    def route_task(self, state: SupervisorState):
-        print("ROUTE TASK")
-        prompt = ChatPromptTemplate.from_messages(
+        self.rag_agent = RagAgent(self.model, self.retriever, self.models)
+        self.visualizer_agent = VisualizerAgent(self.model, self.models)
+        self.searcher_agent = SeracherAgent(self.model, self.models)
+        self._route_task_chain = ChatPromptTemplate.from_messages(
             [
                 ("system", routing_prompt),
                 MessagesPlaceholder("chat_history"),
                 ("human", "Вопрос: {question}")
             ]
-        )
-        chain = prompt | self.model | StrOutputParser()
-        ans = chain.invoke({"chat_history": state["chat_history"], "question": state["user_input"]})
+        ) | self.models.get("route_task", self.model) | StrOutputParser()
+        self._simple_task_chain = (ChatPromptTemplate.from_template(simple_task_prompt)
+                                   | self.models.get("answer", self.model) | StrOutputParser())
+        self.app = self.compile_graph()
+
+    async def route_task_chain(self, state: SupervisorState) -> str:
+        return await self._route_task_chain.ainvoke({"chat_history": state["chat_history"],
+                                                     "question": state["user_input"]})
+
+    def _start_speculative_retrieval(self, state: SupervisorState,
+                                     config: RunnableConfig) -> SpeculativeRetrieval | None:
+        """Только для первого вопроса беседы: история уже содержит текущий вопрос"""
+        retriever = config.get("configurable", {}).get("retriever", self.retriever)
+        if not SPECULATIVE_RETRIEVAL_ENABLED or retriever is None or len(state["chat_history"]) > 1:
+            return None
+        return SpeculativeRetrieval(retriever, state["user_input"], state.get("belongs_to"))
+
+    async def route_task(self, state: SupervisorState, config: RunnableConfig):
+        """Выбор агента: для первого вопроса беседы сначала локальный классификатор, при низкой уверенности - LLM.
+        При SPECULATIVE_RETRIEVAL_ENABLED одновременно с выбором агента запускается поиск по исходному вопросу
+        """
+        print("ROUTE TASK")
+        speculative_retrieval = self._start_speculative_retrieval(state, config)
+        # маршрут уточняющего вопроса зависит от истории ("построй таблицу по этим данным"),
+        # а классификатор видит только текст вопроса: с историей решает LLM, и решение не журналируется
+        has_history = len(state["chat_history"]) > 1
+        try:
+            ans = None if has_history else await asyncio.to_thread(route_classifier.classify, state["user_input"])
+            if ans is None:
+                ans = await self.route_task_chain(state)
+                if not has_history:
+                    await asyncio.to_thread(route_classifier.log_decision, state["user_input"], ans)
+        except BaseException:
+            if speculative_retrieval:
+                speculative_retrieval.discard()
+            raise
+        if speculative_retrieval and ans != "rag_agent":
+            speculative_retrieval.discard()
         if ans == "visualizer":
             return Command(goto="visualizer", update={"routing": ans})
         if ans == "rag_agent":
-            return Command(goto="rag_agent", update={"routing": ans})
+            speculative_documents = await speculative_retrieval.take() if speculative_retrieval else None
+            speculative_chunks = [ChunkRef.from_document(doc) for doc in speculative_documents] \
+                if speculative_documents else None
+            return Command(goto="rag_agent", update={"routing": ans, "speculative_chunks": speculative_chunks})
         if ans == "web_searcher":
             return Command(goto="web_searcher", update={"routing": ans})
         return Command(goto="simple", update={"routing": ans})
 
-    def handle_rag_agent(self, state: SupervisorState):
+    async def handle_rag_agent(self, state: SupervisorState, config: RunnableConfig):
+        """Если в документах ничего не найдено и RETRIEVAL_EMPTY_FALLBACK - "simple" или "web_searcher",
+        вопрос передается этому агенту, иначе возвращается ответ RagAgent
+        """
         print("rag agent")
-        rag_agent = RagAgent(self.model, self.retriever)
-        result = rag_agent().invoke(
+        result = await self.rag_agent().ainvoke(
             {"question": state["user_input"],
              "user_id": state["user_id"],
              "workspace_id": state["workspace_id"],
              "belongs_to": state["belongs_to"],
-             "chat_history": state["chat_history"]}
+             "chat_history": state["chat_history"],
+             "planner_mode": state.get("planner_mode", "sequential"),
+             "speculative_chunks": state.get("speculative_chunks")},
+            config
         )
-        print("ANSWER RAG AGENT", result)
+        if result.get("retrieval_empty") and RETRIEVAL_EMPTY_FALLBACK in ("simple", "web_searcher"):
+            return Command(goto=RETRIEVAL_EMPTY_FALLBACK, update={"routing": RETRIEVAL_EMPTY_FALLBACK})
         agent_result = {
             "type": "rag_agent"
         }
-        return {
+        return Command(goto="supervisor", update={
             "agent_result": agent_result,
             "complete": True,
             "answer": result.get("answer", ""),
-            "neighboring_docs": [doc.page_content for doc in result["neighboring_docs"]],
+            "neighboring_chunks": result["neighboring_chunks"],
             "used_docs_names": result["used_docs"]
-        }
-
-    def handle_visualizer_task(self, state: SupervisorState):
-        visualizer_agent = VisualizerAgent(self.model)
+        })
 
-        result = visualizer_agent().invoke(
+    async def handle_visualizer_task(self, state: SupervisorState, config: RunnableConfig):
+        result = await self.visualizer_agent().ainvoke(
             {"chat_history": state["chat_history"],
-             "user_input": state["user_input"]}
+             "user_input": state["user_input"]},
+            config
         )
 
         agent_result = {
@@ -106,17 +162,16 @@ class SuperVisor:
             "answer": result.get("answer", "")
         }
 
-    def web_searcher(self, state: SupervisorState):
+    async def web_searcher(self, state: SupervisorState, config: RunnableConfig):
         print("web searcher")
-        searcher_agent = SeracherAgent(self.model)
-
-        result = searcher_agent().invoke(
+        result = await self.searcher_agent().ainvoke(
             {"chat_history": state["chat_history"],
-             "user_input": state["user_input"]}
+             "user_input": state["user_input"]},
+            config
         )
 
         agent_result = {
-            "type": "visualizer",
+            "type": "web_searcher",
             "data": result,
             "complete": True,
         }
@@ -124,14 +179,14 @@ class SuperVisor:
         return {
             "agent_result": agent_result,
             "complete": agent_result["complete"],
-            "answer": result.get("searched_content", "Не удалось дать овтет")
+            "answer": result.get("answer", "Не удалось дать ответ")
         }
 
-    def handle_simple_task(self, state: SupervisorState):
+    async def handle_simple_task(self, state: SupervisorState):
         print("simple task")
 
-        chain = ChatPromptTemplate.from_template(simple_task_prompt) | self.model | StrOutputParser()
-        answer = chain.invoke({"chat_history": state["chat_history"], "user_input": state["user_input"]})
+        answer = await self._simple_task_chain.ainvoke({"chat_history": state["chat_history"],
+                                                        "user_input": state["user_input"]})
         agent_result = {
             "type": "simple",
         }
@@ -144,8 +199,6 @@ class SuperVisor:
     def supervisor_results(self, state: SupervisorState):
         result = state["agent_result"]
         print("AGENT TYPE", result["type"])
-        print("================STATE RESULT=====================")
-        print(state)
         match result["type"]:
             case "rag_agent":
                 return {"complete": True}
@@ -155,7 +208,7 @@ class SuperVisor:
                     return {"complete": False}
                 return {"use_visualizer": True, "complete": True}
             case "web_searcher":
-                return {"complete": True}
+                return {"use_web_search": True, "complete": True}
             case "simple":
                 return {"complete": True}
             case _:
@@ -173,7 +226,6 @@ class SuperVisor:
 
         workflow.add_edge(START, "route_task")
 
-        workflow.add_edge("rag_agent", "supervisor")
         workflow.add_edge("visualizer", "supervisor")
         workflow.add_edge("simple", "supervisor")
         workflow.add_edge("web_searcher", "supervisor")
@@ -187,7 +239,8 @@ class SuperVisor:
 
 
 if __name__ == "__main__":
-    from src.rag_agent_api.langchain_model_init import model_for_answer
+    from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
+    from src.rag_agent_api.services.chunk_store_service import ChunkStore
     from src.rag_agent_api.services.retriever_service import VectorDBManager
 
     question = "  кто такой илон маск"
@@ -195,6 +248,7 @@ if __name__ == "__main__":
     retriever = VectorDBManager.get_or_create_retriever(10, 20)
     super_visor = SuperVisor(
         model=model_for_answer,
+        models=node_models,
         retriever=retriever,
     )
     # chat_history = [
@@ -221,8 +275,9 @@ if __name__ == "__main__":
         """)
     ]
 
-    result = super_visor().invoke({"user_input": question, "user_id": 10, "workspace_id": 20, "belongs_to": None,
-                                   "chat_history": chat_history})
+    result = asyncio.run(super_visor().ainvoke({"user_input": question, "user_id": 10, "workspace_id": 20,
+                                                "belongs_to": None, "chat_history": chat_history},
+                                               {"configurable": {"chunk_store": ChunkStore()}}))
 
     print("RESULT", result)
     print("ANSWER", result["answer"])
@@ -32,14 +32,19 @@ def _prompt_creator(system_prompt) -> ChatPromptTemplate:
 
 
 class VisualizerAgent:
-    def __init__(self, model: BaseChatModel):
+    def __init__(self, model: BaseChatModel, models: dict[str, BaseChatModel] | None = None):
+        """models - модели отдельных узлов (см. LLM_NODE_MODELS), для остальных используется model"""
         self.model = model
+        self.models = models or {}
         self.state = VisualizerState
+        self._choose_tool_chain = (_prompt_creator(choose_tool_prompt)
+                                   | self.models.get("visualizer_choose_tool", self.model) | StrOutputParser())
+        self._table_create_chain = (_prompt_creator(table_create_prompt)
+                                    | self.models.get("answer", self.model) | StrOutputParser())
         self.app = self.compile_graph()
 
-    def choose_tool(self, state: VisualizerState):
-        chain = _prompt_creator(choose_tool_prompt) | self.model | StrOutputParser()
-        ans = chain.invoke({"history": state["chat_history"], "question": state["user_input"]})
+    async def choose_tool(self, state: VisualizerState):
+        ans = await self._choose_tool_chain.ainvoke({"history": state["chat_history"], "question": state["user_input"]})
         return {"answer_to_route": ans}
 
     def route_tools(self, state: VisualizerState) -> Literal["table", "piechart", "unknow"]:
@@ -47,9 +52,8 @@ class VisualizerAgent:
             return "table"
         return "unknow"
 
-    def handle_table_creator(self, state: VisualizerState):
-        chain = _prompt_creator(table_create_prompt) | self.model | StrOutputParser()
-        answer = chain.invoke({"history": state["chat_history"], "question": state["user_input"]})
+    async def handle_table_creator(self, state: VisualizerState):
+        answer = await self._table_create_chain.ainvoke({"history": state["chat_history"], "question": state["user_input"]})
         return {"isComplete": True, "answer": answer}
 
     def handle_unknow(self, state: VisualizerState):
@@ -0,0 +1,95 @@
+"""Нагрузочный тест /agent/: пропускная способность и задержка при одновременных запросах.
+
+Запросы отправляются в запущенный сервер пачками по concurrency штук. Чтобы сравнить
+синхронное и асинхронное выполнение графа, тест запускается на сервере до и после изменения
+с одинаковыми параметрами.
+
+По умолчанию вопросы повторяются по кругу, и после первых запросов ответы приходят из кэша ответов
+и кэша поиска. Чтобы замерить выполнение графа, используется --unique: каждый вопрос из --questions-file
+(по одному в строке) отправляется один раз. Кэш ответов находит и близкие по смыслу вопросы,
+поэтому вопросы в файле должны быть разными по смыслу, либо на сервере выключается SEMANTIC_CACHE_ENABLED.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.agent_load_test --url http://localhost:8000 \
+        --user-id 10 --workspace-id 20 --concurrency 1 4 16 --requests 32
+    python -m src.rag_agent_api.benchmarks.agent_load_test --url http://localhost:8000 \
+        --user-id 10 --workspace-id 20 --unique --questions-file questions.txt
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+QUESTIONS = [
+    "привет",
+    "что говорится в документе про порядок оплаты",
+    "какие сроки указаны в договоре",
+    "построй таблицу по этим данным",
+]
+
+
+async def _request(client: httpx.AsyncClient, url: str, params: dict) -> tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        response = await client.get(url, params=params)
+        ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def load_questions(path: str) -> list[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def run(base_url: str, user_id: int, workspace_id: int, concurrency: int, requests: int,
+              timeout: float, questions: list[str] = QUESTIONS) -> dict:
+    """questions повторяются по кругу, если запросов больше, чем вопросов"""
+    url = f"{base_url.rstrip('/')}/agent/"
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i: int, client: httpx.AsyncClient):
+        async with semaphore:
+            params = {"question": questions[i % len(questions)], "user_id": user_id, "workspace_id": workspace_id}
+            return await _request(client, url, params)
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(limited(i, client) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": sum(not ok for _, ok in results),
+        "throughput_rps": round(requests / elapsed, 3),
+        "latency_s_p50": round(statistics.median(latencies), 2),
+        "latency_s_p95": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /agent/")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--workspace-id", type=int, required=True)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--questions-file", help="вопросы, по одному в строке")
+    parser.add_argument("--unique", action="store_true",
+                        help="каждый вопрос отправляется один раз: ответы не берутся из кэшей")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions_file) if args.questions_file else QUESTIONS
+    if args.unique and len(questions) < args.requests * len(args.concurrency):
+        parser.error(f"для --unique нужно не меньше {args.requests * len(args.concurrency)} вопросов "
+                     f"(--requests на каждое значение --concurrency), в файле {len(questions)}")
+    for n, c in enumerate(args.concurrency):
+        run_questions = questions[n * args.requests:(n + 1) * args.requests] if args.unique else questions
+        print(asyncio.run(run(args.url, args.user_id, args.workspace_id, c, args.requests, args.timeout,
+                              run_questions)))
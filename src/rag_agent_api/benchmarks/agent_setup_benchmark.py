@@ -0,0 +1,64 @@
+"""Стоимость подготовки графа агентов на один запрос /agent/.
+
+before - как было до компиляции графов при старте: на каждый запрос создается SuperVisor
+со своим retriever, а внутри него компилируются графы RagAgent, VisualizerAgent, SeracherAgent и их цепочки.
+after - граф создан один раз, на запрос собирается только config с retriever пользователя.
+В обоих случаях замеряется подготовка и один вызов графа: модель заменена на FakeListChatModel,
+супервизор выбирает агента "simple", поэтому разница между before и after - стоимость подготовки.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.agent_setup_benchmark --requests 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from src.rag_agent_api.agents.supervisor_agent import SuperVisor
+from src.rag_agent_api.services.chunk_store_service import ChunkStore
+
+AGENT_INPUT = {"user_input": "вопрос", "user_id": 1, "workspace_id": 1, "belongs_to": None,
+               "chat_history": [], "planner_mode": "sequential"}
+
+
+def _summary(name: str, latencies: list[float]) -> dict:
+    latencies.sort()
+    return {
+        "setup": name,
+        "ms_mean": round(statistics.mean(latencies), 3),
+        "ms_p50": round(statistics.median(latencies), 3),
+        "ms_p95": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+async def run(requests: int) -> list[dict]:
+    model = FakeListChatModel(responses=["simple"])
+    retriever = object()
+
+    before = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        await SuperVisor(model=model, retriever=retriever)().ainvoke(
+            AGENT_INPUT, {"configurable": {"chunk_store": ChunkStore()}})
+        before.append((time.perf_counter() - start) * 1000)
+
+    super_visor = SuperVisor(model=model)
+    after = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        config = {"configurable": {"retriever": retriever, "chunk_store": ChunkStore()}}
+        await super_visor().ainvoke(AGENT_INPUT, config)
+        after.append((time.perf_counter() - start) * 1000)
+
+    return [_summary("before", before), _summary("after", after)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Стоимость подготовки графа агентов на запрос")
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    for row in asyncio.run(run(args.requests)):
+        print(row)
@@ -0,0 +1,90 @@
+"""Пиковая память одного запроса к графу агентов (tracemalloc).
+
+Граф SuperVisor -> RagAgent выполняется с FakeListChatModel, retriever и база заменены заглушками,
+которые возвращают фрагменты заданного размера, как CustomRetriever (краткое содержание)
+и DocumentsGetterService. Выбор агента и категории вопроса зафиксирован.
+Пик считается от начала вызова графа, данные заглушек в него не входят.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.agent_state_memory_benchmark --documents 8 --chunk-chars 4000
+"""
+import argparse
+import asyncio
+import statistics
+import tracemalloc
+
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from src.rag_agent_api.agents import rag_agent as rag_agent_module
+from src.rag_agent_api.agents import supervisor_agent as supervisor_module
+from src.rag_agent_api.agents.supervisor_agent import SuperVisor
+from src.rag_agent_api.services.chunk_store_service import ChunkStore
+
+
+class StubRetriever:
+    def __init__(self, documents: list[Document]):
+        self.documents = documents
+
+    def get_relevant_documents(self, query: str, belongs_to: str | None = None) -> list[Document]:
+        # новые объекты на каждый вызов, как при поиске без кэша
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in self.documents]
+
+
+def _fixtures(documents: int, chunk_chars: int) -> tuple[list[Document], dict[tuple[str, int], str]]:
+    words = chunk_chars // 6
+    source_chunks = {("doc.pdf", n): f"фрагмент {n} " + " ".join(["текст"] * words) for n in range(documents * 3)}
+    retrieved = [Document(page_content="краткое содержание " + " ".join(["слово"] * (words // 4)),
+                          metadata={"belongs_to": "doc.pdf", "doc_number": n, "score": 0.2 + n / 100})
+                 for n in range(1, documents * 3, 3)]
+    return retrieved, source_chunks
+
+
+async def _run_once(super_visor: SuperVisor, retriever: StubRetriever) -> int:
+    config = {"configurable": {"retriever": retriever, "chunk_store": ChunkStore()}}
+    agent_input = {"user_input": "вопрос", "user_id": 1, "workspace_id": 1, "belongs_to": None,
+                   "chat_history": [], "planner_mode": "sequential"}
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    result = await super_visor().ainvoke(agent_input, config)
+    _, peak = tracemalloc.get_traced_memory()
+    del result
+    return peak - baseline
+
+
+def run(documents: int, chunk_chars: int, repeats: int) -> dict:
+    retrieved, source_chunks = _fixtures(documents, chunk_chars)
+
+    def get_source_chunks_by_spans(user_id, workspace_id, spans):
+        return [Document(page_content=source_chunks[(belongs_to, n)],
+                         metadata={"belongs_to": belongs_to, "doc_number": n})
+                for belongs_to, file_spans in spans.items() for first, last in file_spans
+                for n in range(first, last + 1) if (belongs_to, n) in source_chunks]
+
+    rag_agent_module.DocumentsGetterService.get_source_chunks_by_spans = staticmethod(get_source_chunks_by_spans)
+    rag_agent_module.category_classifier.classify = lambda question: "factual"
+    supervisor_module.route_classifier.classify = lambda question: "rag_agent"
+    rag_agent_module.RERANK_MODE = "sequential"
+    super_visor = SuperVisor(model=FakeListChatModel(responses=["5"]))
+    retriever = StubRetriever(retrieved)
+
+    asyncio.run(_run_once(super_visor, retriever))  # прогрев: импорты и токенизатор не входят в замер
+    tracemalloc.start()
+    peaks = [asyncio.run(_run_once(super_visor, retriever)) for _ in range(repeats)]
+    tracemalloc.stop()
+    return {
+        "documents": documents,
+        "chunk_chars": chunk_chars,
+        "peak_kib_median": round(statistics.median(peaks) / 1024, 1),
+        "peak_kib_max": round(max(peaks) / 1024, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пиковая память запроса к графу агентов")
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument("--chunk-chars", type=int, default=4000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(run(args.documents, args.chunk_chars, args.repeats))
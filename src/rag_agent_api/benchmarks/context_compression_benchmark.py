@@ -0,0 +1,89 @@
+"""Токены запроса и задержка генерации ответа RagAgent с полным и сжатым контекстом.
+
+Контекст каждого вопроса из data/rerank_eval_set.json собирается ContextPacker из документов вопроса
+(все документы - фрагменты одного файла), затем ответ генерируется по полному контексту и по контексту
+после ContextCompressor. Токены запроса (input_tokens) берутся из usage_metadata ответа модели,
+время сжатия входит в задержку сжатого варианта. Порог CONTEXT_COMPRESSION_MIN_TOKENS не применяется:
+контексты набора короткие. Качество сжатия - доля предложений релевантных по разметке документов,
+оставшихся в сжатом контексте (relevant_sentences_kept), и доля оставшихся предложений нерелевантных
+документов (irrelevant_sentences_kept).
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.context_compression_benchmark --ratio 0.5 --window 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+from langchain_core.documents import Document
+
+from src.rag_agent_api.agents.rag_agent import RagAgent
+from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
+from src.rag_agent_api.services.context_compressor_service import ContextCompressor
+from src.rag_agent_api.services.context_packer_service import context_packer
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "data", "rerank_eval_set.json")
+
+
+async def _answer(agent: RagAgent, question: str, context: str) -> tuple[int, float]:
+    usage = UsageMetadataCallbackHandler()
+    start = time.perf_counter()
+    await agent._answer_with_context_chain.ainvoke({"history": [], "question": question, "context": context},
+                                                   config={"callbacks": [usage]})
+    latency = time.perf_counter() - start
+    return sum(item.get("input_tokens", 0) for item in usage.usage_metadata.values()), latency
+
+
+def kept_share(documents: list[dict], compressed_text: str) -> float | None:
+    sentences = [sentence for d in documents for sentence in ContextCompressor.split_sentences(d["text"])]
+    if not sentences:
+        return None
+    return sum(sentence in compressed_text for sentence in sentences) / len(sentences)
+
+
+async def evaluate(eval_set: list[dict], compressor: ContextCompressor) -> dict:
+    agent = RagAgent(model_for_answer, retriever=None, models=node_models)
+    full_tokens, compressed_tokens, full_latencies, compressed_latencies = [], [], [], []
+    relevant_kept, irrelevant_kept = [], []
+    for item in eval_set:
+        documents = [Document(page_content=d["text"], metadata={"belongs_to": "eval.pdf", "doc_number": i})
+                     for i, d in enumerate(item["documents"])]
+        packed = context_packer.pack(documents)
+
+        tokens, latency = await _answer(agent, item["question"], packed.text)
+        full_tokens.append(tokens)
+        full_latencies.append(latency)
+
+        start = time.perf_counter()
+        compressed = compressor.compress(item["question"], packed)
+        compression_latency = time.perf_counter() - start
+        relevant_kept.append(kept_share([d for d in item["documents"] if d["relevant"]], compressed.text))
+        irrelevant_kept.append(kept_share([d for d in item["documents"] if not d["relevant"]], compressed.text))
+        tokens, latency = await _answer(agent, item["question"], compressed.text)
+        compressed_tokens.append(tokens)
+        compressed_latencies.append(compression_latency + latency)
+    return {
+        "questions": len(eval_set),
+        "prompt_tokens_full_mean": round(statistics.mean(full_tokens), 1),
+        "prompt_tokens_compressed_mean": round(statistics.mean(compressed_tokens), 1),
+        "prompt_tokens_saved_mean": round(statistics.mean(full_tokens) - statistics.mean(compressed_tokens), 1),
+        "latency_s_full_median": round(statistics.median(full_latencies), 3),
+        "latency_s_compressed_median": round(statistics.median(compressed_latencies), 3),
+        "relevant_sentences_kept": round(statistics.mean(v for v in relevant_kept if v is not None), 3),
+        "irrelevant_sentences_kept": round(statistics.mean(v for v in irrelevant_kept if v is not None), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сжатие контекста: токены запроса и задержка ответа")
+    parser.add_argument("--ratio", type=float, default=0.5)
+    parser.add_argument("--window", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(EVAL_SET_PATH, encoding="utf-8") as f:
+        eval_set = json.load(f)
+    print(asyncio.run(evaluate(eval_set, ContextCompressor(ratio=args.ratio, window=args.window, min_tokens=0))))
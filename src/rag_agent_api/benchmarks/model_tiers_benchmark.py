@@ -0,0 +1,71 @@
+"""Задержка и точность классификационных узлов на разных уровнях моделей.
+
+Вопросы из data/query_classifier/{route,category}_examples.json классифицируются цепочками
+route_task (SuperVisor) и analyze_query_for_category (RagAgent) на модели узла из LLM_NODE_MODELS
+и на модели ответа ("answer"), которой раньше выполнялись все узлы.
+Точность - доля ответов, совпавших с разметкой, на limit случайных примерах.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.model_tiers_benchmark --limit 20
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from src.rag_agent_api.config import LLM_TIERS, LLM_NODE_MODELS
+from src.rag_agent_api.langchain_model_init import create_gigachat
+from src.rag_agent_api.prompts.rag_agent_prompts import analyze_category_prompt
+from src.rag_agent_api.prompts.supervisor_prompts import routing_prompt
+from src.rag_agent_api.services.model_registry_service import ModelRegistry
+from src.rag_agent_api.services.query_classifier_service import route_classifier, category_classifier
+
+# без кэша LLM: замеряются вызовы модели
+model_registry = ModelRegistry(LLM_TIERS, LLM_NODE_MODELS, create_gigachat)
+
+TASKS = {
+    "route_task": (routing_prompt, "Вопрос: {question}", route_classifier),
+    "analyze_query_for_category": (analyze_category_prompt, "Вопрос пользователя: {question}", category_classifier),
+}
+
+
+async def evaluate(node: str, model_node: str, limit: int) -> dict:
+    system_prompt, human_prompt, classifier = TASKS[node]
+    chain = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        MessagesPlaceholder("chat_history", optional=True),
+        ("human", human_prompt)
+    ]) | model_registry.get(model_node) | StrOutputParser()
+    correct, latencies = 0, []
+    examples = classifier.load_examples(with_decisions=False)
+    # примеры в файле сгруппированы по меткам, выборка перемешивается с фиксированным seed
+    for example in random.Random(0).sample(examples, min(limit, len(examples))):
+        start = time.perf_counter()
+        answer = await chain.ainvoke({"chat_history": [], "question": example["text"]})
+        latencies.append(time.perf_counter() - start)
+        correct += answer.strip().lower() == example["label"]
+    latencies.sort()
+    spec = model_registry.spec(model_node)
+    return {
+        "node": node,
+        "tier": spec.tier,
+        "model": spec.model,
+        "accuracy": round(correct / len(latencies), 3),
+        "latency_s_p50": round(statistics.median(latencies), 3),
+        "latency_s_p95": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение уровней моделей на классификационных узлах")
+    parser.add_argument("--nodes", nargs="+", default=list(TASKS))
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    for node in args.nodes:
+        for model_node in (node, "answer"):
+            print(asyncio.run(evaluate(node, model_node, args.limit)))
@@ -0,0 +1,69 @@
+"""Сравнение качества и задержки реранкеров RagAgent на фиксированном наборе data/rerank_eval_set.json.
+
+Для каждого вопроса все документы оцениваются выбранным режимом, документ считается релевантным,
+если его оценка не ниже порога режима. Качество - precision/recall/accuracy по разметке,
+задержка - время оценки всего списка документов одного вопроса.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.rerank_comparison --modes cross_encoder parallel listwise
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from langchain_core.documents import Document
+
+from src.rag_agent_api.agents.rag_agent import RagAgent
+from src.rag_agent_api.config import RERANK_MIN_SCORE
+from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
+from src.rag_agent_api.services.cross_encoder_reranker_service import cross_encoder_reranker
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "data", "rerank_eval_set.json")
+
+
+def evaluate(mode: str, eval_set: list[dict]) -> dict:
+    agent = RagAgent(model_for_answer, retriever=None, models=node_models)
+    rerankers = {
+        "cross_encoder": (agent._rerank_cross_encoder, cross_encoder_reranker.threshold),
+        "parallel": (agent._rerank_parallel, RERANK_MIN_SCORE),
+        "listwise": (agent._rerank_listwise, RERANK_MIN_SCORE),
+        "sequential": (agent._rerank_sequential, RERANK_MIN_SCORE),
+    }
+    rerank, threshold = rerankers[mode]
+    if mode == "cross_encoder":
+        cross_encoder_reranker.model  # загрузка модели не входит в замер
+    tp = fp = fn = tn = 0
+    latencies = []
+    for item in eval_set:
+        documents = [Document(page_content=d["text"]) for d in item["documents"]]
+        start = time.perf_counter()
+        ranks = asyncio.run(rerank(item["question"], documents))
+        latencies.append(time.perf_counter() - start)
+        for i, d in enumerate(item["documents"]):
+            predicted = ranks.get(i, 0) >= threshold
+            tp += predicted and d["relevant"]
+            fp += predicted and not d["relevant"]
+            fn += not predicted and d["relevant"]
+            tn += not predicted and not d["relevant"]
+    return {
+        "mode": mode,
+        "precision": round(tp / (tp + fp), 3) if tp + fp else 0.0,
+        "recall": round(tp / (tp + fn), 3) if tp + fn else 0.0,
+        "accuracy": round((tp + tn) / (tp + fp + fn + tn), 3),
+        "latency_s_mean": round(statistics.mean(latencies), 3),
+        "latency_s_max": round(max(latencies), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение реранкеров на фиксированном наборе")
+    parser.add_argument("--modes", nargs="+", default=["cross_encoder", "parallel", "listwise"])
+    args = parser.parse_args()
+
+    with open(EVAL_SET_PATH, encoding="utf-8") as f:
+        eval_set = json.load(f)
+    for mode in args.modes:
+        print(evaluate(mode, eval_set))
@@ -0,0 +1,69 @@
+"""Подбор RETRIEVAL_MAX_DISTANCE по набору data/rerank_eval_set.json.
+
+Для каждой пары вопрос-документ считается косинусное расстояние (1 - cos) между векторами модели эмбеддингов,
+в тех же единицах, что score фрагментов CustomRetriever. Для порогов из сетки выводятся доля релевантных
+документов, прошедших порог (recall), доля прошедших нерелевантных и доля вопросов, для которых не прошел
+ни один документ (RagAgent ответил бы, что ничего не найдено). Рекомендуемый порог - наименьший,
+при котором recall не ниже --min-recall.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.retrieval_threshold_calibration --min-recall 0.95
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.retriever_service import _distances
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "data", "rerank_eval_set.json")
+THRESHOLDS = np.round(np.arange(0.05, 1.55, 0.05), 2)
+
+
+def question_distances(eval_set: list[dict]) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Косинусные расстояния до документов вопроса и разметка релевантности"""
+    result = []
+    for item in eval_set:
+        question = np.asarray(embeddings.embed_query(item["question"]), dtype=np.float32)
+        documents = np.asarray(embeddings.embed_documents([d["text"] for d in item["documents"]]), dtype=np.float32)
+        relevant = np.asarray([d["relevant"] for d in item["documents"]], dtype=bool)
+        result.append((_distances(question, documents, "cosine"), relevant))
+    return result
+
+
+def sweep(distances: list[tuple[np.ndarray, np.ndarray]]) -> list[dict]:
+    all_distances = np.concatenate([d for d, _ in distances])
+    all_relevant = np.concatenate([r for _, r in distances])
+    rows = []
+    for threshold in THRESHOLDS:
+        passed = all_distances <= threshold
+        rows.append({
+            "threshold": float(threshold),
+            "recall": round(float(passed[all_relevant].mean()), 3),
+            "irrelevant_passed": round(float(passed[~all_relevant].mean()), 3),
+            "questions_not_found": sum(1 for d, _ in distances if not (d <= threshold).any()),
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Подбор порога косинусного расстояния для найденных фрагментов")
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    args = parser.parse_args()
+
+    with open(EVAL_SET_PATH, encoding="utf-8") as f:
+        eval_set = json.load(f)
+    distances = question_distances(eval_set)
+    relevant = np.concatenate([d[r] for d, r in distances])
+    irrelevant = np.concatenate([d[~r] for d, r in distances])
+    print({"relevant_distance_median": round(float(np.median(relevant)), 3),
+           "relevant_distance_max": round(float(relevant.max()), 3),
+           "irrelevant_distance_median": round(float(np.median(irrelevant)), 3),
+           "irrelevant_distance_min": round(float(irrelevant.min()), 3)})
+    rows = sweep(distances)
+    for row in rows:
+        print(row)
+    suitable = [row for row in rows if row["recall"] >= args.min_recall]
+    print({"recommended_threshold": suitable[0]["threshold"] if suitable else None})
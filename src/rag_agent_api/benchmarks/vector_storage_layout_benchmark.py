@@ -0,0 +1,103 @@
+"""Сравнение раскладок векторного хранилища: per_user (каталог на пользователя) и shared (одно хранилище).
+
+Для каждого числа пользователей создаются синтетические хранилища во временном каталоге,
+затем для выборки пользователей измеряется холодное открытие (клиент + коллекция + один запрос)
+и число открытых файловых дескрипторов процесса после обращения ко всей выборке.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.vector_storage_layout_benchmark --users 1000 10000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import chromadb
+from chromadb.api.client import SharedSystemClient
+
+DIMENSION = 768
+VECTORS_PER_COLLECTION = 10
+
+
+def _open_fds() -> int | None:
+    fd_dir = "/proc/self/fd"
+    if os.path.isdir(fd_dir):
+        return len(os.listdir(fd_dir))
+    return None
+
+
+def _random_vectors(n: int) -> list[list[float]]:
+    return [[random.random() for _ in range(DIMENSION)] for _ in range(n)]
+
+
+def _fill_collection(client, user_id: int) -> None:
+    collection = client.get_or_create_collection(f"user_{user_id}_1")
+    collection.add(
+        ids=[f"file.pdf::{i}" for i in range(VECTORS_PER_COLLECTION)],
+        embeddings=_random_vectors(VECTORS_PER_COLLECTION),
+        metadatas=[{"belongs_to": "file.pdf", "doc_number": i} for i in range(VECTORS_PER_COLLECTION)],
+    )
+
+
+def populate(root: str, users: int, layout: str) -> None:
+    if layout == "shared":
+        client = chromadb.PersistentClient(path=os.path.join(root, "chroma_db_shared"))
+        for user_id in range(users):
+            _fill_collection(client, user_id)
+    else:
+        for user_id in range(users):
+            _fill_collection(chromadb.PersistentClient(path=os.path.join(root, f"chroma_db_{user_id}")), user_id)
+    SharedSystemClient.clear_system_cache()
+
+
+def measure(root: str, sample: list[int], layout: str) -> dict:
+    SharedSystemClient.clear_system_cache()
+    fds_before = _open_fds()
+    latencies = []
+    query = _random_vectors(1)
+    for user_id in sample:
+        start = time.perf_counter()
+        path = os.path.join(root, "chroma_db_shared" if layout == "shared" else f"chroma_db_{user_id}")
+        client = chromadb.PersistentClient(path=path)
+        client.get_collection(f"user_{user_id}_1").query(query_embeddings=query, n_results=4)
+        latencies.append((time.perf_counter() - start) * 1000)
+    fds_after = _open_fds()
+    latencies.sort()
+    return {
+        "layout": layout,
+        "open_ms_p50": round(statistics.median(latencies), 2),
+        "open_ms_p95": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "open_fds_added": None if fds_before is None else fds_after - fds_before,
+    }
+
+
+def run(users: int, sample_size: int) -> list[dict]:
+    results = []
+    sample = random.sample(range(users), min(sample_size, users))
+    for layout in ("per_user", "shared"):
+        root = tempfile.mkdtemp(prefix=f"vec_bench_{layout}_")
+        try:
+            start = time.perf_counter()
+            populate(root, users, layout)
+            result = measure(root, sample, layout)
+            result["users"] = users
+            result["populate_s"] = round(time.perf_counter() - start, 1)
+            results.append(result)
+        finally:
+            SharedSystemClient.clear_system_cache()
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк раскладок векторного хранилища")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--sample", type=int, default=500, help="сколько пользователей открывать при замере")
+    args = parser.parse_args()
+
+    for n in args.users:
+        for row in run(n, args.sample):
+            print(row)
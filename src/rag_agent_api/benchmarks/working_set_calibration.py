@@ -0,0 +1,70 @@
+"""Подбор порогов рабочего набора беседы (WORKING_SET_MIN_SIMILARITY, WORKING_SET_MIN_COVERED_RATIO).
+
+Рабочий набор - документы вопроса из data/rerank_eval_set.json. Для каждого набора в
+data/working_set_eval_set.json есть уточняющий вопрос, ответ на который есть в наборе, и новый вопрос,
+ответа на который в наборе нет (оба в самостоятельной форме, как после define_user_question).
+Для каждой пары порогов выводятся доля уточняющих вопросов, обслуженных набором (hit_rate),
+и доля новых вопросов, ошибочно обслуженных набором (false_hit_rate).
+Рекомендуемая пара - с наибольшим hit_rate при false_hit_rate не выше --max-false-hit-rate.
+
+Запуск:
+    python -m src.rag_agent_api.benchmarks.working_set_calibration --max-false-hit-rate 0
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.working_set_service import ConversationWorkingSets
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+SIMILARITIES = np.round(np.arange(0.3, 0.95, 0.05), 2)
+COVERED_RATIOS = (0.25, 0.34, 0.5, 0.67, 1.0)
+
+
+def similarities(rerank_eval_set: list[dict], pairs: list[dict]) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Косинусные близости уточняющего и нового вопроса к фрагментам рабочего набора"""
+    result = []
+    for pair in pairs:
+        documents = [d["text"] for d in rerank_eval_set[pair["question_index"]]["documents"]]
+        vectors = ConversationWorkingSets._normalize(embeddings.embed_documents(documents))
+        follow_up, new_question = ConversationWorkingSets._normalize(
+            embeddings.embed_documents([pair["follow_up"], pair["new_question"]]))
+        result.append((vectors @ follow_up, vectors @ new_question))
+    return result
+
+
+def sweep(pair_similarities: list[tuple[np.ndarray, np.ndarray]]) -> list[dict]:
+    rows = []
+    for min_similarity in SIMILARITIES:
+        for min_covered_ratio in COVERED_RATIOS:
+            working_sets = ConversationWorkingSets(min_similarity=float(min_similarity),
+                                                   min_covered_ratio=min_covered_ratio)
+            hits = [working_sets.covered(follow_up) is not None for follow_up, _ in pair_similarities]
+            false_hits = [working_sets.covered(new) is not None for _, new in pair_similarities]
+            rows.append({
+                "min_similarity": float(min_similarity),
+                "min_covered_ratio": min_covered_ratio,
+                "hit_rate": round(float(np.mean(hits)), 3),
+                "false_hit_rate": round(float(np.mean(false_hits)), 3),
+            })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Подбор порогов рабочего набора беседы")
+    parser.add_argument("--max-false-hit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with open(os.path.join(DATA_DIR, "rerank_eval_set.json"), encoding="utf-8") as f:
+        rerank_eval_set = json.load(f)
+    with open(os.path.join(DATA_DIR, "working_set_eval_set.json"), encoding="utf-8") as f:
+        pairs = json.load(f)
+    rows = sweep(similarities(rerank_eval_set, pairs))
+    for row in rows:
+        print(row)
+    suitable = [row for row in rows if row["false_hit_rate"] <= args.max_false_hit_rate]
+    best = max(suitable, key=lambda row: (row["hit_rate"], row["min_similarity"])) if suitable else None
+    print({"recommended": best})
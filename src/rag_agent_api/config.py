@@ -22,3 +22,162 @@ some_questions_for_examples = [
 TEMP_DOWNLOADS = r'C:\Users\vrylk\OneDrive\Документы\Assistant\temp_downloads'
 USERS_DIRECTORY = r'C:\Users\vrylk\OneDrive\Документы\Assistant\users_directory'
 VEC_BASES = r'C:\Users\vrylk\OneDrive\Документы\Assistant\vec_bases'
+
+RETRIEVAL_CACHE_MAX_SIZE = 1024
+
+GC_BATCH_SIZE = 500
+# коллекция пересобирается, когда удаленные элементы составляют эту долю HNSW индекса
+GC_COMPACT_DELETED_RATIO = 0.2
+# загрузка, копирование и удаление файлов пространства и сборка мусора в нем выполняются под межпроцессной
+# блокировкой пространства. Сборщик мусора пропускает пространство, если не дождался блокировки
+WORKSPACE_LOCKS_DIR = "var/workspace_locks"
+GC_LOCK_TIMEOUT_SECONDS = 10
+
+# "per_user" - отдельный каталог chroma_db_{user_id} на каждого пользователя,
+# "shared" - все коллекции user_{user_id}_{workspace_id} в одном хранилище SHARED_VEC_BASE_NAME
+VEC_STORAGE_LAYOUT = "per_user"
+SHARED_VEC_BASE_NAME = "chroma_db_shared"
+
+HISTORY_CACHE_MAX_SIZE = 2048
+HISTORY_CACHE_TTL_SECONDS = 600
+FILES_CACHE_MAX_SIZE = 2048
+
+WARMUP_MAX_CONCURRENCY = 2
+WARMUP_MAX_PENDING = 32
+WARMUP_COOLDOWN_SECONDS = 300
+WARMUP_MAX_WORKSPACES_PER_USER = 3
+
+# "sequential" - по одному вызову LLM на документ подряд,
+# "parallel" - по одному вызову на документ, не больше RERANK_MAX_CONCURRENCY одновременно,
+# "listwise" - один вызов LLM, который оценивает весь список документов,
+# "cross_encoder" - локальный cross-encoder CROSS_ENCODER_MODEL_NAME без обращений к LLM
+RERANK_MODE = "parallel"
+RERANK_MAX_CONCURRENCY = 6
+RERANK_TIMEOUT_SECONDS = 15
+RERANK_MIN_SCORE = 3
+
+# сколько соседних фрагментов с каждой стороны найденного добавляется в контекст
+NEIGHBOUR_RADIUS = 1
+
+# найденные фрагменты с косинусным расстоянием (1 - cos, от 0 до 2) больше порога не используются.
+# Score фрагмента пересчитывается в косинусное расстояние независимо от hnsw:space коллекции (по умолчанию
+# в Chroma это квадрат L2). Порог подбирается по набору rerank_eval_set:
+# python -m src.rag_agent_api.benchmarks.retrieval_threshold_calibration. Если порог не прошел ни один фрагмент,
+# RagAgent не ищет соседей и не оценивает документы, а отвечает, что в документах ничего не найдено.
+# RETRIEVAL_EMPTY_FALLBACK: "not_found" - этот ответ возвращается пользователю,
+# "simple" или "web_searcher" - супервизор передает вопрос соответствующему агенту
+RETRIEVAL_MAX_DISTANCE = 0.8
+RETRIEVAL_EMPTY_FALLBACK = "not_found"
+
+# бюджет токенов контекста для ответа и токенизатор для их подсчета
+CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_TOKENIZER_NAME = embeddings_model_name
+# перекрытие соседних фрагментов короче этого числа символов не вырезается
+CONTEXT_MIN_OVERLAP_CHARS = 20
+
+LOCAL_MODELS_DEVICE = "cpu"
+LOCAL_MODELS_BATCH_SIZE = 32
+
+# используется при RERANK_MODE = "cross_encoder"
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+CROSS_ENCODER_THRESHOLD = 0.5
+
+# "sequential" - три последовательных вызова LLM (уточнение вопроса, категория, дополнительные вопросы),
+# "fast" - один вызов LLM со структурированным ответом
+QUERY_PLANNER_MODE = "sequential"
+# режим планировщика для отдельных пространств: {workspace_id: "fast"}
+QUERY_PLANNER_MODE_BY_WORKSPACE: dict[int, str] = {}
+
+# локальный классификатор маршрута и категории запроса (services/query_classifier_service.py),
+# при уверенности ниже порога решение принимает LLM.
+# Центроиды не поставляются с кодом: обучаются командой train в QUERY_CLASSIFIER_MODEL_DIR (каталог в .gitignore),
+# включать после обучения и проверки точности командой evaluate. Без центроидов решает LLM
+QUERY_CLASSIFIER_ENABLED = False
+QUERY_CLASSIFIER_MODEL_DIR = "var/query_classifier"
+QUERY_CLASSIFIER_MIN_CONFIDENCE = 0.7
+QUERY_CLASSIFIER_TEMPERATURE = 0.05
+# журнал решений LLM для разметки: содержит вопросы пользователей, поэтому выключен по умолчанию
+# и пишется вне исходного кода (каталог в .gitignore). При размере файла задачи больше
+# QUERY_CLASSIFIER_DECISIONS_MAX_BYTES новые решения не записываются.
+# В обучение журнал попадает только явно (train --with-decisions) после проверки разметки
+QUERY_CLASSIFIER_LOG_DECISIONS = False
+QUERY_CLASSIFIER_DECISIONS_DIR = "var/query_classifier"
+QUERY_CLASSIFIER_DECISIONS_MAX_BYTES = 5 * 1024 * 1024
+
+# кэш ответов по смыслу вопроса в пределах версии пространства
+SEMANTIC_CACHE_ENABLED = True
+SEMANTIC_CACHE_MIN_SIMILARITY = 0.95
+SEMANTIC_CACHE_TTL_SECONDS = 3600
+SEMANTIC_CACHE_MAX_SIZE_PER_WORKSPACE = 256
+SEMANTIC_CACHE_MAX_WORKSPACES = 1024
+
+# поиск документов по исходному вопросу одновременно с выбором агента супервизором, только для первого
+# вопроса беседы: уточняющий вопрос без истории ищет не то. При выборе RagAgent найденные документы
+# используются сразу, уточнение вопроса, категория и дополнительные вопросы пропускаются (3 вызова LLM,
+# 1 - в режиме "fast"), поэтому поиск идет только по исходному вопросу, без дополнительных вопросов
+SPECULATIVE_RETRIEVAL_ENABLED = False
+
+# уровни моделей LLM: быстрая модель с детерминированным ответом для классификации и оценок,
+# большая - для ответов пользователю. GigaChat при temperature от 0 до 0.001 отвечает детерминированно
+LLM_TIERS: dict[str, dict] = {
+    "fast": {"model": "GigaChat-2", "temperature": 0.001},
+    "answer": {"model": "GigaChat-2-Pro", "temperature": 0.8},
+    "summary": {"model": "GigaChat-2", "temperature": 0.8},
+}
+# модель каждого узла агентов: уровень из LLM_TIERS и ограничение длины ответа (None - без ограничения),
+# model и temperature уровня можно переопределить для отдельного узла.
+# cache - ответы узла детерминированы и кэшируются по точному совпадению запроса (LLM_CACHE_*).
+# Узлы, в запрос которых входит история диалога, не кэшируются: кэш хранится на диске и не очищается
+# вместе с историей пользователя.
+# Промпты узлов с коротким max_tokens просят только ответ, без рассуждений, иначе ответ обрезается
+LLM_NODE_MODELS: dict[str, dict] = {
+    "route_task": {"tier": "fast", "max_tokens": 10, "cache": False},
+    "analyze_query_for_category": {"tier": "fast", "max_tokens": 10, "cache": True},
+    "visualizer_choose_tool": {"tier": "fast", "max_tokens": 10, "cache": False},
+    "rerank": {"tier": "fast", "max_tokens": 5, "cache": True},
+    "rerank_listwise": {"tier": "fast", "max_tokens": 200, "cache": True},
+    "define_user_question": {"tier": "fast", "max_tokens": 200, "cache": False},
+    "query_strategy": {"tier": "fast", "max_tokens": 400, "cache": True},
+    "fast_query_planner": {"tier": "fast", "max_tokens": 1000, "cache": False},
+    "answer": {"tier": "answer", "max_tokens": None},
+    "summarization": {"tier": "summary", "max_tokens": None},
+}
+
+# точный кэш ответов LLM для узлов с cache=True в LLM_NODE_MODELS
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = r'C:\Users\vrylk\OneDrive\Документы\Assistant\llm_cache.sqlite'
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 100_000
+
+# рабочий набор беседы: фрагменты последнего ответа RagAgent переиспользуются для уточняющего вопроса
+# без поиска, соседей и оценки документов, если уточненный вопрос близок (косинусная близость эмбеддингов
+# не ниже WORKING_SET_MIN_SIMILARITY) к доле фрагментов набора не меньше WORKING_SET_MIN_COVERED_RATIO.
+# Пороги подбираются на парах уточняющий/новый вопрос:
+# python -m src.rag_agent_api.benchmarks.working_set_calibration
+WORKING_SET_ENABLED = True
+WORKING_SET_TTL_SECONDS = 900
+WORKING_SET_MAX_CONVERSATIONS = 4096
+WORKING_SET_MIN_SIMILARITY = 0.6
+WORKING_SET_MIN_COVERED_RATIO = 0.5
+
+# сжатие контекста перед ответом: из собранного контекста остаются самые близкие к вопросу предложения
+# (косинусная близость эмбеддингов) и CONTEXT_COMPRESSION_WINDOW предложений вокруг каждого,
+# пока их длина не превысит CONTEXT_COMPRESSION_RATIO исходной. Контекст короче
+# CONTEXT_COMPRESSION_MIN_TOKENS не сжимается. Выключено, пока доля сохраненных релевантных предложений
+# и экономия токенов не проверены: python -m src.rag_agent_api.benchmarks.context_compression_benchmark
+CONTEXT_COMPRESSION_ENABLED = False
+CONTEXT_COMPRESSION_RATIO = 0.5
+CONTEXT_COMPRESSION_WINDOW = 1
+CONTEXT_COMPRESSION_MIN_TOKENS = 600
+
+# PlanAndExecuteAgent: шаги плана без зависимостей друг от друга выполняются одновременно,
+# не более PLAN_MAX_CONCURRENT_STEPS шагов сразу
+PLAN_MAX_CONCURRENT_STEPS = 3
+# бюджет одной задачи PlanAndExecuteAgent: вызовы LLM (включая вызовы агентов-инструментов), время и токены.
+# При исчерпании бюджета или после PLAN_MAX_REPLANS перепланирований возвращается лучший частичный ответ
+PLAN_MAX_LLM_CALLS = 20
+PLAN_MAX_SECONDS = 120
+PLAN_MAX_TOKENS = 30_000
+PLAN_MAX_REPLANS = 2
+# результат шага в запросах следующих шагов и итогового ответа обрезается до этого числа символов
+PLAN_STEP_RESULT_MAX_CHARS = 2000
@@ -1,24 +1,33 @@
 import os
+from functools import lru_cache
 from typing import List
 
 from langchain_huggingface import HuggingFaceEmbeddings
 from sentence_transformers import SentenceTransformer
 
-from src.rag_agent_api.config import embeddings_model_name, HF_TOKEN
+from src.rag_agent_api.config import embeddings_model_name, HF_TOKEN, LOCAL_MODELS_DEVICE, LOCAL_MODELS_BATCH_SIZE
 
 os.environ['HF_TOKEN'] = HF_TOKEN
 
 embeddings = HuggingFaceEmbeddings(
-    model_name=embeddings_model_name
+    model_name=embeddings_model_name,
+    model_kwargs={"device": LOCAL_MODELS_DEVICE},
+    encode_kwargs={"batch_size": LOCAL_MODELS_BATCH_SIZE}
 )
 
 
+@lru_cache(maxsize=None)
+def load_local_model(model_cls: type, model_name: str):
+    """Загружает локальную модель sentence_transformers (SentenceTransformer, CrossEncoder) один раз на процесс"""
+    return model_cls(model_name, device=LOCAL_MODELS_DEVICE)
+
+
 class ChromaCompatibleEmbeddingFunction:
     def __init__(self, model_name: str):
-        self.model = SentenceTransformer(model_name)
+        self.model = load_local_model(SentenceTransformer, model_name)
 
     def __call__(self, input: List[str]) -> List[List[float]]:
-        return self.model.encode(input, convert_to_numpy=True).tolist()
+        return self.model.encode(input, batch_size=LOCAL_MODELS_BATCH_SIZE, convert_to_numpy=True).tolist()
 
 
 embedding_function = ChromaCompatibleEmbeddingFunction(model_name=embeddings_model_name)
@@ -1,16 +1,32 @@
-from src.rag_agent_api.config import GIGACHAT_API_PERS
+from src.rag_agent_api.config import GIGACHAT_API_PERS, LLM_TIERS, LLM_NODE_MODELS, LLM_CACHE_ENABLED
 import os
+from langchain_core.caches import BaseCache
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_gigachat.chat_models import GigaChat
 
+from src.rag_agent_api.services.llm_cache_service import LLMResponseStore, NodeLLMCache
+from src.rag_agent_api.services.model_registry_service import ModelRegistry, ModelSpec
+
 os.environ[
     "GIGACHAT_API_PERS"] = GIGACHAT_API_PERS
 
-model_for_answer = GigaChat(verify_ssl_certs=False,
-                            credentials=GIGACHAT_API_PERS,
-                            temperature=0.8,
-                            model="GigaChat-2")
 
-model_for_brief_content = GigaChat(verify_ssl_certs=False,
-                                   credentials=GIGACHAT_API_PERS,
-                                   temperature=0.8,
-                                   model="GigaChat-2")
+def create_gigachat(spec: ModelSpec, callbacks: list[BaseCallbackHandler], cache: BaseCache | None) -> GigaChat:
+    return GigaChat(verify_ssl_certs=False,
+                    credentials=GIGACHAT_API_PERS,
+                    temperature=spec.temperature,
+                    max_tokens=spec.max_tokens,
+                    model=spec.model,
+                    callbacks=callbacks,
+                    cache=cache)
+
+
+llm_response_store = LLMResponseStore() if LLM_CACHE_ENABLED else None
+model_registry = ModelRegistry(LLM_TIERS, LLM_NODE_MODELS, create_gigachat,
+                               (lambda node: NodeLLMCache(node, llm_response_store)) if LLM_CACHE_ENABLED else None)
+# модели узлов агентов, см. LLM_NODE_MODELS
+node_models = model_registry.models()
+
+model_for_answer = model_registry.get("answer")
+
+model_for_brief_content = model_registry.get("summarization")
@@ -47,6 +47,17 @@ rerank_chain_prompt = """
         Верни только цифру. НЕ используй ничего другого, кроме цифр от 1 до 5.
         """
 
+rerank_listwise_prompt = """
+        Ты - реранкер в RAG системе. У тебя есть запрос пользователя и пронумерованный список найденных документов:
+        {documents}
+        
+        Оцени, насколько каждый документ релевантен запросу по шкале от 1 до 5 (5  - полностью релевантен).
+        Верни оценки по одной на строке в формате "номер документа: оценка", например:
+        1: 5
+        2: 1
+        Оцени все документы из списка. НЕ используй ничего другого, кроме номеров документов и оценок от 1 до 5.
+        """
+
 check_possibilyty_response_prompt = """
         Ты - умный помощник, который должен определить, можно ли ответить на вопрос пользователя по найденному контексту.\n
         Проанализируй весь полученный контекст, выясни, есть ли в контексте ключевые слова из вопроса, подходит ли контекст к вопросу по семантике и смыслу.\n
@@ -151,5 +162,25 @@ define_user_question_prompt = """
     **Запрос пользователя**:
     {question}
     
-    Верни только подготовленный для поиска в векторном хранилище запрос без лишним слов и комментариев. Размышляй шаг за шагом.
+    Верни только подготовленный для поиска в векторном хранилище запрос без лишним слов и комментариев.
+"""
+
+fast_query_planner_prompt = """
+    Ты  - умный ассистент, который готовит запрос пользователя для поиска в векторном хранилище.
+    
+    **Твоя задача** за один шаг:
+    1. определить итоговый запрос пользователя на основании истории диалога и последнего сообщения (question).
+       Если история не нужна для понимания запроса, верни запрос без изменений.
+    2. отнести запрос к одной из категорий (category):
+       factual - если в вопросе спрашивают про какие либо факты, либо если они должны содержаться в ответе,
+       analytical - если для ответа на вопрос нужно провести цепочку рассуждений,
+       opinion - если в вопросе спрашивают мнение или просят порассуждать.
+    3. составить 2-4 дополнительных вопроса для лучшего поиска информации (sub_questions):
+       для factual - уточняющие фактологические вопросы,
+       для analytical - вопросы про шаги рассуждения,
+       для opinion - вопросы про различные точки зрения.
+    
+    Не используй вступительные слова и комментарии.
 """
+
+nothing_found_answer = "В загруженных документах не найдено информации по этому вопросу."
@@ -35,7 +35,7 @@ routing_prompt = """
         Входные данные: Используй интернет
         Выходные данные: web_searcher
         
-        Верни только одно слово  - название агента из списка. Размышля шаг за шагом. Не используй других слов или пояснений в ответе.  
+        Верни только одно слово  - название агента из списка. Не используй других слов или пояснений в ответе.  
         """
 
 simple_task_prompt = """
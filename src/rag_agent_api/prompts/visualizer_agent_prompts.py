@@ -12,7 +12,7 @@ choose_tool_prompt = """
                 **Твоя задача**:
                 Вернуть одно слово - название инструмента или unknow, если ни один инструмент не подходит
                 
-                Верни только одно слово из table, unknow. Размышляй шаг за шагом. Не пиши дополнительных слов или пояснений.                      
+                Верни только одно слово из table, unknow. Не пиши дополнительных слов или пояснений.                      
                 """
 
 table_create_prompt = """
@@ -0,0 +1,32 @@
+import asyncio
+from typing import Any
+
+from fastapi import APIRouter
+
+from src.rag_agent_api.services.llm_cache_service import llm_cache_hit_rates
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.vector_gc_service import VectorGarbageCollector
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+)
+
+
+@router.get("/metrics")
+async def get_metrics() -> dict[str, Any]:
+    snapshot = metrics.snapshot()
+    speculative_started = metrics.get_counter("speculative_retrieval_started")
+    snapshot["ratios"] = {
+        "speculative_retrieval_waste": (metrics.get_counter("speculative_retrieval_discarded") / speculative_started
+                                        if speculative_started else 0.0),
+        "llm_cache_hit_rate": llm_cache_hit_rates()
+    }
+    return snapshot
+
+
+@router.post("/vector_gc")
+async def vector_gc(dry_run: bool = False) -> dict[str, Any]:
+    """Удаляет осиротевшие фрагменты, векторы и коллекции, возвращает отчет с освобожденными байтами"""
+    report = await asyncio.to_thread(VectorGarbageCollector(dry_run=dry_run).run)
+    return report._asdict()
@@ -1,3 +1,4 @@
+import asyncio
 from typing import NamedTuple, Any
 
 from fastapi import APIRouter, UploadFile, File, Form
@@ -6,11 +7,12 @@ from src.rag_agent_api.config import TEMP_DOWNLOADS
 from src.rag_agent_api.langchain_model_init import model_for_brief_content
 from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
 from src.rag_agent_api.services.database.documents_remove_service import DocumentsRemoveService
-from src.rag_agent_api.services.database.documents_saver_service import DocumentsSaverService
 from src.rag_agent_api.services.llm_model_service import LLMModelService
 from src.rag_agent_api.services.pdf_reader_service import PDFReader
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
 from src.rag_agent_api.services.retriever_service import VectorDBManager
 from src.rag_agent_api.services.vectore_store_service import VecStoreService
+from src.rag_agent_api.services.workspace_lock_service import workspace_lock
 
 router = APIRouter(
     prefix="/files",
@@ -49,11 +51,11 @@ async def _get_doc_content(file_path: str) -> str | None:
 async def _save_doc_content(content: str, user_id: int,
                             file_name: str, work_space_id: int) -> tuple[str, str] | Exception:
     """Сохраняет извлеченную информацию"""
-    retriever = VectorDBManager.get_or_create_retriever(user_id, work_space_id)
+    retriever = await asyncio.to_thread(VectorDBManager.get_or_create_retriever, user_id, work_space_id)
     vecstore_store_service = VecStoreService(llm_model_service, retriever, content, file_name, user_id, work_space_id)
 
     try:
-        doc_id, summarize_content = vecstore_store_service.save_docs_and_add_in_retriever()
+        doc_id, summarize_content = await asyncio.to_thread(vecstore_store_service.save_docs_and_add_in_retriever)
         return doc_id, summarize_content
     except Exception as e:
         return e
@@ -69,7 +71,7 @@ async def load_file(
     if content:
         try:
             doc_id, summarize_content = await _save_doc_content(content, user_id, file.filename, workspace_id)
-            DocumentsSaverService.save_file(user_id, workspace_id, file.filename, summarize_content)
+            await asyncio.to_thread(WorkspaceVersions.bump, user_id, workspace_id)
             return {"status": 200, "doc_id": doc_id, "summary": summarize_content}
         except Exception as e:
             return {"status": 400, "error": str(e)}
@@ -84,16 +86,29 @@ async def my_files(user_id: int, workspace_id: int) -> list[DocWithIdAndSummary]
     return docs
 
 
+def _delete_all_files_locked(user_id: int, workspace_id: int) -> None:
+    with workspace_lock(user_id, workspace_id):
+        VecStoreService.clear_vector_stores(user_id, workspace_id)
+        DocumentsRemoveService.delete_all_files_in_workspace(user_id, workspace_id)
+        DocumentsRemoveService.delete_all_chunks_in_workspace(user_id, workspace_id)
+
+
+def _delete_file_locked(user_id: int, workspace_id: int, file_id: int, file_name: str) -> None:
+    with workspace_lock(user_id, workspace_id):
+        VecStoreService.delete_file_from_vecstore(user_id, workspace_id, file_name)
+        DocumentsRemoveService.delete_chunks_by_file(user_id, workspace_id, file_name)
+        DocumentsRemoveService.delete_file_by_id(user_id, workspace_id, file_id)
+
+
 @router.get("/delete_all_files")
 async def delete_all_files(user_id: int, workspace_id: int) -> str:
-    VecStoreService.clear_vector_stores(user_id, workspace_id)
-    DocumentsRemoveService.delete_all_files_in_workspace(user_id, workspace_id)
-    DocumentsRemoveService.delete_all_chunks_in_workspace(user_id, workspace_id)
+    await asyncio.to_thread(_delete_all_files_locked, user_id, workspace_id)
+    await asyncio.to_thread(WorkspaceVersions.bump, user_id, workspace_id)
     return "Загруженные документы удалены"
 
 
 @router.get("/delete_file")
 async def delete_file(user_id: int, workspace_id: int, file_id: int, file_name: str) -> dict[str, Any]:
-    DocumentsRemoveService.delete_file_by_id(user_id, workspace_id, file_id)
-    VecStoreService.delete_file_from_vecstore(user_id, workspace_id, file_name)
+    await asyncio.to_thread(_delete_file_locked, user_id, workspace_id, file_id, file_name)
+    await asyncio.to_thread(WorkspaceVersions.bump, user_id, workspace_id)
     return {"status": 200}
@@ -1,21 +1,33 @@
+import asyncio
+import json
 from pprint import pprint
-from typing import NamedTuple, List, Any
+from typing import NamedTuple, List, Any, AsyncIterator
 
 # FastApi
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 
 from src.rag_agent_api.agents.supervisor_agent import SuperVisor
+from src.rag_agent_api.config import QUERY_PLANNER_MODE, QUERY_PLANNER_MODE_BY_WORKSPACE, SEMANTIC_CACHE_ENABLED
+from src.rag_agent_api.embeddings_init import embeddings
 # AGENTS
-from src.rag_agent_api.langchain_model_init import model_for_answer
+from src.rag_agent_api.langchain_model_init import model_for_answer, node_models
+from src.rag_agent_api.services.answer_cache_service import answer_cache
+from src.rag_agent_api.services.chunk_store_service import ChunkStore
 from src.rag_agent_api.services.database.messages_service import MessagesService, Message
 # SERVICES
 from src.rag_agent_api.services.retriever_service import VectorDBManager
+from src.rag_agent_api.services.tracing_service import TracingCallbackHandler
+from src.rag_agent_api.services.working_set_service import working_sets
 
 router = APIRouter(
     prefix="/agent",
     tags=["agent"],
 )
 
+# граф компилируется один раз при старте, retriever пользователя передается в config каждого вызова
+super_visor = SuperVisor(model=model_for_answer, models=node_models)
+
 
 class AgentAnswer(NamedTuple):
     answer_id: int | None
@@ -24,15 +36,18 @@ class AgentAnswer(NamedTuple):
     use_visualizer: bool
     used_docs_names: List[str]
     used_docs: List[str]
+    from_cache: bool = False
+    trace: list[dict] | None = None
 
 
-async def format_agent_answer(answer) -> AgentAnswer:
+async def format_agent_answer(answer, chunk_store: ChunkStore | None = None) -> AgentAnswer:
+    """Тексты использованных фрагментов берутся из ChunkStore запроса по ссылкам из состояния графа"""
     used_docs_names, used_docs = [], []
     use_web_search, use_visualizer = False, False
     question, generation = answer["user_input"], answer["answer"]
     if answer.get("used_docs_names", None):
         used_docs_names = answer["used_docs_names"]
-        used_docs = answer["neighboring_docs"]
+        used_docs = [chunk_store.text(chunk) for chunk in answer["neighboring_chunks"]]
     else:
         if answer.get("use_web_search", None):
             use_web_search = True
@@ -42,31 +57,97 @@ async def format_agent_answer(answer) -> AgentAnswer:
     return AgentAnswer(None, generation, use_web_search, use_visualizer, used_docs_names, used_docs)
 
 
-async def _invoke_agent(question: str, user_id: int, workspace_id: int, belongs_to: str,
-                        chat_history: list[Message]) -> AgentAnswer:
-    retriever = VectorDBManager.get_or_create_retriever(user_id, workspace_id)
-    super_visor = SuperVisor(model=model_for_answer, retriever=retriever)
+def _planner_mode(workspace_id: int, requested_mode: str | None) -> str:
+    """Режим планировщика запроса: из запроса, иначе из настроек пространства, иначе общий"""
+    if requested_mode in ("sequential", "fast"):
+        return requested_mode
+    return QUERY_PLANNER_MODE_BY_WORKSPACE.get(workspace_id, QUERY_PLANNER_MODE)
+
+
+def _agent_input(question: str, user_id: int, workspace_id: int, belongs_to: str,
+                 chat_history: list[Message], planner_mode: str | None) -> dict[str, Any]:
     chat_history = [(mess.type, mess.message) for mess in chat_history][:5]
-    print("invoke", question, user_id, workspace_id, belongs_to, chat_history)
+    return {"user_input": question, "user_id": user_id, "workspace_id": workspace_id, "belongs_to": belongs_to,
+            "chat_history": chat_history, "planner_mode": _planner_mode(workspace_id, planner_mode)}
+
+
+async def _agent_config(user_id: int, workspace_id: int, tracer: TracingCallbackHandler) -> dict[str, Any]:
+    retriever = await asyncio.to_thread(VectorDBManager.get_or_create_retriever, user_id, workspace_id)
+    return {"configurable": {"retriever": retriever, "chunk_store": ChunkStore()}, "callbacks": [tracer]}
+
+
+def _finish_trace(tracer: TracingCallbackHandler, answer: AgentAnswer, user_id: int, workspace_id: int,
+                  question: str, include_trace: bool) -> AgentAnswer:
+    """Пишет трассировку запроса в лог и, если запрошено, добавляет ее в ответ"""
+    tracer.log(user_id=user_id, workspace_id=workspace_id, question=question, from_cache=answer.from_cache)
+    return answer._replace(trace=tracer.trace()) if include_trace else answer
+
+
+class AnswerCacheLookup(NamedTuple):
+    scope: tuple | None
+    embedding: list[float] | None
+    answer: AgentAnswer | None
+
+
+def _has_prior_turns(chat_history: list[Message]) -> bool:
+    """История читается после сохранения текущего вопроса, предыдущие ходы беседы - остальные сообщения"""
+    return len(chat_history) > 1
+
+
+async def _lookup_answer_cache(question: str, user_id: int, workspace_id: int, belongs_to: str | None,
+                               chat_history: list[Message]) -> AnswerCacheLookup:
+    """Кэш используется только для первого вопроса беседы: уточняющий вопрос RagAgent переписывает
+    с учетом истории, и ответ на него зависит от беседы, а не только от текста вопроса
+    """
+    if not SEMANTIC_CACHE_ENABLED or _has_prior_turns(chat_history):
+        return AnswerCacheLookup(None, None, None)
+    scope = await asyncio.to_thread(answer_cache.make_scope, user_id, workspace_id, belongs_to)
+    embedding = await asyncio.to_thread(embeddings.embed_query, question)
+    cached = answer_cache.get(scope, embedding)
+    return AnswerCacheLookup(scope, embedding, AgentAnswer(**cached)._replace(from_cache=True) if cached else None)
+
+
+def _store_in_answer_cache(lookup: AnswerCacheLookup, question: str, answer: AgentAnswer) -> None:
+    """Кэшируются только ответы по документам пространства"""
+    if lookup.scope is None or not answer.used_docs_names:
+        return
+    answer_cache.put(lookup.scope, question, lookup.embedding,
+                     answer._replace(answer_id=None, trace=None)._asdict())
+
+
+async def _invoke_agent(question: str, user_id: int, workspace_id: int, belongs_to: str,
+                        chat_history: list[Message], planner_mode: str | None = None,
+                        tracer: TracingCallbackHandler | None = None) -> AgentAnswer:
+    tracer = tracer or TracingCallbackHandler()
+    cache_lookup = await _lookup_answer_cache(question, user_id, workspace_id, belongs_to, chat_history)
+    if cache_lookup.answer:
+        return cache_lookup.answer
+    agent_input = _agent_input(question, user_id, workspace_id, belongs_to, chat_history, planner_mode)
+    print("invoke", question, user_id, workspace_id, belongs_to, agent_input["chat_history"])
     try:
-        result = super_visor().invoke(
-            {"user_input": question, "user_id": user_id, "workspace_id": workspace_id, "belongs_to": belongs_to,
-             "chat_history": chat_history})
-        print("VISOR RESULT", result)
-        return await format_agent_answer(result)
+        config = await _agent_config(user_id, workspace_id, tracer)
+        result = await super_visor().ainvoke(agent_input, config)
+        answer = await format_agent_answer(result, config["configurable"]["chunk_store"])
+        _store_in_answer_cache(cache_lookup, question, answer)
+        return answer
     except Exception as e:
         print("ОШИБКА ОБРАБОТКИ ЗАПРОСА", e)
         return await format_agent_answer({"user_input": question, "answer": "произошла ошибка"})
 
 
 @router.get("/")
-async def get_answer(question: str, user_id: int, workspace_id: int, belongs_to: str = None) -> dict[str, Any]:
+async def get_answer(question: str, user_id: int, workspace_id: int, belongs_to: str = None,
+                     planner_mode: str = None, trace: bool = False) -> dict[str, Any]:
+    """trace=true добавляет в ответ трассировку по узлам графа: время, токены LLM, число документов"""
     print(question, user_id, workspace_id, belongs_to)
-    MessagesService.insert_message(user_id, workspace_id, question, "user")
-    chat_history = MessagesService.get_user_messages(user_id, workspace_id)
+    await asyncio.to_thread(MessagesService.insert_message, user_id, workspace_id, question, "user")
+    chat_history = await asyncio.to_thread(MessagesService.get_user_messages, user_id, workspace_id)
     belongs_to = belongs_to if belongs_to != 'null' else None
-    answer = await _invoke_agent(question, user_id, workspace_id, belongs_to, chat_history)
-    answer._replace(answer_id=MessagesService.insert_message(user_id, workspace_id, answer.answer, "assistant"))
+    tracer = TracingCallbackHandler()
+    answer = await _invoke_agent(question, user_id, workspace_id, belongs_to, chat_history, planner_mode, tracer)
+    answer = _finish_trace(tracer, answer, user_id, workspace_id, question, trace)
+    answer = answer._replace(answer_id=await asyncio.to_thread(MessagesService.insert_message, user_id,
+                                                               workspace_id, answer.answer, "assistant"))
     print("=" * 50)
     print("=" * 50)
     print("=" * 50)
@@ -74,9 +155,102 @@ async def get_answer(question: str, user_id: int, workspace_id: int, belongs_to:
     return answer._asdict()
 
 
+# узлы, в которых генерируется итоговый ответ: RagAgent, SuperVisor (простой вопрос) и SeracherAgent
+ANSWER_NODES = {"generate_answer_with_retrieve_context", "simple", "generate"}
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _progress_event(node: str, update: dict) -> tuple[str, Any] | None:
+    """Событие хода выполнения графа по обновлению состояния узла"""
+    match node:
+        case "route_task":
+            return "route", {"routing": update.get("routing")}
+        case "retrieve_documents":
+            return "retrieved", {"count": len(update.get("retrieved_chunks") or [])}
+        case "get_neighboring_docs":
+            return "neighbours", {"count": len(update.get("neighboring_chunks") or [])}
+        case "reranked_documents":
+            return "reranked", {"count": len(update.get("neighboring_chunks") or [])}
+        case "search":
+            return "searched", {}
+        case "nothing_found":
+            return "nothing_found", {}
+    return None
+
+
+async def _stream_agent(question: str, user_id: int, workspace_id: int, belongs_to: str,
+                        chat_history: list[Message], planner_mode: str | None,
+                        include_trace: bool = False) -> AsyncIterator[str]:
+    """События SSE: route, retrieved, neighbours, reranked, searched, nothing_found - ход выполнения графа,
+    token - очередной фрагмент ответа, done - итоговый ответ в формате AgentAnswer после сохранения сообщения.
+    Ответ из кэша отправляется сразу событием done с from_cache=True
+    """
+    tracer = TracingCallbackHandler()
+    agent_input = _agent_input(question, user_id, workspace_id, belongs_to, chat_history, planner_mode)
+    result = {"user_input": question, "answer": ""}
+    chunk_store = None
+    cache_lookup = AnswerCacheLookup(None, None, None)
+    try:
+        cache_lookup = await _lookup_answer_cache(question, user_id, workspace_id, belongs_to, chat_history)
+        if cache_lookup.answer:
+            answer = _finish_trace(tracer, cache_lookup.answer, user_id, workspace_id, question, include_trace)
+            answer = answer._replace(
+                answer_id=await asyncio.to_thread(MessagesService.insert_message, user_id, workspace_id,
+                                                  answer.answer, "assistant"))
+            yield _sse("done", answer._asdict())
+            return
+        config = await _agent_config(user_id, workspace_id, tracer)
+        chunk_store = config["configurable"]["chunk_store"]
+        async for namespace, mode, chunk in super_visor().astream(agent_input, config,
+                                                                  stream_mode=["updates", "messages"],
+                                                                  subgraphs=True):
+            if mode == "messages":
+                message, metadata = chunk
+                if metadata.get("langgraph_node") in ANSWER_NODES and message.content:
+                    yield _sse("token", message.content)
+                continue
+            for node, update in chunk.items():
+                if not update:
+                    continue
+                if not namespace:
+                    result.update(update)
+                event = _progress_event(node, update)
+                if event:
+                    yield _sse(*event)
+    except Exception as e:
+        print("ОШИБКА ОБРАБОТКИ ЗАПРОСА", e)
+        result = {"user_input": question, "answer": "произошла ошибка"}
+        yield _sse("error", result["answer"])
+    answer = await format_agent_answer(result, chunk_store)
+    _store_in_answer_cache(cache_lookup, question, answer)
+    answer = _finish_trace(tracer, answer, user_id, workspace_id, question, include_trace)
+    answer = answer._replace(
+        answer_id=await asyncio.to_thread(MessagesService.insert_message, user_id, workspace_id, answer.answer,
+                                          "assistant"))
+    yield _sse("done", answer._asdict())
+
+
+@router.get("/stream")
+async def stream_answer(question: str, user_id: int, workspace_id: int, belongs_to: str = None,
+                        planner_mode: str = None, trace: bool = False) -> StreamingResponse:
+    """Потоковый ответ агента в формате server-sent events, сообщение сохраняется после завершения потока"""
+    await asyncio.to_thread(MessagesService.insert_message, user_id, workspace_id, question, "user")
+    chat_history = await asyncio.to_thread(MessagesService.get_user_messages, user_id, workspace_id)
+    belongs_to = belongs_to if belongs_to != 'null' else None
+    return StreamingResponse(
+        _stream_agent(question, user_id, workspace_id, belongs_to, chat_history, planner_mode, trace),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/clear_chat_history")
 async def clear_chat_history(user_id: int, workspace_id: int) -> dict[str, int]:
     MessagesService.delete_messages(user_id, workspace_id)
+    working_sets.forget(user_id, workspace_id)
     return {"status": 200}
 
 
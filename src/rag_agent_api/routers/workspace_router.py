@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any
 
 from fastapi import APIRouter
@@ -8,8 +9,11 @@ from src.rag_agent_api.services.database.documents_saver_service import Document
 from src.rag_agent_api.services.database.messages_service import MessagesService
 from src.rag_agent_api.services.database.workspace_market_service import WorkspaceMarketService
 from src.rag_agent_api.services.database.workspaces_service import WorkspacesService, WorkSpace
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
 from src.rag_agent_api.services.retriever_service import VectorDBManager
 from src.rag_agent_api.services.vectore_store_service import VecStoreService
+from src.rag_agent_api.services.warmup_service import warmup_service
+from src.rag_agent_api.services.workspace_lock_service import workspace_lock
 
 router = APIRouter(
     prefix="/workspace",
@@ -17,21 +21,40 @@ router = APIRouter(
 )
 
 
+def _delete_workspace_data_locked(user_id: int, workspace_id: int) -> None:
+    with workspace_lock(user_id, workspace_id):
+        VecStoreService.clear_vector_stores(user_id, workspace_id)
+        WorkspaceMarketService.delete_workspace_from_market(user_id, workspace_id)
+        DocumentsRemoveService.delete_all_files_in_workspace(user_id, workspace_id)
+        DocumentsRemoveService.delete_all_chunks_in_workspace(user_id, workspace_id)
+
+
+def _copy_workspace_data_locked(source_user_id: int, source_workspace_id: int, target_user_id: int,
+                                target_workspace_id: int) -> None:
+    with workspace_lock(source_user_id, source_workspace_id), workspace_lock(target_user_id, target_workspace_id):
+        VectorDBManager.copy_collection(source_user_id, source_workspace_id, target_user_id, target_workspace_id)
+        all_chunks = DocumentsGetterService.get_all_chunks_from_workspace(source_user_id, source_workspace_id)
+        all_files = DocumentsGetterService.get_all_files_from_workspace(source_user_id, source_workspace_id)
+
+        DocumentsSaverService.save_chunks(target_user_id, target_workspace_id, all_chunks)
+        DocumentsSaverService.save_many_files(target_user_id, target_workspace_id, all_files)
+
+
 @router.post("/delete_workspace")
 async def delete_workspace(user_id: int, workspace_id: int) -> dict:
     print(workspace_id)
-    VecStoreService.clear_vector_stores(user_id, workspace_id)
-    WorkspaceMarketService.delete_workspace_from_market(user_id, workspace_id)
-    DocumentsRemoveService.delete_all_files_in_workspace(user_id, workspace_id)
-    DocumentsRemoveService.delete_all_chunks_in_workspace(user_id, workspace_id)
+    await asyncio.to_thread(_delete_workspace_data_locked, user_id, workspace_id)
     MessagesService.delete_messages(user_id, workspace_id)
     WorkspacesService.delete_workspace(user_id, workspace_id)
+    await asyncio.to_thread(WorkspaceVersions.bump, user_id, workspace_id)
     return {"status": 200}
 
 
 @router.get('/user_workspaces')
 async def user_workspaces(user_id: int) -> list[WorkSpace]:
-    return WorkspacesService.get_all_user_workspaces(user_id)
+    workspaces = WorkspacesService.get_all_user_workspaces(user_id)
+    warmup_service.schedule(user_id, sorted((space.workspace_id for space in workspaces), reverse=True))
+    return workspaces
 
 
 @router.get("/create_new_workspace")
@@ -44,12 +67,9 @@ async def copy_workspace(source_user_id: int, source_workspace_id: int, target_u
                          target_workspace_name: str) -> dict[str, Any]:
     if not WorkspacesService.check_exist_workspace(target_user_id, target_workspace_name):
         target_workspace_id = WorkspacesService.create_workspace(target_user_id, target_workspace_name)
-        VectorDBManager.copy_collection(source_user_id, source_workspace_id, target_user_id, target_workspace_id)
-        all_chunks = DocumentsGetterService.get_all_chunks_from_workspace(source_user_id, source_workspace_id)
-        all_files = DocumentsGetterService.get_all_files_from_workspace(source_user_id, source_workspace_id)
-
-        DocumentsSaverService.save_chunks(target_user_id, target_workspace_id, all_chunks)
-        DocumentsSaverService.save_many_files(target_user_id, target_workspace_id, all_files)
+        await asyncio.to_thread(_copy_workspace_data_locked, source_user_id, source_workspace_id,
+                                target_user_id, target_workspace_id)
+        await asyncio.to_thread(WorkspaceVersions.bump, target_user_id, target_workspace_id)
         return {"status": "sucsess", "user_id": target_user_id, "workspace_id": target_workspace_id}
     return {"status": "fail"}
 
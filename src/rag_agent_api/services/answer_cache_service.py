@@ -0,0 +1,81 @@
+import copy
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+
+from src.rag_agent_api.config import (
+    SEMANTIC_CACHE_MIN_SIMILARITY,
+    SEMANTIC_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_MAX_SIZE_PER_WORKSPACE,
+    SEMANTIC_CACHE_MAX_WORKSPACES
+)
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
+
+
+class CachedAnswer(NamedTuple):
+    question: str
+    embedding: np.ndarray
+    answer: dict
+
+
+class SemanticAnswerCache:
+    """Кэш ответов агента по смыслу вопроса.
+    Область кэша - (user_id, workspace_id, версия пространства, belongs_to): изменение набора документов
+    увеличивает версию, и ответы по старому содержимому больше не находятся.
+    Внутри области ответ возвращается, если косинусная близость эмбеддингов вопросов не ниже min_similarity.
+    Записи вытесняются по LRU и по TTL
+    """
+
+    def __init__(self,
+                 min_similarity: float = SEMANTIC_CACHE_MIN_SIMILARITY,
+                 ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS,
+                 max_size_per_workspace: int = SEMANTIC_CACHE_MAX_SIZE_PER_WORKSPACE,
+                 max_workspaces: int = SEMANTIC_CACHE_MAX_WORKSPACES):
+        self.min_similarity = min_similarity
+        self._ttl_seconds = ttl_seconds
+        self._max_size_per_workspace = max_size_per_workspace
+        self._lock = threading.Lock()
+        self._scopes: LRUCache = LRUCache(maxsize=max_workspaces)
+
+    @staticmethod
+    def make_scope(user_id: int, workspace_id: int, belongs_to: Optional[str]) -> tuple:
+        """Область фиксирует версию пространства на момент начала обработки вопроса"""
+        return int(user_id), int(workspace_id), WorkspaceVersions.get(user_id, workspace_id), belongs_to
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get(self, scope: tuple, embedding: list[float]) -> dict | None:
+        query = self._normalize(embedding)
+        with self._lock:
+            entries: TTLCache | None = self._scopes.get(scope)
+            if entries is not None:
+                entries.expire()
+            best_key, best_similarity = None, self.min_similarity
+            for key, entry in list((entries or {}).items()):
+                similarity = float(entry.embedding @ query)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+            # обращение через get обновляет позицию записи в LRU
+            entry = entries.get(best_key) if best_key is not None else None
+        if entry is None:
+            metrics.inc("answer_cache_misses")
+            return None
+        metrics.inc("answer_cache_hits")
+        return copy.deepcopy(entry.answer)
+
+    def put(self, scope: tuple, question: str, embedding: list[float], answer: dict) -> None:
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None:
+                entries = TTLCache(maxsize=self._max_size_per_workspace, ttl=self._ttl_seconds)
+                self._scopes[scope] = entries
+            entries[question] = CachedAnswer(question, self._normalize(embedding), copy.deepcopy(answer))
+
+
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,63 @@
+from typing import NamedTuple
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig
+
+
+class ChunkRef(NamedTuple):
+    """Ссылка на фрагмент документа в состоянии графа вместо Document с текстом"""
+    belongs_to: str
+    doc_number: int
+    score: float = float("inf")
+    rerank_score: float | None = None
+
+    @property
+    def id(self) -> str:
+        return f"{self.belongs_to}:{self.doc_number}"
+
+    @classmethod
+    def from_document(cls, document: Document) -> "ChunkRef":
+        return cls(document.metadata["belongs_to"], int(document.metadata["doc_number"]),
+                   document.metadata.get("score", float("inf")), document.metadata.get("rerank_score"))
+
+
+class ChunkStore:
+    """Тексты фрагментов одного запроса.
+    Узлы графа передают друг другу только ChunkRef, текст берется из хранилища там, где он нужен:
+    оценка релевантности, формирование контекста ответа и ответ пользователю.
+    Создается на каждый запрос и передается через config={"configurable": {"chunk_store": ChunkStore()}}
+    """
+
+    def __init__(self):
+        self._texts: dict[str, str] = {}
+
+    def add(self, documents: list[Document]) -> list[ChunkRef]:
+        refs = []
+        for document in documents:
+            ref = ChunkRef.from_document(document)
+            self._texts[ref.id] = document.page_content
+            refs.append(ref)
+        return refs
+
+    def text(self, ref: ChunkRef) -> str:
+        return self._texts[ref.id]
+
+    def documents(self, refs: list[ChunkRef]) -> list[Document]:
+        """Document с текстом и оценками фрагмента для кода, который работает с документами"""
+        documents = []
+        for ref in refs:
+            metadata = {"belongs_to": ref.belongs_to, "doc_number": ref.doc_number, "score": ref.score}
+            if ref.rerank_score is not None:
+                metadata["rerank_score"] = ref.rerank_score
+            documents.append(Document(page_content=self.text(ref), metadata=metadata))
+        return documents
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
+def get_chunk_store(config: RunnableConfig) -> ChunkStore:
+    chunk_store = config.get("configurable", {}).get("chunk_store")
+    if chunk_store is None:
+        raise ValueError('не передан config={"configurable": {"chunk_store": ChunkStore()}}')
+    return chunk_store
@@ -0,0 +1,97 @@
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+from src.rag_agent_api.config import (
+    CONTEXT_COMPRESSION_RATIO,
+    CONTEXT_COMPRESSION_WINDOW,
+    CONTEXT_COMPRESSION_MIN_TOKENS
+)
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.context_packer_service import PackedContext, context_packer
+
+# конец предложения: знак препинания и пробел перед заглавной буквой, цифрой или началом перечисления
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+(?=[«\"(\-—•\dA-ZА-ЯЁ])|\n+")
+
+
+class CompressedContext(NamedTuple):
+    text: str
+    original_tokens: int
+    tokens: int
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - self.tokens
+
+
+class ContextCompressor:
+    """Извлекающее сжатие контекста ответа.
+    Блоки собранного контекста разбиваются на предложения, предложения и вопрос векторизуются одним вызовом
+    модели эмбеддингов на каждый. Предложения берутся по убыванию близости к вопросу вместе с window соседями
+    в пределах блока, пока их длина не превысит ratio от длины контекста, и выводятся в исходном порядке
+    """
+
+    def __init__(self,
+                 ratio: float = CONTEXT_COMPRESSION_RATIO,
+                 window: int = CONTEXT_COMPRESSION_WINDOW,
+                 min_tokens: int = CONTEXT_COMPRESSION_MIN_TOKENS):
+        self.ratio = ratio
+        self.window = window
+        self.min_tokens = min_tokens
+
+    @staticmethod
+    def split_sentences(text: str) -> list[str]:
+        return [sentence.strip() for sentence in SENTENCE_END.split(text) if sentence.strip()]
+
+    def _select(self, similarities: np.ndarray, lengths: np.ndarray, block_ids: np.ndarray) -> np.ndarray:
+        """Маска выбранных предложений: лучшее предложение берется всегда, следующие - пока хватает длины"""
+        limit = lengths.sum() * self.ratio
+        keep = np.zeros(len(similarities), dtype=bool)
+        used = 0
+        for i in np.argsort(-similarities):
+            first, last = max(i - self.window, 0), min(i + self.window, len(keep) - 1)
+            group = [j for j in range(first, last + 1) if block_ids[j] == block_ids[i] and not keep[j]]
+            added = lengths[group].sum()
+            if used and used + added > limit:
+                break
+            keep[group] = True
+            used += added
+        return keep
+
+    def compress(self, question: str, packed: PackedContext) -> CompressedContext:
+        """Токены исходного и сжатого контекста считаются одинаково: по тексту вместе с заголовками документов"""
+        original_tokens = context_packer.count_tokens(packed.text)
+        if original_tokens < self.min_tokens:
+            return CompressedContext(packed.text, original_tokens, original_tokens)
+        sentences, block_ids = [], []
+        for block_id, (_, text) in enumerate(packed.blocks):
+            block_sentences = self.split_sentences(text)
+            sentences.extend(block_sentences)
+            block_ids.extend([block_id] * len(block_sentences))
+        if len(sentences) < 2:
+            return CompressedContext(packed.text, original_tokens, original_tokens)
+
+        vectors = np.asarray(embeddings.embed_documents(sentences), dtype=np.float32)
+        question_vector = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        similarities = vectors @ question_vector / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(question_vector))
+        block_ids = np.asarray(block_ids)
+        keep = self._select(similarities, np.asarray([len(s) for s in sentences]), block_ids)
+
+        blocks = []
+        for block_id, (belongs_to, _) in enumerate(packed.blocks):
+            runs, previous = [], None
+            for i in np.flatnonzero(keep & (block_ids == block_id)):
+                # подряд идущие предложения - одна строка, пропуск между ними - новая строка
+                if previous is not None and i == previous + 1:
+                    runs[-1] += " " + sentences[i]
+                else:
+                    runs.append(sentences[i])
+                previous = i
+            if runs:
+                blocks.append((belongs_to, "\n".join(runs)))
+        text = context_packer.render(blocks)
+        return CompressedContext(text, original_tokens, context_packer.count_tokens(text))
+
+
+context_compressor = ContextCompressor()
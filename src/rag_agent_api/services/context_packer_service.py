@@ -0,0 +1,99 @@
+from functools import lru_cache
+from typing import NamedTuple
+
+from langchain_core.documents import Document
+from transformers import AutoTokenizer
+
+from src.rag_agent_api.config import CONTEXT_TOKEN_BUDGET, CONTEXT_TOKENIZER_NAME, CONTEXT_MIN_OVERLAP_CHARS
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name: str):
+    """Загружает токенизатор один раз на процесс"""
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+class PackedContext(NamedTuple):
+    text: str
+    documents: list[Document]
+    used_tokens: int
+    dropped_tokens: int
+    # (belongs_to, текст подряд идущих фрагментов документа), из них собран text
+    blocks: list[tuple[str, str]]
+
+
+class ContextPacker:
+    """Собирает контекст для ответа в пределах бюджета токенов.
+    Фрагменты отбираются жадно по релевантности (оценка реранкера, затем векторная оценка),
+    затем упорядочиваются по документу и номеру фрагмента, а перекрытие соседних фрагментов,
+    оставшееся от разбиения текста, вырезается
+    """
+
+    def __init__(self,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 tokenizer_name: str = CONTEXT_TOKENIZER_NAME,
+                 min_overlap_chars: int = CONTEXT_MIN_OVERLAP_CHARS):
+        self.token_budget = token_budget
+        self.tokenizer_name = tokenizer_name
+        self.min_overlap_chars = min_overlap_chars
+
+    def count_tokens(self, text: str) -> int:
+        return len(load_tokenizer(self.tokenizer_name).encode(text, add_special_tokens=False))
+
+    @staticmethod
+    def _relevance_key(doc: Document) -> tuple[float, float]:
+        return -doc.metadata.get("rerank_score", float("-inf")), doc.metadata.get("score", float("inf"))
+
+    @staticmethod
+    def _position(doc: Document) -> tuple[str, int]:
+        return doc.metadata.get("belongs_to", ""), int(doc.metadata.get("doc_number", 0))
+
+    @staticmethod
+    def render(blocks: list[tuple[str, str]]) -> str:
+        return "\n\n".join(f"Документ: {belongs_to}\n{text}" for belongs_to, text in blocks)
+
+    def _strip_overlap(self, previous: str, text: str) -> str:
+        """Убирает из начала text самый длинный префикс, которым заканчивается previous"""
+        for size in range(min(len(previous), len(text)), self.min_overlap_chars - 1, -1):
+            if previous.endswith(text[:size]):
+                return text[size:].lstrip()
+        return text
+
+    def pack(self, documents: list[Document]) -> PackedContext:
+        unique: dict[tuple[str, int], Document] = {}
+        for doc in documents:
+            if doc.page_content.strip():
+                unique.setdefault(self._position(doc), doc)
+
+        selected: list[Document] = []
+        used = dropped = 0
+        for doc in sorted(unique.values(), key=self._relevance_key):
+            tokens = self.count_tokens(doc.page_content)
+            if used + tokens <= self.token_budget:
+                selected.append(doc)
+                used += tokens
+            else:
+                dropped += tokens
+
+        # документы идут в порядке самого релевантного фрагмента, фрагменты внутри документа - по номеру
+        documents_order = {}
+        for doc in selected:
+            documents_order.setdefault(doc.metadata.get("belongs_to", ""), len(documents_order))
+        selected.sort(key=lambda d: (documents_order[self._position(d)[0]], self._position(d)[1]))
+
+        blocks: list[tuple[str, str]] = []
+        previous: Document | None = None
+        for doc in selected:
+            belongs_to, doc_number = self._position(doc)
+            text = doc.page_content.strip()
+            if previous is not None and self._position(previous) == (belongs_to, doc_number - 1):
+                text = self._strip_overlap(previous.page_content.strip(), text)
+                blocks[-1] = (belongs_to, blocks[-1][1] + "\n" + text)
+            else:
+                blocks.append((belongs_to, text))
+            previous = doc
+        context = self.render(blocks)
+        return PackedContext(context, selected, self.count_tokens(context), dropped, blocks)
+
+
+context_packer = ContextPacker()
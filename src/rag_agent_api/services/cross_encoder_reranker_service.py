@@ -0,0 +1,29 @@
+from langchain_core.documents import Document
+from sentence_transformers import CrossEncoder
+
+from src.rag_agent_api.config import CROSS_ENCODER_MODEL_NAME, CROSS_ENCODER_THRESHOLD, LOCAL_MODELS_BATCH_SIZE
+from src.rag_agent_api.embeddings_init import load_local_model
+
+
+class CrossEncoderReranker:
+    """Локальная оценка релевантности пар (вопрос, фрагмент) мультиязычным cross-encoder.
+    Все пары оцениваются одним батчевым проходом модели на CPU
+    """
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL_NAME, threshold: float = CROSS_ENCODER_THRESHOLD):
+        self.model_name = model_name
+        self.threshold = threshold
+
+    @property
+    def model(self) -> CrossEncoder:
+        return load_local_model(CrossEncoder, self.model_name)
+
+    def score(self, question: str, documents: list[Document]) -> list[float]:
+        """Возвращает оценки релевантности от 0 до 1 в порядке документов"""
+        if not documents:
+            return []
+        pairs = [(question, doc.page_content) for doc in documents]
+        return [float(s) for s in self.model.predict(pairs, batch_size=LOCAL_MODELS_BATCH_SIZE)]
+
+
+cross_encoder_reranker = CrossEncoderReranker()
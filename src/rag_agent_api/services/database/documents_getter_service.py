@@ -1,7 +1,14 @@
-from src.database.repositories import chunksCRUDRepository, filesCRUDRepository
+import threading
 from typing import NamedTuple
+
+from cachetools import LRUCache
 from langchain_core.documents import Document
 
+from src.database.repositories import chunksCRUDRepository, filesCRUDRepository
+from src.database.tables import Files
+from src.rag_agent_api.config import FILES_CACHE_MAX_SIZE
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
+
 
 class File(NamedTuple):
     user_id: int
@@ -11,6 +18,24 @@ class File(NamedTuple):
     summary_content: str
 
 
+_files_cache: LRUCache = LRUCache(maxsize=FILES_CACHE_MAX_SIZE)
+_files_cache_lock = threading.Lock()
+
+
+def _select_workspace_files(user_id: int, workspace_id: int) -> list[Files]:
+    """Файлы пространства, закэшированные по версии пространства:
+    загрузка и удаление файлов увеличивают версию, и следующий вызов читает список из базы
+    """
+    key = (int(user_id), int(workspace_id), WorkspaceVersions.get(user_id, workspace_id))
+    with _files_cache_lock:
+        files = _files_cache.get(key)
+    if files is None:
+        files = filesCRUDRepository.select_all_by_user_id_and_work_space_id(user_id, workspace_id)
+        with _files_cache_lock:
+            _files_cache[key] = files
+    return files
+
+
 class DocumentsGetterService:
     @staticmethod
     def get_source_chunk(user_id: int, workspace_id: int, belongs_to: str, doc_number: str) -> Document:
@@ -26,6 +51,29 @@ class DocumentsGetterService:
                             metadata={"belongs_to": chunk.source_doc_name, "doc_number": chunk.doc_number})
         return Document(page_content="")
 
+    @staticmethod
+    def get_source_chunks_by_spans(user_id: int, workspace_id: int,
+                                   spans: dict[str, list[tuple[int, int]]]) -> list[Document]:
+        """Извлечение исходных фрагментов по диапазонам номеров одним запросом к базе
+        spans - {название документа: [(первый номер, последний номер)]}
+
+        returns: Documents в порядке документов в spans и номеров фрагментов, без повторов
+        """
+        chunks = chunksCRUDRepository.select_chunks_by_spans(user_id, workspace_id, spans)
+        by_position = {}
+        for chunk in chunks:
+            by_position.setdefault((chunk.source_doc_name, chunk.doc_number), chunk)
+        order = {belongs_to: i for i, belongs_to in enumerate(spans)}
+        positions = sorted(by_position, key=lambda position: (order[position[0]], position[1]))
+        return [Document(page_content=by_position[p].summary_content,
+                         metadata={"belongs_to": p[0], "doc_number": p[1]})
+                for p in positions]
+
+    @staticmethod
+    def get_file_doc_numbers(user_id: int, workspace_id: int, belongs_to: str) -> list[int]:
+        """Возвращает номера всех фрагментов документа belongs_to"""
+        return chunksCRUDRepository.select_doc_numbers_by_file(user_id, workspace_id, belongs_to)
+
     @staticmethod
     def get_all_chunks_from_workspace(user_id: int, workspace_id: int) -> list[Document]:
         chunks = chunksCRUDRepository.select_all_chunks_from_workspace(user_id, workspace_id)
@@ -40,7 +88,7 @@ class DocumentsGetterService:
         Возвращает все id и названия файлов пользователя в workspace
         {"id": "name"}
         """
-        files = filesCRUDRepository.select_all_by_user_id_and_work_space_id(user_id, workspace_id)
+        files = _select_workspace_files(user_id, workspace_id)
         result = {str(f.id): f.file_name for f in files}
         return result
 
@@ -49,13 +97,13 @@ class DocumentsGetterService:
         """Возвращает загруженные файлы с их кратких содержанием в формате
          {"id": "summary"}
          """
-        files = filesCRUDRepository.select_all_by_user_id_and_work_space_id(user_id, workspace_id)
+        files = _select_workspace_files(user_id, workspace_id)
         result = {str(f.id): f.summary_content for f in files}
         return result
 
     @staticmethod
     def get_all_files_from_workspace(user_id: int, workspace_id: int) -> list[File]:
         """Возвращает все файлы в пользовательском пространстве пользователя"""
-        files = filesCRUDRepository.select_all_by_user_id_and_work_space_id(user_id, workspace_id)
+        files = _select_workspace_files(user_id, workspace_id)
         return [File(file.user_id, file.workspace_id, file.file_name, file.load_date, file.summary_content) for file in
                 files]
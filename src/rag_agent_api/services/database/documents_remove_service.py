@@ -7,6 +7,11 @@ class DocumentsRemoveService:
         """Удаляет документв пространстве по id документа"""
         return filesCRUDRepository.delete_file_by_id(user_id, workspace_id, file_id)
 
+    @staticmethod
+    def delete_files_by_name(user_id: int, workspace_id: int, file_name: str) -> None:
+        """Удаляет записи о файле file_name в пространстве"""
+        return filesCRUDRepository.delete_files_by_name(user_id, workspace_id, file_name)
+
     @staticmethod
     def delete_all_files_in_workspace(user_id: int, workspace_id: int) -> None:
         """Удаляет все файлы в пространстве"""
@@ -16,3 +21,8 @@ class DocumentsRemoveService:
     def delete_all_chunks_in_workspace(user_id: int, workspace_id: int) -> None:
         """Удаляет все фрагменты в пространстве"""
         return chunksCRUDRepository.delete_all_chunks_in_workspace(user_id, workspace_id)
+
+    @staticmethod
+    def delete_chunks_by_file(user_id: int, workspace_id: int, belongs_to: str) -> None:
+        """Удаляет все фрагменты документа belongs_to"""
+        return chunksCRUDRepository.delete_chunks_by_file(user_id, workspace_id, belongs_to)
@@ -1,5 +1,8 @@
+import threading
 from typing import Literal, NamedTuple
 
+from cachetools import TTLCache
+
 from src.database.repositories.favoriteAnswersCrudRepository import (
     add_in_favorite,
     delete_from_favorite,
@@ -13,6 +16,7 @@ from src.database.repositories.messagesCRUDRepository import (
     update_favorite_status_in_history
 )
 from src.database.tables import Messages
+from src.rag_agent_api.config import HISTORY_CACHE_MAX_SIZE, HISTORY_CACHE_TTL_SECONDS
 
 roles = Literal["user", "assistant", "jarvis"]
 
@@ -32,6 +36,19 @@ class FavoriteMessage(NamedTuple):
     message: str
 
 
+_history_cache: TTLCache = TTLCache(maxsize=HISTORY_CACHE_MAX_SIZE, ttl=HISTORY_CACHE_TTL_SECONDS)
+_history_cache_lock = threading.Lock()
+# номер изменения истории пространства: чтение, начатое до изменения, не попадет в кэш
+_history_generations: dict[tuple[int, int], int] = {}
+
+
+def _invalidate_history(user_id: int, workspace_id: int) -> None:
+    key = (int(user_id), int(workspace_id))
+    with _history_cache_lock:
+        _history_cache.pop(key, None)
+        _history_generations[key] = _history_generations.get(key, 0) + 1
+
+
 class MessagesService:
 
     @staticmethod
@@ -44,16 +61,30 @@ class MessagesService:
             infavorite=False
         )
         print("new message", new_message)
-        return insert_messages(new_message)
+        message_id = insert_messages(new_message)
+        _invalidate_history(user_id, workspace_id)
+        return message_id
 
     @staticmethod
     def get_user_messages(user_id: int, workspace_id: int) -> list[Message]:
+        """История сообщений пространства, закэшированная до следующего изменения истории"""
+        key = (int(user_id), int(workspace_id))
+        with _history_cache_lock:
+            cached = _history_cache.get(key)
+            generation = _history_generations.get(key, 0)
+        if cached is not None:
+            return list(cached)
         messages = select_all_by_user_id_and_work_space_id(user_id, workspace_id)
-        return [Message(mes.id, mes.message_type, mes.message, "history", mes.infavorite) for mes in messages]
+        history = [Message(mes.id, mes.message_type, mes.message, "history", mes.infavorite) for mes in messages]
+        with _history_cache_lock:
+            if _history_generations.get(key, 0) == generation:
+                _history_cache[key] = history
+        return list(history)
 
     @staticmethod
     def delete_messages(user_id: int, workspace_id: int) -> None:
         delete_all_messages_from_workspace(user_id, workspace_id)
+        _invalidate_history(user_id, workspace_id)
 
     @staticmethod
     def add_in_favorite(id: int, user_id: int, workspace_id: int, text: str) -> None:
@@ -73,3 +104,4 @@ class MessagesService:
     @staticmethod
     def update_favorite_status_in_history(id: int, user_id: int, workspace_id: int, status: bool):
         update_favorite_status_in_history(id, user_id, workspace_id, status)
+        _invalidate_history(user_id, workspace_id)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+from src.rag_agent_api.config import LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES
+from src.rag_agent_api.services.metrics_service import metrics
+
+# признак ответа из кэша в response_metadata сообщения, по нему callbacks не учитывают задержку и токены
+CACHE_HIT_METADATA_KEY = "llm_cache_hit"
+# лишние записи удаляются не при каждой вставке, а раз в TRIM_EVERY вставок
+TRIM_EVERY = 100
+
+
+class LLMResponseStore:
+    """Ответы LLM в SQLite: запись живет ttl_seconds, при превышении max_entries
+    удаляются записи с самым давним обращением
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inserts = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, node TEXT NOT NULL, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    @staticmethod
+    def make_key(prompt: str, llm_string: str) -> str:
+        """llm_string - модель и параметры вызова, prompt - сериализованные сообщения"""
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is not None:
+                self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def put(self, key: str, node: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, node, response, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)", (key, node, response, now, now)
+            )
+            self._inserts += 1
+            if self._inserts % TRIM_EVERY == 0:
+                self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        self._connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._connection.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+        )
+
+    def clear(self, node: str | None = None) -> None:
+        with self._lock, self._connection:
+            if node is None:
+                self._connection.execute("DELETE FROM llm_cache")
+            else:
+                self._connection.execute("DELETE FROM llm_cache WHERE node = ?", (node,))
+
+
+class NodeLLMCache(BaseCache):
+    """Точный кэш ответов LLM одного узла агентов, передается клиенту модели через параметр cache.
+    Ключ - хэш модели с параметрами вызова и сообщений запроса, поэтому ответ возвращается только
+    на побайтно совпадающий запрос. Используется для узлов с детерминированными ответами (см. LLM_NODE_MODELS),
+    попадания и промахи пишутся в счетчики llm_cache_hits и llm_cache_misses с меткой node
+    """
+
+    def __init__(self, node: str, store: LLMResponseStore):
+        self.node = node
+        self.store = store
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        response = self.store.get(self.store.make_key(prompt, llm_string))
+        if response is None:
+            metrics.inc("llm_cache_misses", labels={"node": self.node})
+            return None
+        metrics.inc("llm_cache_hits", labels={"node": self.node})
+        generations = loads(response)
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None:
+                # токены ответа из кэша не расходуются
+                message.usage_metadata = None
+                message.response_metadata[CACHE_HIT_METADATA_KEY] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        self.store.put(self.store.make_key(prompt, llm_string), self.node, dumps(list(return_val)))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.store.clear(self.node)
+
+
+def is_cache_hit(response: Any) -> bool:
+    """Ответ LLMResult получен из NodeLLMCache"""
+    return any(getattr(getattr(generation, "message", None), "response_metadata", {}).get(CACHE_HIT_METADATA_KEY)
+               for generations in response.generations for generation in generations)
+
+
+def llm_cache_hit_rates() -> dict[str, float]:
+    """Доля попаданий в кэш по узлам: {node: hits / (hits + misses)}"""
+    counters = metrics.snapshot()["counters"]
+    hits = {item["labels"]["node"]: item["value"] for item in counters.get("llm_cache_hits", [])}
+    misses = {item["labels"]["node"]: item["value"] for item in counters.get("llm_cache_misses", [])}
+    return {node: hits.get(node, 0) / (hits.get(node, 0) + misses.get(node, 0)) for node in hits.keys() | misses.keys()}
@@ -0,0 +1,73 @@
+import threading
+from collections import defaultdict, deque
+
+HISTOGRAM_WINDOW = 1000
+
+
+def _labels_key(labels: dict | None) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+class _Histogram:
+    """Число и сумма наблюдений за все время и последние HISTOGRAM_WINDOW значений для перцентилей"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.window: deque[float] = deque(maxlen=HISTOGRAM_WINDOW)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.window.append(value)
+
+    def summary(self) -> dict:
+        values = sorted(self.window)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": values[len(values) // 2] if values else 0.0,
+            "p95": values[min(int(len(values) * 0.95), len(values) - 1)] if values else 0.0,
+            "max": values[-1] if values else 0.0,
+        }
+
+
+class MetricsRegistry:
+    """Простой потокобезопасный реестр метрик процесса (счетчики и гистограммы)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self._histograms: dict[str, dict[tuple, _Histogram]] = defaultdict(lambda: defaultdict(_Histogram))
+
+    def inc(self, name: str, value: float = 1, labels: dict | None = None) -> None:
+        with self._lock:
+            self._counters[name][_labels_key(labels)] += value
+
+    def observe(self, name: str, value: float, labels: dict | None = None) -> None:
+        with self._lock:
+            self._histograms[name][_labels_key(labels)].observe(value)
+
+    def get_counter(self, name: str, labels: dict | None = None) -> float:
+        with self._lock:
+            return self._counters[name][_labels_key(labels)]
+
+    def snapshot(self) -> dict:
+        """Возвращает текущие значения всех метрик в формате
+        {"counters": {"name": [{"labels": {...}, "value": 1}]},
+         "histograms": {"name": [{"labels": {...}, "count": 1, "mean": 0.5, "p50": 0.5, "p95": 0.5, "max": 0.5}]}}
+        """
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.summary()} for key, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                }
+            }
+
+
+metrics = MetricsRegistry()
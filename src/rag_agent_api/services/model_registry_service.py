@@ -0,0 +1,86 @@
+import threading
+import time
+from typing import Any, Callable, NamedTuple
+from uuid import UUID
+
+from langchain_core.caches import BaseCache
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from src.rag_agent_api.services.llm_cache_service import is_cache_hit
+from src.rag_agent_api.services.metrics_service import metrics
+
+
+class ModelSpec(NamedTuple):
+    tier: str
+    model: str
+    temperature: float
+    max_tokens: int | None
+
+
+class LLMLatencyHandler(BaseCallbackHandler):
+    """Задержка вызовов клиента модели: гистограмма llm_latency_seconds с метками tier и model.
+    Ответы из кэша LLM в задержку модели не входят
+    """
+    run_inline = True
+
+    def __init__(self, spec: ModelSpec):
+        self.labels = {"tier": spec.tier, "model": spec.model}
+        self._lock = threading.Lock()
+        self._started: dict[UUID, float] = {}
+
+    def on_chat_model_start(self, serialized: dict[str, Any] | None, messages: Any, *, run_id: UUID,
+                            **kwargs: Any) -> None:
+        with self._lock:
+            self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            started_at = self._started.pop(run_id, None)
+        if started_at is not None and not is_cache_hit(response):
+            metrics.observe("llm_latency_seconds", time.perf_counter() - started_at, self.labels)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._started.pop(run_id, None)
+        metrics.inc("llm_errors", labels=self.labels)
+
+
+class ModelRegistry:
+    """Клиенты LLM по узлам агентов.
+    tiers - {уровень: {"model": ..., "temperature": ...}},
+    nodes - {узел: {"tier": ..., "max_tokens": ..., "cache": ...}}, model и temperature уровня
+    можно переопределить в узле.
+    Узлы с одинаковыми параметрами используют один клиент, factory(spec, callbacks, cache) создает клиент.
+    Узлы с cache=True получают отдельный клиент с кэшем cache_factory(node), чтобы попадания считались по узлам
+    """
+
+    def __init__(self, tiers: dict[str, dict], nodes: dict[str, dict],
+                 factory: Callable[[ModelSpec, list[BaseCallbackHandler], BaseCache | None], BaseChatModel],
+                 cache_factory: Callable[[str], BaseCache] | None = None):
+        self.tiers = tiers
+        self.nodes = nodes
+        self._factory = factory
+        self._cache_factory = cache_factory
+        self._lock = threading.Lock()
+        self._clients: dict[tuple[ModelSpec, str | None], BaseChatModel] = {}
+
+    def spec(self, node: str) -> ModelSpec:
+        params = self.nodes[node]
+        tier = self.tiers[params["tier"]]
+        return ModelSpec(params["tier"], params.get("model", tier["model"]),
+                         params.get("temperature", tier["temperature"]), params.get("max_tokens"))
+
+    def get(self, node: str) -> BaseChatModel:
+        spec = self.spec(node)
+        cached = self._cache_factory is not None and self.nodes[node].get("cache", False)
+        key = (spec, node if cached else None)
+        with self._lock:
+            if key not in self._clients:
+                cache = self._cache_factory(node) if cached else None
+                self._clients[key] = self._factory(spec, [LLMLatencyHandler(spec)], cache)
+            return self._clients[key]
+
+    def models(self) -> dict[str, BaseChatModel]:
+        """{узел: клиент} для всех узлов, передается агентам в параметре models"""
+        return {node: self.get(node) for node in self.nodes}
@@ -0,0 +1,87 @@
+import threading
+import time
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from src.rag_agent_api.config import PLAN_MAX_LLM_CALLS, PLAN_MAX_SECONDS, PLAN_MAX_TOKENS, PLAN_MAX_REPLANS
+from src.rag_agent_api.services.llm_cache_service import is_cache_hit
+from src.rag_agent_api.services.tracing_service import token_usage
+
+
+class PlanBudgetExceeded(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"бюджет задачи исчерпан: {reason}")
+        self.reason = reason
+
+
+class PlanBudget(BaseCallbackHandler):
+    """Бюджет одной задачи PlanAndExecuteAgent: число вызовов LLM, время и токены, число перепланирований.
+    Передается в callbacks вызовов и проверяется в начале каждого вызова LLM задачи, в том числе внутри
+    агентов-инструментов: при исчерпании on_chat_model_start бросает PlanBudgetExceeded и вызов не выполняется.
+    Вызов учитывается при старте, чтобы одновременные шаги не превысили лимит; ответы из кэша LLM
+    в бюджет не входят
+    """
+    run_inline = True
+    raise_error = True
+
+    def __init__(self,
+                 max_llm_calls: int = PLAN_MAX_LLM_CALLS,
+                 max_seconds: float = PLAN_MAX_SECONDS,
+                 max_tokens: int = PLAN_MAX_TOKENS,
+                 max_replans: int = PLAN_MAX_REPLANS):
+        self.max_llm_calls = max_llm_calls
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.max_replans = max_replans
+        self._lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.llm_calls = 0
+        self.tokens = 0
+        self.replans = 0
+
+    def _start_call(self) -> None:
+        with self._lock:
+            self.check()
+            self.llm_calls += 1
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list[list[BaseMessage]],
+                            **kwargs: Any) -> None:
+        self._start_call()
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str], **kwargs: Any) -> None:
+        self._start_call()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if is_cache_hit(response):
+            with self._lock:
+                self.llm_calls -= 1
+            return
+        prompt_tokens, completion_tokens = token_usage(response)
+        with self._lock:
+            self.tokens += prompt_tokens + completion_tokens
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def remaining_seconds(self) -> float:
+        return max(self.max_seconds - self.elapsed(), 0.0)
+
+    def check(self) -> None:
+        if self.llm_calls >= self.max_llm_calls:
+            raise PlanBudgetExceeded("llm_calls")
+        if self.tokens >= self.max_tokens:
+            raise PlanBudgetExceeded("tokens")
+        if not self.remaining_seconds():
+            raise PlanBudgetExceeded("time")
+
+    def start_replan(self) -> None:
+        if self.replans >= self.max_replans:
+            raise PlanBudgetExceeded("replans")
+        self.replans += 1
+
+    def usage(self) -> dict[str, Any]:
+        return {"llm_calls": self.llm_calls, "tokens": self.tokens, "seconds": round(self.elapsed(), 3),
+                "replans": self.replans}
@@ -0,0 +1,201 @@
+"""Локальный классификатор запросов по эмбеддингам LaBSE (ближайший центроид).
+
+Используется вместо вызова LLM в SuperVisor.route_task (задача route) и RagAgent.analyze_query_for_category
+(задача category). Если уверенность ниже QUERY_CLASSIFIER_MIN_CONFIDENCE, решение принимает LLM.
+При QUERY_CLASSIFIER_LOG_DECISIONS ответ LLM дописывается в журнал решений в QUERY_CLASSIFIER_DECISIONS_DIR,
+после проверки разметки журнал можно добавить к обучающей выборке (--with-decisions).
+Обучающие примеры лежат в data/query_classifier, обученные центроиды пишутся в QUERY_CLASSIFIER_MODEL_DIR.
+
+Обучение и оценка точности:
+    python -m src.rag_agent_api.services.query_classifier_service train --tasks route category
+    python -m src.rag_agent_api.services.query_classifier_service evaluate --tasks route category
+"""
+import argparse
+import json
+import os
+import random
+import threading
+
+import numpy as np
+
+from src.rag_agent_api.config import (
+    QUERY_CLASSIFIER_ENABLED,
+    QUERY_CLASSIFIER_MODEL_DIR,
+    QUERY_CLASSIFIER_MIN_CONFIDENCE,
+    QUERY_CLASSIFIER_TEMPERATURE,
+    QUERY_CLASSIFIER_LOG_DECISIONS,
+    QUERY_CLASSIFIER_DECISIONS_DIR,
+    QUERY_CLASSIFIER_DECISIONS_MAX_BYTES
+)
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.metrics_service import metrics
+
+CLASSIFIER_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "query_classifier")
+
+TASK_LABELS = {
+    "route": ["rag_agent", "visualizer", "web_searcher", "simple"],
+    "category": ["factual", "analytical", "opinion"],
+}
+
+
+class NearestCentroidClassifier:
+    """Центроид каждого класса - нормированное среднее эмбеддингов примеров.
+    Уверенность - softmax косинусных близостей к центроидам с температурой QUERY_CLASSIFIER_TEMPERATURE
+    """
+
+    def __init__(self, task: str, data_dir: str = CLASSIFIER_DATA_DIR,
+                 model_dir: str = QUERY_CLASSIFIER_MODEL_DIR,
+                 decisions_dir: str = QUERY_CLASSIFIER_DECISIONS_DIR,
+                 min_confidence: float = QUERY_CLASSIFIER_MIN_CONFIDENCE,
+                 temperature: float = QUERY_CLASSIFIER_TEMPERATURE):
+        self.task = task
+        self.labels = TASK_LABELS[task]
+        self.data_dir = data_dir
+        self.model_dir = model_dir
+        self.decisions_dir = decisions_dir
+        self.min_confidence = min_confidence
+        self.temperature = temperature
+        self._lock = threading.Lock()
+        self._centroids: np.ndarray | None = None
+        self._loaded = False
+
+    @property
+    def examples_path(self) -> str:
+        return os.path.join(self.data_dir, f"{self.task}_examples.json")
+
+    @property
+    def decisions_path(self) -> str:
+        return os.path.join(self.decisions_dir, f"{self.task}_decisions.jsonl")
+
+    @property
+    def model_path(self) -> str:
+        return os.path.join(self.model_dir, f"{self.task}_centroids.npy")
+
+    def load_examples(self, with_decisions: bool = False) -> list[dict]:
+        """Размеченные примеры и, если with_decisions, решения LLM из журнала"""
+        with open(self.examples_path, encoding="utf-8") as f:
+            examples = json.load(f)
+        if with_decisions and os.path.exists(self.decisions_path):
+            with open(self.decisions_path, encoding="utf-8") as f:
+                examples += [json.loads(line) for line in f if line.strip()]
+        return [e for e in examples if e["label"] in self.labels]
+
+    def log_decision(self, text: str, label: str) -> None:
+        """Сохраняет решение LLM для разметки, если включен QUERY_CLASSIFIER_LOG_DECISIONS"""
+        if not QUERY_CLASSIFIER_LOG_DECISIONS or label not in self.labels:
+            return
+        with self._lock:
+            os.makedirs(self.decisions_dir, exist_ok=True)
+            if os.path.exists(self.decisions_path) and \
+                    os.path.getsize(self.decisions_path) >= QUERY_CLASSIFIER_DECISIONS_MAX_BYTES:
+                metrics.inc("query_classifier_decisions_dropped", labels={"task": self.task})
+                return
+            with open(self.decisions_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+
+    def fit(self, examples: list[dict]) -> np.ndarray:
+        vectors = np.asarray(embeddings.embed_documents([e["text"] for e in examples]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        labels = np.array([e["label"] for e in examples])
+        centroids = []
+        for label in self.labels:
+            class_vectors = vectors[labels == label]
+            if len(class_vectors) == 0:
+                raise ValueError(f"нет примеров класса {label} для задачи {self.task}")
+            centroid = class_vectors.mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+        return np.stack(centroids)
+
+    def train(self, with_decisions: bool = False) -> int:
+        """Обучает центроиды и сохраняет их на диск, возвращает число примеров"""
+        examples = self.load_examples(with_decisions)
+        centroids = self.fit(examples)
+        os.makedirs(self.model_dir, exist_ok=True)
+        np.save(self.model_path, centroids)
+        with self._lock:
+            self._centroids = centroids
+            self._loaded = True
+        return len(examples)
+
+    @property
+    def centroids(self) -> np.ndarray | None:
+        with self._lock:
+            if not self._loaded:
+                self._centroids = np.load(self.model_path) if os.path.exists(self.model_path) else None
+                self._loaded = True
+            return self._centroids
+
+    def predict_vector(self, vector: np.ndarray, centroids: np.ndarray) -> tuple[str, float]:
+        similarities = centroids @ (vector / np.linalg.norm(vector))
+        logits = similarities / self.temperature
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    def predict(self, text: str) -> tuple[str, float] | None:
+        """Возвращает (метка, уверенность) или None, если классификатор выключен или не обучен"""
+        if not QUERY_CLASSIFIER_ENABLED:
+            return None
+        centroids = self.centroids
+        if centroids is None:
+            return None
+        vector = np.asarray(embeddings.embed_query(text), dtype=np.float32)
+        return self.predict_vector(vector, centroids)
+
+    def classify(self, text: str) -> str | None:
+        """Метка класса, если уверенность не ниже порога, иначе None - решение остается за LLM"""
+        prediction = self.predict(text)
+        if prediction is None:
+            return None
+        label, confidence = prediction
+        if confidence < self.min_confidence:
+            metrics.inc("query_classifier_fallbacks", labels={"task": self.task})
+            return None
+        metrics.inc("query_classifier_hits", labels={"task": self.task, "label": label})
+        return label
+
+    def evaluate(self, test_ratio: float = 0.3, seed: int = 0, with_decisions: bool = False) -> dict:
+        """Точность на отложенной выборке: по всем запросам и по тем, где уверенность выше порога"""
+        examples = self.load_examples(with_decisions)
+        random.Random(seed).shuffle(examples)
+        split = int(len(examples) * (1 - test_ratio))
+        train, test = examples[:split], examples[split:]
+        centroids = self.fit(train)
+        vectors = embeddings.embed_documents([e["text"] for e in test])
+        correct = confident = confident_correct = 0
+        for example, vector in zip(test, vectors):
+            label, confidence = self.predict_vector(np.asarray(vector, dtype=np.float32), centroids)
+            correct += label == example["label"]
+            if confidence >= self.min_confidence:
+                confident += 1
+                confident_correct += label == example["label"]
+        return {
+            "task": self.task,
+            "train": len(train),
+            "test": len(test),
+            "accuracy": round(correct / len(test), 3) if test else 0.0,
+            "coverage": round(confident / len(test), 3) if test else 0.0,
+            "confident_accuracy": round(confident_correct / confident, 3) if confident else 0.0,
+        }
+
+
+route_classifier = NearestCentroidClassifier("route")
+category_classifier = NearestCentroidClassifier("category")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обучение и оценка локального классификатора запросов")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--tasks", nargs="+", choices=list(TASK_LABELS), default=list(TASK_LABELS))
+    parser.add_argument("--with-decisions", action="store_true",
+                        help="добавить к примерам проверенный журнал решений LLM")
+    parser.add_argument("--test-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    for task in args.tasks:
+        classifier = NearestCentroidClassifier(task)
+        if args.command == "train":
+            print(task, "обучен на", classifier.train(with_decisions=args.with_decisions), "примерах")
+        else:
+            print(classifier.evaluate(test_ratio=args.test_ratio, with_decisions=args.with_decisions))
@@ -0,0 +1,66 @@
+import re
+import threading
+from typing import Optional
+
+from cachetools import LRUCache
+from langchain_core.documents import Document
+
+from src.database.repositories import workspaceVersionsCRUDRepository
+from src.rag_agent_api.config import RETRIEVAL_CACHE_MAX_SIZE
+from src.rag_agent_api.services.metrics_service import metrics
+
+
+class WorkspaceVersions:
+    """Счетчик версий содержимого рабочих пространств.
+    Версия увеличивается при любом изменении набора документов в пространстве,
+    все закэшированные по старой версии данные перестают использоваться.
+    Версии хранятся в таблице workspace_versions: кэши каждого процесса API сверяются с ней,
+    поэтому загрузка или удаление в одном процессе сбрасывает кэши всех процессов
+    """
+
+    @staticmethod
+    def get(user_id: int, workspace_id: int) -> int:
+        return workspaceVersionsCRUDRepository.select_version(int(user_id), int(workspace_id))
+
+    @staticmethod
+    def bump(user_id: int, workspace_id: int) -> int:
+        return workspaceVersionsCRUDRepository.increment_version(int(user_id), int(workspace_id))
+
+
+def normalize_query(query: str) -> str:
+    """Приводит запрос к нижнему регистру и схлопывает пробелы"""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class RetrievalCache:
+    """Ограниченный LRU кэш результатов поиска CustomRetriever.
+    Ключ: (user_id, workspace_id, версия пространства, belongs_to, нормализованный запрос)
+    """
+
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_MAX_SIZE):
+        self._lock = threading.Lock()
+        self._cache: LRUCache = LRUCache(maxsize=max_size)
+
+    @staticmethod
+    def make_key(user_id: int, workspace_id: int, belongs_to: Optional[str], query: str) -> tuple:
+        """Ключ фиксирует версию пространства на момент начала поиска,
+        поэтому результат, полученный во время изменения пространства, не попадет под новую версию
+        """
+        return (int(user_id), int(workspace_id), WorkspaceVersions.get(user_id, workspace_id),
+                belongs_to, normalize_query(query))
+
+    def get(self, key: tuple) -> list[Document] | None:
+        with self._lock:
+            docs = self._cache.get(key)
+        if docs is None:
+            metrics.inc("retrieval_cache_misses")
+            return None
+        metrics.inc("retrieval_cache_hits")
+        return [doc.model_copy(deep=True) for doc in docs]
+
+    def put(self, key: tuple, docs: list[Document]) -> None:
+        with self._lock:
+            self._cache[key] = [doc.model_copy(deep=True) for doc in docs]
+
+
+retrieval_cache = RetrievalCache()
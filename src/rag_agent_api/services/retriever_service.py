@@ -1,58 +1,186 @@
+import os
 from typing import Optional
 
 import chromadb
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from chromadb.errors import InvalidCollectionException
+import numpy as np
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.vectorstores import VectorStore
 
-from src.rag_agent_api.config import VEC_BASES
+from src.rag_agent_api.config import VEC_BASES, VEC_STORAGE_LAYOUT, SHARED_VEC_BASE_NAME
 from src.rag_agent_api.embeddings_init import embeddings, embedding_function
 from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
+from src.rag_agent_api.services.retrieval_cache_service import retrieval_cache
+from src.rag_agent_api.services.workspace_lock_service import user_store_lock, workspace_lock
 
 
 class CustomRetriever:
-    def __init__(self, vectorstore: VectorStore):
+    def __init__(self,
+                 vectorstore: VectorStore,
+                 user_id: Optional[int] = None,
+                 workspace_id: Optional[int] = None,
+                 search_kwargs: Optional[dict] = None):
         self.vectorstore = vectorstore
+        self.user_id = user_id
+        self.workspace_id = workspace_id
+        self.search_kwargs = {"k": 4, **(search_kwargs or {})}
 
     def get_relevant_documents(self, query: str, belongs_to: Optional[str] = None) -> list[Document]:
+        if self.user_id is None or self.workspace_id is None:
+            return self._search(query, belongs_to)
+        cache_key = retrieval_cache.make_key(self.user_id, self.workspace_id, belongs_to, query)
+        cached_docs = retrieval_cache.get(cache_key)
+        if cached_docs is not None:
+            return cached_docs
+        docs = self._search(query, belongs_to)
+        retrieval_cache.put(cache_key, docs)
+        return docs
+
+    def _search(self, query: str, belongs_to: Optional[str] = None) -> list[Document]:
         print("===================get docs++++++++++++++++++")
-        search_filter = {"belongs_to": belongs_to} if belongs_to else None
-        results = self.vectorstore.similarity_search_with_score(query, filter=search_filter)
-        collection_name = self.vectorstore._collection.name
-        user_id = collection_name.split('_')[1]
-        enriched_docs = []
+        results = self._search_in_file(query, belongs_to) if belongs_to else None
+        if results is None:
+            results = self._search_in_collection(query, {"belongs_to": belongs_to} if belongs_to else None)
+        # текст фрагмента и его соседей RagAgent читает из базы одним запросом по диапазонам номеров
+        docs = []
         for doc, score in results:
             doc.metadata["score"] = score
-            doc.metadata["source_chunk_content"] = self._get_source_chunk(int(user_id), doc.metadata)
-            enriched_docs.append(doc)
-        return enriched_docs
+            docs.append(doc)
+        return docs
+
+    def _search_in_collection(self, query: str, search_filter: Optional[dict]) -> list[tuple[Document, float]]:
+        """Поиск по индексу коллекции.
+        Индекс ранжирует в пространстве коллекции (по умолчанию квадрат L2), а score фрагмента - косинусное
+        расстояние, пересчитанное по векторам найденных фрагментов
+        """
+        collection = self.vectorstore._collection
+        query_embedding = np.asarray(self.vectorstore.embeddings.embed_query(query), dtype=np.float32)
+        found = collection.query(
+            query_embeddings=[query_embedding.tolist()],
+            n_results=self.search_kwargs["k"],
+            where=search_filter,
+            include=["embeddings", "documents", "metadatas"]
+        )
+        if len(found["ids"][0]) == 0:
+            return []
+        distances = _distances(query_embedding, np.asarray(found["embeddings"][0], dtype=np.float32), "cosine")
+        return [
+            (Document(page_content=found["documents"][0][i], metadata=found["metadatas"][0][i] or {},
+                      id=found["ids"][0][i]),
+             float(distances[i]))
+            for i in range(len(found["ids"][0]))
+        ]
+
+    def _search_in_file(self, query: str, belongs_to: str) -> list[tuple[Document, float]] | None:
+        """Поиск только среди векторов одного файла.
+        id векторов файла восстанавливаются по номерам его фрагментов, поэтому вместо фильтра по metadata
+        по всему пространству считаются расстояния только до векторов этого файла.
+        Ранжирование - в пространстве коллекции, score - косинусное расстояние, как в _search_in_collection.
+        Возвращает None, если файл был загружен до появления id-индекса (векторы со случайными id)
+        """
+        if self.user_id is None or self.workspace_id is None:
+            return None
+        doc_numbers = DocumentsGetterService.get_file_doc_numbers(self.user_id, self.workspace_id, belongs_to)
+        if not doc_numbers:
+            return None
+        collection = self.vectorstore._collection
+        found = collection.get(
+            ids=VectorDBManager.file_vector_ids(belongs_to, doc_numbers),
+            include=["embeddings", "documents", "metadatas"]
+        )
+        if len(found["ids"]) == 0:
+            return None
+
+        query_embedding = np.asarray(self.vectorstore.embeddings.embed_query(query), dtype=np.float32)
+        file_embeddings = np.asarray(found["embeddings"], dtype=np.float32)
+        distances = _distances(query_embedding, file_embeddings, (collection.metadata or {}).get("hnsw:space", "l2"))
+        best = np.argsort(distances)[:self.search_kwargs["k"]]
+        cosine_distances = _distances(query_embedding, file_embeddings[best], "cosine")
+        return [
+            (Document(page_content=found["documents"][i], metadata=found["metadatas"][i] or {}, id=found["ids"][i]),
+             float(distance))
+            for i, distance in zip(best, cosine_distances)
+        ]
 
-    def _get_source_chunk(self, user_id: int, metadata: dict) -> str:
-        return DocumentsGetterService.get_source_chunk(
-            user_id=user_id,
-            workspace_id=metadata["workspace_id"],
-            belongs_to=metadata["belongs_to"],
-            doc_number=metadata["doc_number"]
-        ).page_content
+
+def _distances(query: np.ndarray, embeddings: np.ndarray, space: str) -> np.ndarray:
+    """Расстояния в тех же единицах, что возвращает hnsw индекс Chroma для выбранного пространства"""
+    if space == "cosine":
+        norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query)
+        return 1.0 - embeddings @ query / np.maximum(norms, 1e-12)
+    if space == "ip":
+        return 1.0 - embeddings @ query
+    return np.sum((embeddings - query) ** 2, axis=1)
 
 
 class VectorDBManager:
+    @staticmethod
+    def vector_id(belongs_to: str, doc_number: int) -> str:
+        """id вектора фрагмента: по названию файла и номеру фрагмента можно найти все векторы файла без поиска по metadata"""
+        return f"{belongs_to}::{doc_number}"
+
+    @staticmethod
+    def file_vector_ids(belongs_to: str, doc_numbers: list[int]) -> list[str]:
+        return [VectorDBManager.vector_id(belongs_to, n) for n in doc_numbers]
+
+    @staticmethod
+    def user_client_path(user_id: int) -> str:
+        """Каталог хранилища пользователя в раскладке per_user"""
+        return os.path.join(VEC_BASES, f"chroma_db_{user_id}")
+
+    @staticmethod
+    def shared_client_path() -> str:
+        """Каталог общего хранилища всех пользователей в раскладке shared"""
+        return os.path.join(VEC_BASES, SHARED_VEC_BASE_NAME)
+
+    @staticmethod
+    def client_path(user_id: int) -> str:
+        if VEC_STORAGE_LAYOUT == "shared":
+            return VectorDBManager.shared_client_path()
+        return VectorDBManager.user_client_path(user_id)
+
+    @staticmethod
+    def get_client(user_id: int) -> ClientAPI:
+        """Клиент хранилища, в котором лежат коллекции пользователя.
+        Коллекции разделены по имени user_{user_id}_{workspace_id}, поэтому в раскладке shared
+        все пользователи работают через один клиент и одну базу
+        """
+        return chromadb.PersistentClient(path=VectorDBManager.client_path(user_id))
+
+    @staticmethod
+    def collection_name(user_id: int, workspace_id: int) -> str:
+        return f"user_{user_id}_{workspace_id}"
+
+    @staticmethod
+    def get_collection(user_id: int, workspace_id: int) -> Collection | None:
+        """Возвращает коллекцию пространства или None, если ее нет"""
+        try:
+            return VectorDBManager.get_client(user_id).get_collection(
+                VectorDBManager.collection_name(user_id, workspace_id))
+        except InvalidCollectionException:
+            return None
 
     @staticmethod
     def get_or_create_retriever(user_id: int, workspace_id: int):
-        collection_name = f"user_{user_id}_{workspace_id}"
-        client = chromadb.PersistentClient(path=rf"{VEC_BASES}/chroma_db_{user_id}")
-        if collection_name in [name for name in client.list_collections()]:
-            collection = client.get_collection(collection_name)
-        else:
-            collection = client.create_collection(collection_name)
+        """Коллекция создается под блокировкой пространства: пока сборщик мусора подменяет коллекцию
+        пересобранной, ее нет под своим именем, и без блокировки здесь создалась бы пустая
+        """
+        client = VectorDBManager.get_client(user_id)
+        collection = VectorDBManager.get_collection(user_id, workspace_id)
+        if collection is None:
+            with workspace_lock(user_id, workspace_id), user_store_lock(user_id):
+                collection = client.get_or_create_collection(VectorDBManager.collection_name(user_id, workspace_id))
 
         vec_store = Chroma(
             collection_name=collection.name,
             embedding_function=embeddings,
-            client=client
+            client=client,
+            create_collection_if_not_exists=False
         )
-        return CustomRetriever(vec_store)
+        return CustomRetriever(vec_store, user_id, workspace_id)
 
     @staticmethod
     def _copy_collection_to_user(source_user_id: int,
@@ -60,8 +188,8 @@ class VectorDBManager:
                                  target_user_id: int,
                                  target_collection_name: str
                                  ) -> bool:
-        source_client = chromadb.PersistentClient(path=f"{VEC_BASES}/chroma_db_{source_user_id}")
-        target_client = chromadb.PersistentClient(path=f"{VEC_BASES}/chroma_db_{target_user_id}")
+        source_client = VectorDBManager.get_client(source_user_id)
+        target_client = VectorDBManager.get_client(target_user_id)
 
         if source_collection_name not in [name for name in source_client.list_collections()]:
             raise ValueError(f"коллекция не найдена у пользователя {source_user_id}")
@@ -69,10 +197,11 @@ class VectorDBManager:
         source_collection = source_client.get_collection(source_collection_name)
         source_data = source_collection.get()
 
-        target_collection = target_client.get_or_create_collection(
-            target_collection_name,
-            embedding_function=embedding_function
-        )
+        with user_store_lock(target_user_id):
+            target_collection = target_client.get_or_create_collection(
+                target_collection_name,
+                embedding_function=embedding_function
+            )
         target_collection.add(
             ids=source_data["ids"],
             documents=source_data["documents"],
@@ -85,7 +214,7 @@ class VectorDBManager:
     def copy_collection(source_user_id: int, source_workspace_id: int, target_user_id: int, target_workspace_id: int):
         return VectorDBManager._copy_collection_to_user(
             source_user_id=source_user_id,
-            source_collection_name=f"user_{source_user_id}_{source_workspace_id}",
+            source_collection_name=VectorDBManager.collection_name(source_user_id, source_workspace_id),
             target_user_id=target_user_id,
-            target_collection_name=f"user_{target_user_id}_{target_workspace_id}"
+            target_collection_name=VectorDBManager.collection_name(target_user_id, target_workspace_id)
         )
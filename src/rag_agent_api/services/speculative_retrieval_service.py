@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from langchain_core.documents import Document
+
+from src.rag_agent_api.services.metrics_service import metrics
+
+
+class SpeculativeRetrieval:
+    """Поиск документов по исходному вопросу, запущенный одновременно с выбором агента.
+    Если выбран RagAgent, найденные документы передаются ему вместо повторного поиска,
+    иначе результат отбрасывается. Время, скрытое за выбором агента, пишется в гистограмму
+    speculative_retrieval_saved_seconds, доля отброшенных запусков - discarded / started
+    """
+
+    def __init__(self, retriever, query: str, belongs_to: str | None):
+        self.started_at = time.perf_counter()
+        self.finished_at: float | None = None
+        self._task = asyncio.create_task(asyncio.to_thread(self._search, retriever, query, belongs_to))
+        # ошибка отброшенного поиска не должна попадать в лог как необработанная
+        self._task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        metrics.inc("speculative_retrieval_started")
+
+    def _search(self, retriever, query: str, belongs_to: str | None) -> list[Document]:
+        try:
+            return retriever.get_relevant_documents(query, belongs_to)
+        finally:
+            self.finished_at = time.perf_counter()
+
+    async def take(self) -> list[Document] | None:
+        """Дожидается поиска и возвращает документы, None - если поиск завершился ошибкой"""
+        waited_from = time.perf_counter()
+        try:
+            documents = await self._task
+        except Exception as e:
+            print("ошибка опережающего поиска", e)
+            metrics.inc("speculative_retrieval_failed")
+            return None
+        # выигрыш - часть поиска, выполненная до того, как RagAgent понадобились документы
+        saved = max(0.0, min(self.finished_at, waited_from) - self.started_at)
+        metrics.inc("speculative_retrieval_used")
+        metrics.observe("speculative_retrieval_saved_seconds", saved)
+        return documents
+
+    def discard(self) -> None:
+        """Отменяет ожидание поиска: поток дорабатывает в фоне, результат не используется"""
+        self._task.cancel()
+        metrics.inc("speculative_retrieval_discarded")
@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import time
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from src.rag_agent_api.services.metrics_service import metrics
+
+# трассировки пишутся в stdout отдельным логгером, по одной JSON строке на запрос
+logger = logging.getLogger("rag_agent_api.trace")
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# поля состояния, по которым считается число фрагментов, прошедших через узел
+DOCUMENT_FIELDS = ("retrieved_chunks", "neighboring_chunks", "speculative_chunks")
+
+
+def token_usage(response: LLMResult) -> tuple[int, int]:
+    """Токены запроса и ответа вызова LLM"""
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+    if not prompt_tokens and not completion_tokens:
+        # модели без usage_metadata возвращают расход в llm_output словарем или объектом
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        get = usage.get if isinstance(usage, dict) else lambda name, default: getattr(usage, name, default)
+        prompt_tokens, completion_tokens = get("prompt_tokens", 0), get("completion_tokens", 0)
+    return prompt_tokens or 0, completion_tokens or 0
+
+
+def _node_path(checkpoint_ns: str) -> str:
+    """'rag_agent:<id>|retrieve_documents:<id>' -> 'rag_agent/retrieve_documents'"""
+    return "/".join(part.split(":")[0] for part in checkpoint_ns.split("|") if part)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Трассировка одного запроса через callbacks LangGraph.
+    Для каждого выполнения узла (в том числе узлов вложенных графов) записывает время выполнения,
+    токены запросов и ответов LLM, вызванных внутри узла, и число документов в ответе узла.
+    LLM вызовы вне узлов графа (PlanAndExecuteAgent) записываются отдельными записями,
+    имя берется из metadata["trace_node"]
+    """
+    run_inline = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+        self._spans: dict[str, dict[str, Any]] = {}
+        self._node_runs: dict[UUID, str] = {}
+        self._llm_runs: dict[UUID, tuple[str, float]] = {}
+
+    def on_chain_start(self, serialized: dict[str, Any] | None, inputs: Any, *, run_id: UUID,
+                       metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        metadata = metadata or {}
+        node = metadata.get("langgraph_node")
+        if node is None or kwargs.get("name") != node or node.startswith("__"):
+            return
+        checkpoint_ns = metadata.get("langgraph_checkpoint_ns", node)
+        with self._lock:
+            self._node_runs[run_id] = checkpoint_ns
+            self._spans[checkpoint_ns] = {
+                "node": _node_path(checkpoint_ns),
+                "start_s": round(time.perf_counter() - self._started_at, 4),
+                "duration_s": None,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "llm_calls": 0,
+            }
+
+    def _end_node(self, run_id: UUID, outputs: Any = None, error: BaseException | None = None) -> None:
+        with self._lock:
+            checkpoint_ns = self._node_runs.pop(run_id, None)
+            if checkpoint_ns is None:
+                return
+            span = self._spans[checkpoint_ns]
+            span["duration_s"] = round(time.perf_counter() - self._started_at - span["start_s"], 4)
+            if isinstance(outputs, dict):
+                for field in DOCUMENT_FIELDS:
+                    if isinstance(outputs.get(field), list):
+                        span[field] = len(outputs[field])
+            if error is not None:
+                span["error"] = repr(error)
+        metrics.observe("node_latency_seconds", span["duration_s"], {"node": span["node"]})
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_node(run_id, outputs=outputs)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_node(run_id, error=error)
+
+    def on_chat_model_start(self, serialized: dict[str, Any] | None, messages: Any, *, run_id: UUID,
+                            metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        metadata = metadata or {}
+        key = metadata.get("langgraph_checkpoint_ns") or metadata.get("trace_node", "llm")
+        with self._lock:
+            self._llm_runs[run_id] = (key, time.perf_counter())
+
+    def on_llm_start(self, serialized: dict[str, Any] | None, prompts: list[str], *, run_id: UUID,
+                     metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        self.on_chat_model_start(serialized, prompts, run_id=run_id, metadata=metadata, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        prompt_tokens, completion_tokens = token_usage(response)
+        with self._lock:
+            key, started_at = self._llm_runs.pop(run_id, (None, None))
+            if key is None:
+                return
+            span = self._spans.get(key)
+            if span is None:
+                # вызов LLM вне узла графа - отдельная запись
+                span = self._spans[f"{key}:{run_id}"] = {
+                    "node": key,
+                    "start_s": round(started_at - self._started_at, 4),
+                    "duration_s": round(time.perf_counter() - started_at, 4),
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "llm_calls": 0,
+                }
+                metrics.observe("node_latency_seconds", span["duration_s"], {"node": key})
+            span["prompt_tokens"] += prompt_tokens
+            span["completion_tokens"] += completion_tokens
+            span["llm_calls"] += 1
+            node = span["node"]
+        metrics.inc("llm_prompt_tokens", prompt_tokens, {"node": node})
+        metrics.inc("llm_completion_tokens", completion_tokens, {"node": node})
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._llm_runs.pop(run_id, None)
+
+    def trace(self) -> list[dict[str, Any]]:
+        """Записи трассировки в порядке начала выполнения"""
+        with self._lock:
+            return sorted((dict(span) for span in self._spans.values()), key=lambda span: span["start_s"])
+
+    def log(self, **fields: Any) -> None:
+        """Пишет трассировку запроса одной структурированной записью в лог rag_agent_api.trace"""
+        spans = self.trace()
+        logger.info(json.dumps({
+            **fields,
+            "total_s": round(time.perf_counter() - self._started_at, 4),
+            "prompt_tokens": sum(span["prompt_tokens"] for span in spans),
+            "completion_tokens": sum(span["completion_tokens"] for span in spans),
+            "spans": spans,
+        }, ensure_ascii=False, default=str))
@@ -0,0 +1,294 @@
+"""Сборка мусора и уплотнение векторных хранилищ.
+
+Запуск из командной строки:
+    python -m src.rag_agent_api.services.vector_gc_service [--dry-run]
+"""
+import argparse
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, Optional
+
+import chromadb
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from filelock import FileLock, Timeout
+
+from src.database.repositories import chunksCRUDRepository, filesCRUDRepository, workSpaceCRUDRepository
+from src.rag_agent_api.config import (
+    VEC_BASES,
+    SHARED_VEC_BASE_NAME,
+    GC_BATCH_SIZE,
+    GC_COMPACT_DELETED_RATIO,
+    GC_LOCK_TIMEOUT_SECONDS
+)
+from src.rag_agent_api.services.workspace_lock_service import user_store_lock, workspace_lock
+
+_USER_DIR_PATTERN = re.compile(r"^chroma_db_(\d+)$")
+_COLLECTION_PATTERN = re.compile(r"^user_(\d+)_(\d+)$")
+
+
+class GCReport(NamedTuple):
+    dry_run: bool
+    orphan_chunks: int
+    orphan_vectors: int
+    orphan_collections: int
+    removed_directories: int
+    compacted_collections: int
+    bytes_reclaimed: int
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def count_store_collections(path: str) -> int | None:
+    """Число коллекций в хранилище по его sqlite базе, без запуска chromadb клиента.
+    Клиент кэширует открытую базу на весь процесс, поэтому каталог, открытый клиентом, нельзя удалять.
+    None, если в каталоге нет базы
+    """
+    db_path = os.path.join(path, "chroma.sqlite3")
+    if not os.path.exists(db_path):
+        return None
+    connection = sqlite3.connect(db_path)
+    try:
+        return connection.execute("SELECT COUNT(*) FROM collections").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        connection.close()
+
+
+def index_size(path: str, collection: Collection) -> Optional[int]:
+    """Число элементов в сохраненном HNSW индексе коллекции, включая помеченные удаленными.
+    Chroma не убирает удаленные элементы из индекса и не переиспользует их метки, поэтому
+    index_size - count() - число мертвых элементов. Читается из метаданных индекса chromadb 0.6
+    (index_metadata.pickle в каталоге векторного сегмента). None, если индекс еще не сохранен на диск
+    или формат не распознан
+    """
+    connection = sqlite3.connect(os.path.join(path, "chroma.sqlite3"))
+    try:
+        row = connection.execute("SELECT id FROM segments WHERE collection = ? AND scope = 'VECTOR'",
+                                 (str(collection.id),)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    metadata_path = os.path.join(path, row[0], "index_metadata.pickle")
+    if not os.path.exists(metadata_path):
+        return None
+    try:
+        with open(metadata_path, "rb") as f:
+            return int(pickle.load(f).total_elements_added)
+    except (pickle.UnpicklingError, AttributeError, EOFError, ImportError) as e:
+        print("не удалось прочитать метаданные индекса", metadata_path, e)
+        return None
+
+
+class VectorGarbageCollector:
+    """Находит и удаляет данные, оставшиеся после удаления файлов и пространств:
+    - фрагменты в Postgres, для которых нет файла в пространстве;
+    - коллекции Chroma удаленных пространств;
+    - векторы удаленных файлов в живых коллекциях;
+    - пустые каталоги chroma_db_{user_id}.
+    Обрабатываются обе раскладки хранилищ: каталоги пользователей и общее хранилище.
+    Каждое пространство обрабатывается под его блокировкой (workspace_lock), под которой API записывает
+    фрагменты, векторы и файл, поэтому загружаемый файл не считается удаленным. Занятые пространства
+    пропускаются до следующего запуска.
+    Коллекция пересобирается, когда удаленные элементы составляют compact_deleted_ratio HNSW индекса.
+    Пустые каталоги пользователей удаляются до открытия клиентов, под блокировкой каталога (user_store_lock),
+    под которой API создает коллекции, поэтому каталог, опустевший за текущий запуск, удаляется следующим
+    """
+
+    def __init__(self, dry_run: bool = False, batch_size: int = GC_BATCH_SIZE,
+                 compact_deleted_ratio: float = GC_COMPACT_DELETED_RATIO,
+                 lock_timeout: float = GC_LOCK_TIMEOUT_SECONDS):
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.compact_deleted_ratio = compact_deleted_ratio
+        self.lock_timeout = lock_timeout
+
+    def run(self) -> GCReport:
+        size_before = _dir_size(VEC_BASES)
+        orphan_chunks = self.collect_orphan_chunks()
+        orphan_vectors, orphan_collections, removed_directories, compacted = self.collect_vector_stores()
+        bytes_reclaimed = 0 if self.dry_run else max(size_before - _dir_size(VEC_BASES), 0)
+        return GCReport(self.dry_run, orphan_chunks, orphan_vectors, orphan_collections, removed_directories,
+                        compacted, bytes_reclaimed)
+
+    @contextmanager
+    def _locked(self, lock: FileLock) -> Iterator[bool]:
+        """Блокировка пространства или каталога хранилища на время обработки. В режиме dry_run ничего
+        не удаляется и блокировка не берется. Возвращает False, если блокировка занята дольше lock_timeout
+        """
+        if self.dry_run:
+            yield True
+            return
+        try:
+            lock.acquire(timeout=self.lock_timeout)
+        except Timeout:
+            print("блокировка занята, пропускаем до следующего запуска", lock.lock_file)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
+
+    def collect_orphan_chunks(self) -> int:
+        """Удаляет пачками фрагменты без файла, по пространствам под их блокировкой"""
+        if self.dry_run:
+            return chunksCRUDRepository.count_orphan_chunks()
+        total = 0
+        for user_id, workspace_id in chunksCRUDRepository.select_orphan_chunk_workspaces():
+            with self._locked(workspace_lock(user_id, workspace_id)) as acquired:
+                if not acquired:
+                    continue
+                while True:
+                    ids = chunksCRUDRepository.select_orphan_chunk_ids(user_id, workspace_id, self.batch_size)
+                    if not ids:
+                        break
+                    total += len(ids)
+                    chunksCRUDRepository.delete_chunks_by_ids(ids)
+                    if len(ids) < self.batch_size:
+                        break
+        return total
+
+    def collect_vector_stores(self) -> tuple[int, int, int, int]:
+        orphan_vectors = orphan_collections = removed_directories = compacted = 0
+        if not os.path.isdir(VEC_BASES):
+            return orphan_vectors, orphan_collections, removed_directories, compacted
+
+        workspaces = {(space.user_id, space.id) for space in workSpaceCRUDRepository.select_all()}
+        for path, is_user_dir in self._store_paths():
+            if is_user_dir and count_store_collections(path) == 0:
+                if self._remove_empty_user_dir(path):
+                    removed_directories += 1
+                continue
+
+            client = chromadb.PersistentClient(path=path)
+            for collection_name in client.list_collections():
+                name_match = _COLLECTION_PATTERN.match(collection_name)
+                if not name_match:
+                    continue
+                key = (int(name_match.group(1)), int(name_match.group(2)))
+                with self._locked(workspace_lock(*key)) as acquired:
+                    if not acquired:
+                        continue
+                    if key not in workspaces and (self.dry_run or not workSpaceCRUDRepository.exists_workspace(*key)):
+                        orphan_collections += 1
+                        if not self.dry_run:
+                            client.delete_collection(collection_name)
+                        continue
+                    collection = client.get_collection(collection_name)
+                    orphan_vectors += self._collect_orphan_vectors(collection, *key)
+                    if not self.dry_run and self._needs_compaction(path, collection):
+                        self._compact_collection(client, collection_name)
+                        compacted += 1
+
+            if not self.dry_run:
+                self._vacuum(path)
+        return orphan_vectors, orphan_collections, removed_directories, compacted
+
+    def _remove_empty_user_dir(self, path: str) -> bool:
+        """Удаляет каталог пользователя без коллекций. Пустота перепроверяется под блокировкой каталога:
+        коллекция могла появиться при первой загрузке пользователя после первой проверки
+        """
+        user_id = int(_USER_DIR_PATTERN.match(os.path.basename(path)).group(1))
+        with self._locked(user_store_lock(user_id)) as acquired:
+            if not acquired or count_store_collections(path) != 0:
+                return False
+            if not self.dry_run:
+                shutil.rmtree(path, ignore_errors=True)
+            return True
+
+    def _needs_compaction(self, path: str, collection: Collection) -> bool:
+        """Доля удаленных элементов в HNSW индексе не меньше compact_deleted_ratio"""
+        size = index_size(path, collection)
+        if not size:
+            return False
+        return (size - collection.count()) / size >= self.compact_deleted_ratio
+
+    @staticmethod
+    def _store_paths() -> list[tuple[str, bool]]:
+        """Каталоги хранилищ в VEC_BASES: (путь, является ли каталог хранилищем одного пользователя)"""
+        paths = []
+        for dir_name in sorted(os.listdir(VEC_BASES)):
+            if _USER_DIR_PATTERN.match(dir_name):
+                paths.append((os.path.join(VEC_BASES, dir_name), True))
+            elif dir_name == SHARED_VEC_BASE_NAME:
+                paths.append((os.path.join(VEC_BASES, dir_name), False))
+        return paths
+
+    def _collect_orphan_vectors(self, collection: Collection, user_id: int, workspace_id: int) -> int:
+        """Удаляет векторы файлов, которых больше нет в пространстве. Возвращает число удаленных векторов"""
+        file_names = {f.file_name for f in filesCRUDRepository.select_all_by_user_id_and_work_space_id(user_id,
+                                                                                                       workspace_id)}
+        total = collection.count()
+        orphan_ids = []
+        for offset in range(0, total, self.batch_size):
+            batch = collection.get(include=["metadatas"], limit=self.batch_size, offset=offset)
+            orphan_ids.extend(
+                id for id, metadata in zip(batch["ids"], batch["metadatas"])
+                if (metadata or {}).get("belongs_to") not in file_names
+            )
+        if not self.dry_run:
+            for i in range(0, len(orphan_ids), self.batch_size):
+                collection.delete(ids=orphan_ids[i: i + self.batch_size])
+        return len(orphan_ids)
+
+    def _compact_collection(self, client: ClientAPI, collection_name: str) -> None:
+        """Пересобирает коллекцию во временную и подменяет ею исходную:
+        новый HNSW индекс строится только по живым векторам.
+        Вызывается под блокировкой пространства: записи в коллекцию во время копирования невозможны,
+        а API, не найдя коллекцию между удалением и переименованием, ждет блокировку, а не создает пустую.
+        У пересобранной коллекции новый id, API получает коллекцию по имени на каждый запрос
+        """
+        source = client.get_collection(collection_name)
+        tmp_name = f"{collection_name}_compact"
+        if tmp_name in client.list_collections():
+            client.delete_collection(tmp_name)
+        target = client.create_collection(tmp_name, metadata=source.metadata)
+        for offset in range(0, source.count(), self.batch_size):
+            batch = source.get(include=["embeddings", "documents", "metadatas"], limit=self.batch_size,
+                               offset=offset)
+            target.add(ids=batch["ids"], embeddings=batch["embeddings"], documents=batch["documents"],
+                       metadatas=batch["metadatas"])
+        client.delete_collection(collection_name)
+        target.modify(name=collection_name)
+
+    @staticmethod
+    def _vacuum(path: str) -> None:
+        db_path = os.path.join(path, "chroma.sqlite3")
+        if not os.path.exists(db_path):
+            return
+        connection = sqlite3.connect(db_path)
+        try:
+            connection.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            print("не удалось выполнить VACUUM", db_path, e)
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка мусора в векторных хранилищах и таблице фрагментов")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать мусор, ничего не удалять")
+    parser.add_argument("--batch-size", type=int, default=GC_BATCH_SIZE)
+    args = parser.parse_args()
+
+    report = VectorGarbageCollector(dry_run=args.dry_run, batch_size=args.batch_size).run()
+    for field, value in report._asdict().items():
+        print(f"{field}: {value}")
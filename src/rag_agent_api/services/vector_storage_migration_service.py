@@ -0,0 +1,82 @@
+"""Перенос коллекций из раскладки per_user (chroma_db_{user_id}) в общее хранилище.
+
+Запуск из командной строки:
+    python -m src.rag_agent_api.services.vector_storage_migration_service [--remove-source]
+
+После переноса нужно переключить VEC_STORAGE_LAYOUT = "shared" в config.py.
+С --remove-source перенесенные коллекции удаляются из каталогов пользователей, а опустевшие каталоги
+удаляет vector_gc_service.
+Повторный запуск безопасен: векторы переносятся через upsert с теми же id.
+"""
+import argparse
+import os
+import re
+from typing import NamedTuple
+
+import chromadb
+
+from src.rag_agent_api.config import VEC_BASES, SHARED_VEC_BASE_NAME, GC_BATCH_SIZE
+
+_USER_DIR_PATTERN = re.compile(r"^chroma_db_\d+$")
+
+
+class MigrationReport(NamedTuple):
+    user_directories: int
+    collections: int
+    vectors: int
+    cleared_directories: int
+
+
+class VectorStorageMigrationService:
+    def __init__(self, batch_size: int = GC_BATCH_SIZE, remove_source: bool = False):
+        self.batch_size = batch_size
+        self.remove_source = remove_source
+
+    def migrate(self) -> MigrationReport:
+        target_client = chromadb.PersistentClient(path=os.path.join(VEC_BASES, SHARED_VEC_BASE_NAME))
+        user_directories = collections = vectors = cleared = 0
+        for dir_name in sorted(os.listdir(VEC_BASES)):
+            if not _USER_DIR_PATTERN.match(dir_name):
+                continue
+            path = os.path.join(VEC_BASES, dir_name)
+            source_client = chromadb.PersistentClient(path=path)
+            user_directories += 1
+            migrated_all = True
+            for collection_name in source_client.list_collections():
+                source = source_client.get_collection(collection_name)
+                target = target_client.get_or_create_collection(collection_name, metadata=source.metadata)
+                vectors += self._copy(source, target)
+                collections += 1
+                if target.count() < source.count():
+                    print("коллекция перенесена не полностью", dir_name, collection_name)
+                    migrated_all = False
+
+            if self.remove_source and migrated_all:
+                for collection_name in source_client.list_collections():
+                    source_client.delete_collection(collection_name)
+                cleared += 1
+        return MigrationReport(user_directories, collections, vectors, cleared)
+
+    def _copy(self, source, target) -> int:
+        copied = 0
+        for offset in range(0, source.count(), self.batch_size):
+            batch = source.get(include=["embeddings", "documents", "metadatas"], limit=self.batch_size,
+                               offset=offset)
+            if not batch["ids"]:
+                break
+            target.upsert(ids=batch["ids"], embeddings=batch["embeddings"], documents=batch["documents"],
+                          metadatas=batch["metadatas"])
+            copied += len(batch["ids"])
+        return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос векторных хранилищ пользователей в общее хранилище")
+    parser.add_argument("--remove-source", action="store_true",
+                        help="удалить коллекции из каталогов chroma_db_{user_id} после успешного переноса")
+    parser.add_argument("--batch-size", type=int, default=GC_BATCH_SIZE)
+    args = parser.parse_args()
+
+    report = VectorStorageMigrationService(batch_size=args.batch_size, remove_source=args.remove_source).migrate()
+    for field, value in report._asdict().items():
+        print(f"{field}: {value}")
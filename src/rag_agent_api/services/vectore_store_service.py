@@ -1,14 +1,15 @@
 import re
 from typing import List, NamedTuple
 
-import chromadb
 from langchain.schema.document import Document
 
-from src.rag_agent_api.config import VEC_BASES
+from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
+from src.rag_agent_api.services.database.documents_remove_service import DocumentsRemoveService
 from src.rag_agent_api.services.database.documents_saver_service import DocumentsSaverService
 from src.rag_agent_api.services.llm_model_service import LLMModelService, SummarizeContentAndDocs
-from src.rag_agent_api.services.retriever_service import CustomRetriever
+from src.rag_agent_api.services.retriever_service import CustomRetriever, VectorDBManager
 from src.rag_agent_api.services.text_splitter_service import TextSplitterService
+from src.rag_agent_api.services.workspace_lock_service import workspace_lock
 
 
 class SummDocsWithSourceAndIds(NamedTuple):
@@ -89,31 +90,61 @@ class VecStoreService:
             return context
         return self.model_service.get_super_brief_content(context, self._define_brief_max_word(context))
 
+    def _delete_previous_upload(self) -> None:
+        """Удаляет векторы, фрагменты и запись ранее загруженного файла с тем же названием.
+        id векторов детерминированы, поэтому при повторной загрузке add_documents перезаписывает только
+        совпавшие номера, а векторы и фрагменты сверх нового числа остались бы в хранилищах.
+        Вызывать под блокировкой пространства до сохранения новых фрагментов
+        """
+        doc_numbers = DocumentsGetterService.get_file_doc_numbers(self.user_id, self.work_space_id, self.file_name)
+        if doc_numbers:
+            ids = VectorDBManager.file_vector_ids(self.file_name, sorted(set(doc_numbers)))
+            self.retriever.vectorstore.delete(ids=ids)
+        DocumentsRemoveService.delete_chunks_by_file(self.user_id, self.work_space_id, self.file_name)
+        DocumentsRemoveService.delete_files_by_name(self.user_id, self.work_space_id, self.file_name)
+
     def save_docs_and_add_in_retriever(self) -> tuple[str, str] | Exception:
+        """Сохраняет фрагменты, векторы и файл.
+        Краткое содержание считается до записи, а запись идет под блокировкой пространства:
+        сборщик мусора не увидит фрагменты и векторы файла, для которого еще нет строки в files
+        """
         chunks = self.get_chunks()
         chunks_with_metadata = self.add_metadata_to_chunks(chunks)
         summarized_chunks = self.get_summarize_chunks(chunks)
-        ids_chunks = DocumentsSaverService.save_chunks(self.user_id, self.work_space_id, chunks_with_metadata)
-        summarized_chunks_with_metadata = self.add_metadata_to_summarized(summarized_chunks, ids_chunks)
-        self.retriever.vectorstore.add_documents(summarized_chunks_with_metadata)
         super_brief_content = self.super_brief_content(
-            self.get_documents_without_add_questions(summarized_chunks_with_metadata))
-        if super_brief_content:
-            return self.file_name, super_brief_content
-        return super_brief_content
+            self.get_documents_without_add_questions([Document(page_content=summ) for summ in summarized_chunks]))
+        if not super_brief_content or isinstance(super_brief_content, Exception):
+            return super_brief_content
+        with workspace_lock(self.user_id, self.work_space_id):
+            self._delete_previous_upload()
+            ids_chunks = DocumentsSaverService.save_chunks(self.user_id, self.work_space_id, chunks_with_metadata)
+            summarized_chunks_with_metadata = self.add_metadata_to_summarized(summarized_chunks, ids_chunks)
+            self.retriever.vectorstore.add_documents(
+                summarized_chunks_with_metadata,
+                ids=[VectorDBManager.vector_id(self.file_name, doc.metadata["doc_number"])
+                     for doc in summarized_chunks_with_metadata]
+            )
+            DocumentsSaverService.save_file(self.user_id, self.work_space_id, self.file_name, super_brief_content)
+        return self.file_name, super_brief_content
 
     @staticmethod
     def clear_vector_stores(user_id: int, workspace_id: int):
         """Удаляет векторное хранилище пользователя"""
-        collection_name = f"user_{user_id}_{workspace_id}"
-        client = chromadb.PersistentClient(path=rf"{VEC_BASES}\chroma_db_{user_id}")
-        if collection_name in [name for name in client.list_collections()]:
-            client.delete_collection(collection_name)
+        if VectorDBManager.get_collection(user_id, workspace_id) is not None:
+            client = VectorDBManager.get_client(user_id)
+            client.delete_collection(VectorDBManager.collection_name(user_id, workspace_id))
 
     @staticmethod
     def delete_file_from_vecstore(user_id: int, workspace_id: int, belongs_to: str):
-        collection_name = f"user_{user_id}_{workspace_id}"
-        client = chromadb.PersistentClient(path=rf"{VEC_BASES}\chroma_db_{user_id}")
-        if collection_name in [name for name in client.list_collections()]:
-            collection = client.get_collection(collection_name)
-            collection.delete(where={"belongs_to": belongs_to})
+        """Удаляет векторы файла по списку id, построенному из номеров его фрагментов.
+        Вызывать до удаления фрагментов файла из базы.
+        Для файлов, загруженных до появления id-индекса, удаляет по фильтру metadata
+        """
+        collection = VectorDBManager.get_collection(user_id, workspace_id)
+        if collection is not None:
+            doc_numbers = DocumentsGetterService.get_file_doc_numbers(user_id, workspace_id, belongs_to)
+            ids = VectorDBManager.file_vector_ids(belongs_to, doc_numbers)
+            if ids and len(collection.get(ids=ids, include=[])["ids"]) > 0:
+                collection.delete(ids=ids)
+            else:
+                collection.delete(where={"belongs_to": belongs_to})
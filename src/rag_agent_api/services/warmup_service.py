@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+from cachetools import TTLCache
+
+from src.rag_agent_api.config import (
+    WARMUP_MAX_CONCURRENCY,
+    WARMUP_MAX_PENDING,
+    WARMUP_COOLDOWN_SECONDS,
+    WARMUP_MAX_WORKSPACES_PER_USER
+)
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
+from src.rag_agent_api.services.database.messages_service import MessagesService
+from src.rag_agent_api.services.database.workspaces_service import WorkspacesService
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.retriever_service import VectorDBManager
+
+
+class WorkspaceWarmupService:
+    """Фоновый прогрев пространств: открывает коллекцию Chroma и загружает HNSW индекс пробным запросом,
+    прогревает модель эмбеддингов, заранее кладет в кэши историю сообщений и список файлов.
+    Одновременно прогревается не больше max_concurrency пространств, а очередь ограничена max_pending,
+    поэтому волна логинов не поднимает в память все хранилища разом
+    """
+
+    def __init__(self,
+                 max_concurrency: int = WARMUP_MAX_CONCURRENCY,
+                 max_pending: int = WARMUP_MAX_PENDING,
+                 cooldown_seconds: int = WARMUP_COOLDOWN_SECONDS):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending: set[tuple[int, int]] = set()
+        self._recently_warmed: TTLCache = TTLCache(maxsize=10_000, ttl=cooldown_seconds)
+        self._tasks: set[asyncio.Task] = set()
+
+    def schedule_user(self, user_id: int) -> None:
+        """Прогрев последних пространств пользователя после входа"""
+        self._tasks_add(asyncio.create_task(self._schedule_user(user_id)))
+
+    async def _schedule_user(self, user_id: int) -> None:
+        workspaces = await asyncio.to_thread(WorkspacesService.get_all_user_workspaces, user_id)
+        latest = sorted(workspaces, key=lambda space: space.workspace_id, reverse=True)
+        self.schedule(user_id, [space.workspace_id for space in latest])
+
+    def schedule(self, user_id: int, workspace_ids: list[int]) -> None:
+        """Ставит в очередь прогрев не более WARMUP_MAX_WORKSPACES_PER_USER пространств пользователя"""
+        for workspace_id in workspace_ids[:WARMUP_MAX_WORKSPACES_PER_USER]:
+            key = (int(user_id), int(workspace_id))
+            with self._lock:
+                if key in self._pending or key in self._recently_warmed:
+                    continue
+                if len(self._pending) >= self._max_pending:
+                    metrics.inc("warmup_skipped")
+                    return
+                self._pending.add(key)
+            self._tasks_add(asyncio.create_task(self._warm(*key)))
+
+    def _tasks_add(self, task: asyncio.Task) -> None:
+        # ссылка на задачу держится до ее завершения, иначе сборщик мусора может ее удалить
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm(self, user_id: int, workspace_id: int) -> None:
+        try:
+            async with self._semaphore:
+                await asyncio.to_thread(self.warm_workspace, user_id, workspace_id)
+            metrics.inc("warmup_completed")
+            with self._lock:
+                self._recently_warmed[(user_id, workspace_id)] = True
+        except Exception as e:
+            metrics.inc("warmup_failed")
+            print("ошибка прогрева пространства", user_id, workspace_id, e)
+        finally:
+            with self._lock:
+                self._pending.discard((user_id, workspace_id))
+
+    @staticmethod
+    def warm_workspace(user_id: int, workspace_id: int) -> None:
+        retriever = VectorDBManager.get_or_create_retriever(user_id, workspace_id)
+        query_embedding = embeddings.embed_query("прогрев")
+        if retriever.vectorstore._collection.count() > 0:
+            retriever.vectorstore.similarity_search_by_vector(query_embedding, k=1)
+        MessagesService.get_user_messages(user_id, workspace_id)
+        DocumentsGetterService.get_files_ids_names(user_id, workspace_id)
+
+
+warmup_service = WorkspaceWarmupService()
@@ -0,0 +1,95 @@
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+from cachetools import TTLCache
+from langchain_core.documents import Document
+
+from src.rag_agent_api.config import (
+    WORKING_SET_TTL_SECONDS,
+    WORKING_SET_MAX_CONVERSATIONS,
+    WORKING_SET_MIN_SIMILARITY,
+    WORKING_SET_MIN_COVERED_RATIO
+)
+from src.rag_agent_api.embeddings_init import embeddings
+from src.rag_agent_api.services.metrics_service import metrics
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
+
+
+class WorkingSet(NamedTuple):
+    version: int
+    belongs_to: Optional[str]
+    documents: list[Document]
+    embeddings: np.ndarray
+
+
+class ConversationWorkingSets:
+    """Фрагменты, на которых RagAgent построил последний ответ беседы (user_id, workspace_id).
+    Уточняющий вопрос сравнивается с ними по эмбеддингам: если близкие фрагменты составляют не меньше
+    min_covered_ratio набора, они используются вместо нового поиска. Набор живет ttl_seconds после последнего ответа
+    и не используется после изменения документов пространства или при другом belongs_to
+    """
+
+    def __init__(self,
+                 ttl_seconds: int = WORKING_SET_TTL_SECONDS,
+                 max_conversations: int = WORKING_SET_MAX_CONVERSATIONS,
+                 min_similarity: float = WORKING_SET_MIN_SIMILARITY,
+                 min_covered_ratio: float = WORKING_SET_MIN_COVERED_RATIO):
+        self.min_similarity = min_similarity
+        self.min_covered_ratio = min_covered_ratio
+        self._lock = threading.Lock()
+        self._sets: TTLCache = TTLCache(maxsize=max_conversations, ttl=ttl_seconds)
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    def find(self, user_id: int, workspace_id: int, belongs_to: Optional[str], question: str) -> list[Document] | None:
+        """Фрагменты рабочего набора, близкие к вопросу, в порядке убывания близости,
+        None - если набора нет или он не покрывает вопрос
+        """
+        with self._lock:
+            working_set: WorkingSet | None = self._sets.get((int(user_id), int(workspace_id)))
+        if (working_set is None or working_set.belongs_to != belongs_to
+                or working_set.version != WorkspaceVersions.get(user_id, workspace_id)):
+            metrics.inc("working_set_misses", labels={"reason": "empty"})
+            return None
+        similarities = working_set.embeddings @ self._normalize(embeddings.embed_query(question))
+        covered = self.covered(similarities)
+        if covered is None:
+            metrics.inc("working_set_misses", labels={"reason": "not_covered"})
+            return None
+        metrics.inc("working_set_hits")
+        return [working_set.documents[i] for i in covered]
+
+    def covered(self, similarities: np.ndarray) -> list[int] | None:
+        """Номера фрагментов, близких к вопросу, по убыванию близости,
+        None - если их доля в наборе меньше min_covered_ratio
+        """
+        covered = [i for i in np.argsort(-similarities) if similarities[i] >= self.min_similarity]
+        if not covered or len(covered) < self.min_covered_ratio * len(similarities):
+            return None
+        return covered
+
+    def remember(self, user_id: int, workspace_id: int, belongs_to: Optional[str],
+                 documents: list[Document]) -> None:
+        version = WorkspaceVersions.get(user_id, workspace_id)
+        vectors = self._normalize(embeddings.embed_documents([doc.page_content for doc in documents]))
+        with self._lock:
+            self._sets[(int(user_id), int(workspace_id))] = WorkingSet(version, belongs_to, documents, vectors)
+
+    def touch(self, user_id: int, workspace_id: int) -> None:
+        """Продлевает жизнь набора, ответ на который был построен по нему"""
+        key = (int(user_id), int(workspace_id))
+        with self._lock:
+            working_set = self._sets.get(key)
+            if working_set is not None:
+                self._sets[key] = working_set
+
+    def forget(self, user_id: int, workspace_id: int) -> None:
+        with self._lock:
+            self._sets.pop((int(user_id), int(workspace_id)), None)
+
+
+working_sets = ConversationWorkingSets()
@@ -0,0 +1,24 @@
+import os
+
+from filelock import FileLock
+
+from src.rag_agent_api.config import WORKSPACE_LOCKS_DIR
+
+
+def workspace_lock(user_id: int, workspace_id: int, timeout: float = -1) -> FileLock:
+    """Межпроцессная блокировка пространства.
+    Под ней записываются фрагменты, векторы и файл пространства, чтобы сборщик мусора, работающий
+    отдельным процессом, не принял недописанный файл за удаленный и не пересобирал коллекцию во время записи.
+    timeout=-1 - ждать без ограничения
+    """
+    os.makedirs(WORKSPACE_LOCKS_DIR, exist_ok=True)
+    return FileLock(os.path.join(WORKSPACE_LOCKS_DIR, f"user_{user_id}_{workspace_id}.lock"), timeout=timeout)
+
+
+def user_store_lock(user_id: int, timeout: float = -1) -> FileLock:
+    """Межпроцессная блокировка каталога хранилища пользователя.
+    Под ней в каталоге создаются коллекции, а сборщик мусора удаляет каталог без коллекций,
+    иначе первая загрузка пользователя могла бы попасть в удаляемый каталог
+    """
+    os.makedirs(WORKSPACE_LOCKS_DIR, exist_ok=True)
+    return FileLock(os.path.join(WORKSPACE_LOCKS_DIR, f"user_{user_id}.lock"), timeout=timeout)
@@ -2,6 +2,7 @@ from typing import Any
 
 from fastapi import APIRouter
 
+from src.rag_agent_api.services.warmup_service import warmup_service
 from src.users_api.services.user_service import UserService
 from src.users_api.user_auth import UserAuth
 
@@ -32,6 +33,8 @@ async def login(email: str, password: str) -> dict[str, Any]:
     user = UserService.select_user_by_email(email)
     print("user", user)
     token = user_auth.login_for_access_token(email, password)
+    if token["status"] == 200:
+        warmup_service.schedule_user(user.id)
     return {"status": 200, "user_id": user.id, "token": token}
 
 
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Тесты работают во временном каталоге: пути из config.py (var/, кэш LLM) создаются при импорте относительно него.
+# База - sqlite в том же каталоге, переменная читается при импорте src.database.connection
+_work_dir = tempfile.mkdtemp()
+os.chdir(_work_dir)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_work_dir, 'tests.db')}")
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from src.rag_agent_api.agents.searcher_agent import SeracherAgent
+from src.rag_agent_api.agents.supervisor_agent import SuperVisor
+from src.rag_agent_api.routers import main_router
+from src.rag_agent_api.services.database.messages_service import Message
+
+ANSWER = "Столица Франции - Париж, это крупнейший город страны."
+
+
+async def fake_search(self, state):
+    return {"searched_content": "Париж - столица и крупнейший город Франции"}
+
+
+def collect_events(question: str, chat_history: list[Message]) -> list[tuple[str, object]]:
+    async def collect():
+        return [event async for event in main_router._stream_agent(question, 1, 37, None, chat_history, None)]
+
+    events = []
+    for raw in asyncio.run(collect()):
+        event, data = raw.strip().split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_web_search_stream_matches_final_answer(monkeypatch):
+    monkeypatch.setattr(SeracherAgent, "search", fake_search)
+    model = GenericFakeChatModel(messages=iter([
+        AIMessage(content="web_searcher"),
+        AIMessage(content="Какая столица Франции?"),
+        AIMessage(content=ANSWER),
+    ]))
+    monkeypatch.setattr(main_router, "super_visor", SuperVisor(model=model))
+    monkeypatch.setattr(main_router.VectorDBManager, "get_or_create_retriever", lambda user_id, workspace_id: None)
+    chat_history = [Message(1, "user", "Что такое Франция?", "", False),
+                    Message(2, "user", "А какая у нее столица?", "", False)]
+
+    events = collect_events("А какая у нее столица?", chat_history)
+
+    streamed = "".join(data for event, data in events if event == "token")
+    done = [data for event, data in events if event == "done"]
+    assert streamed == ANSWER
+    assert len(done) == 1 and done[0]["answer"] == ANSWER
+    assert done[0]["use_web_search"] and not done[0]["use_visualizer"]
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src.rag_agent_api.services.database.documents_getter_service import DocumentsGetterService
+from src.rag_agent_api.services.llm_model_service import SummarizeContentAndDocs
+from src.rag_agent_api.services.text_splitter_service import TextSplitterService
+from src.rag_agent_api.services.vectore_store_service import VecStoreService
+
+USER_ID = 1
+WORKSPACE_ID = 27
+FILE_NAME = "report.txt"
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.documents = {}
+
+    def add_documents(self, documents, ids):
+        self.documents.update(zip(ids, documents))
+
+    def delete(self, ids):
+        for i in ids:
+            self.documents.pop(i, None)
+
+
+@pytest.fixture
+def vectorstore(monkeypatch) -> FakeVectorStore:
+    monkeypatch.setattr(TextSplitterService, "get_semantic_split_documents",
+                        staticmethod(lambda content: content.split("\n\n")))
+    return FakeVectorStore()
+
+
+def upload(vectorstore: FakeVectorStore, content: str) -> None:
+    model_service = SimpleNamespace(
+        get_summarize_docs_with_questions=lambda chunks: SummarizeContentAndDocs(chunks, chunks))
+    VecStoreService(model_service, SimpleNamespace(vectorstore=vectorstore), content, FILE_NAME,
+                    USER_ID, WORKSPACE_ID).save_docs_and_add_in_retriever()
+
+
+def test_reupload_of_shortened_file_keeps_only_new_chunks(vectorstore):
+    upload(vectorstore, "старый первый\n\nстарый второй\n\nстарый третий")
+    upload(vectorstore, "новый первый\n\nновый второй")
+
+    chunks = DocumentsGetterService.get_source_chunks_by_spans(USER_ID, WORKSPACE_ID, {FILE_NAME: [(0, 10)]})
+    assert [c.page_content for c in chunks] == ["новый первый", "новый второй"]
+    assert DocumentsGetterService.get_file_doc_numbers(USER_ID, WORKSPACE_ID, FILE_NAME) == [0, 1]
+    assert sorted(vectorstore.documents) == [f"{FILE_NAME}::0", f"{FILE_NAME}::1"]
+    files = DocumentsGetterService.get_all_files_from_workspace(USER_ID, WORKSPACE_ID)
+    assert [f.summary_content for f in files] == ["новый первый\nновый второй"]
@@ -0,0 +1,11 @@
+from src.database.repositories import workspaceVersionsCRUDRepository
+from src.rag_agent_api.services.retrieval_cache_service import WorkspaceVersions
+
+
+def test_versions_are_stored_in_database():
+    assert WorkspaceVersions.get(2, 26) == 0
+    assert WorkspaceVersions.bump(2, 26) == 1
+    assert WorkspaceVersions.bump(2, 26) == 2
+
+    assert workspaceVersionsCRUDRepository.select_version(2, 26) == 2
+    assert WorkspaceVersions.get(2, 27) == 0